@@ -1,20 +1,34 @@
 import os
+import re
+import json
 import base64
+import hashlib
 import requests as http_requests
-from datetime import datetime, date
+from datetime import datetime, date, timedelta
 from functools import wraps
-from flask import Flask, render_template, request, jsonify, redirect, url_for, flash, session, send_file
+from werkzeug.exceptions import RequestEntityTooLarge
+from itsdangerous import URLSafeTimedSerializer, BadSignature
+from flask import Flask, render_template, request, jsonify, redirect, url_for, flash, session, send_file, Response
 from models import (
-    init_db, Employee, Attendance, StatutoryDeduction, 
+    Employee, Attendance, StatutoryDeduction, 
     Holiday, Branch, Settings, PayrollPeriod, PayrollRecord, get_db, get_cursor, ActivityLog,
-    Admin, DatabaseManager, get_manila_now, AdminAuthCode, EmployeeSchedule
+    Admin, DatabaseManager, get_manila_now, AdminAuthCode, EmployeeSchedule, BackgroundJob, KioskPunch,
+    PayrollInProgress
 )
-from pdf_payslip import generate_payslip_pdf
+from pdf_payslip import generate_payslip_pdf, generate_period_payslips_pdf, iter_payslip_zip, PAYSLIP_TEMPLATE_VERSION
+import db_pool
+import jobs
+import payslip_cache
+import photo_pipeline
+import punch_dedupe
+import id_photos
+import migrate
 import pytz
 from supabase import create_client, Client
 
 app = Flask(__name__)
 app.secret_key = os.environ.get('SESSION_SECRET', 'dev-secret-key')
+db_pool.init_app(app)
 
 SUPABASE_URL = os.environ.get('SUPABASE_URL', '')
 SUPABASE_KEY = os.environ.get('SUPABASE_KEY', '')
@@ -52,24 +66,61 @@ def manila_time_filter(timestamp_obj):
             return '-'
 
 @app.template_filter('fix_photo_url')
-def fix_photo_url_filter(photo_path):
+def fix_photo_url_filter(photo_path, variant='full', fmt='JPEG'):
+    """URL of a punch photo, or of its thumbnail/WebP rendition when it has one."""
     if not photo_path:
         return None
     photo_path = str(photo_path)
+    if photo_pipeline.is_pending(photo_path):
+        return None
     if photo_path.startswith('http://') or photo_path.startswith('https://'):
-        return photo_path
+        return photo_pipeline.variant_url(photo_path, variant, fmt)
     if '/home/ubuntu/attendance/' in photo_path:
         photo_path = photo_path.replace('/home/ubuntu/attendance/', '')
     if not photo_path.startswith('static/') and not photo_path.startswith('/'):
         photo_path = f"static/uploads/{photo_path.split('/')[-1]}"
-    return photo_path
+    return photo_pipeline.variant_url(photo_path, variant, fmt)
+
+@app.template_filter('id_photo_url')
+def id_photo_url_filter(id_photo, variant='full'):
+    if not id_photo:
+        return None
+    if id_photos.is_ref(id_photo):
+        return url_for('id_photo', key=id_photos.key_of(id_photo), variant=variant)
+    if id_photo.startswith('data:'):
+        return id_photo
+    return '/' + id_photo
+
+# Periods with more payslips than this are exported as a background job with progress
+PAYSLIP_ZIP_STREAM_MAX = int(os.environ.get('PAYSLIP_ZIP_STREAM_MAX', '100'))
+# Periods with more payslips than this get their printable register from a background job
+PAYSLIP_PDF_INLINE_MAX = int(os.environ.get('PAYSLIP_PDF_INLINE_MAX', '100'))
 
 UPLOAD_FOLDER = 'static/uploads'
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+photo_pipeline.configure(supabase_client, UPLOAD_FOLDER)
+id_photos.configure(supabase_client)
+
+def check_schema_version():
+    """Single version lookup per worker boot; migrations run via `python migrate.py`."""
+    current, latest = migrate.schema_status()
+    if current >= latest:
+        return
+    if os.environ.get('AUTO_MIGRATE', '').lower() in ('1', 'true', 'yes'):
+        applied = migrate.apply_migrations()
+        app.logger.info(f"Applied schema migrations: {applied}")
+    else:
+        app.logger.warning(
+            f"Database schema is at version {current} but {latest} is available. "
+            "Run `python migrate.py` (or set AUTO_MIGRATE=1) to upgrade."
+        )
 
-init_db()
+check_schema_version()
 
-# Database already fixed via Supabase SQL Editor
+@app.before_request
+def ensure_job_worker():
+    # Started lazily so each forked gunicorn worker gets its own thread
+    jobs.start_embedded_worker()
 
 def login_required(f):
     @wraps(f)
@@ -145,51 +196,28 @@ def admin_logout():
 @app.route('/admin')
 @login_required
 def admin_dashboard():
-    employees = Employee.get_all(include_resigned=True)
+    employees = Employee.get_all(include_resigned=True, projection='roster')
     branches = Branch.get_all()
     return render_template('admin/dashboard.html', employees=employees, branches=branches, can_edit_delete=can_edit_delete())
 
 @app.route('/admin/employees')
 @login_required
 def admin_employees():
-    employees = Employee.get_all(include_resigned=True)
+    employees = Employee.get_all(include_resigned=True, projection='list')
     branches = Branch.get_all()
     today = date.today().strftime('%Y-%m-%d')
     return render_template('admin/employees.html', employees=employees, branches=branches, can_edit_delete=can_edit_delete(), today=today)
 
 def validate_and_save_id_photo(photo_data, employee_id):
-    import base64
-    import re
-    from PIL import Image
-    from io import BytesIO
-    
+    """Store an uploaded data-URL ID photo; returns its reference (or the data URL kept inline) or None."""
     if not photo_data or not photo_data.startswith('data:image/'):
         return None
     
-    match = re.match(r'data:image/(jpeg|png|webp);base64,(.+)', photo_data)
-    if not match:
-        return None
-    
     try:
-        img_bytes = base64.b64decode(match.group(2))
-        if len(img_bytes) > 5 * 1024 * 1024:
+        img_bytes = id_photos.decode_data_url(photo_data)
+        if not img_bytes or len(img_bytes) > 5 * 1024 * 1024:
             return None
-        
-        safe_emp_id = re.sub(r'[^a-zA-Z0-9_-]', '', employee_id)
-        import secrets
-        filename = f"id_{safe_emp_id}_{secrets.token_hex(8)}.jpg"
-        photo_path = f"static/uploads/id_photos/{filename}"
-        os.makedirs('static/uploads/id_photos', exist_ok=True)
-        
-        img = Image.open(BytesIO(img_bytes))
-        img = img.convert('RGB')
-        max_size = (400, 400)
-        img.thumbnail(max_size, Image.Resampling.LANCZOS)
-        # Return base64 string instead of path to ensure persistence on Railway
-        buffered = BytesIO()
-        img.save(buffered, format="JPEG", quality=70)
-        img_str = base64.b64encode(buffered.getvalue()).decode()
-        return f"data:image/jpeg;base64,{img_str}"
+        return id_photos.save_data_url(photo_data)
     except Exception:
         return None
 
@@ -317,7 +345,7 @@ def edit_employee(emp_id):
     new_id_photo = validate_and_save_id_photo(data.get('id_photo'), data['employee_id'])
     new_cv_file = validate_and_save_cv(request.files.get('cv_file'), data['employee_id'])
 
-    existing = Employee.get_by_id(emp_id)
+    existing = Employee.get_by_id(emp_id, projection='files')
     id_photo_path = new_id_photo if new_id_photo is not None else (existing.get('id_photo') if existing else None)
     cv_file_path = new_cv_file if new_cv_file is not None else (existing.get('cv_file') if existing else None)
 
@@ -421,6 +449,7 @@ def get_employee_json(emp_id):
             # Serialize employee data
             if emp:
                 emp = {k: serialize_value(v) for k, v in emp.items()}
+                emp['id_photo_url'] = id_photo_url_filter(emp.get('id_photo'))
             
             # Serialize schedule data
             if schedule:
@@ -434,6 +463,24 @@ def get_employee_json(emp_id):
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/admin/id-photos/<key>/<variant>.jpg')
+@login_required
+def id_photo(key, variant):
+    # Content-addressed: the key is the ETag and the bytes never change
+    etag = f'{key}-{variant}'
+    if etag in request.if_none_match:
+        response = Response(status=304)
+    else:
+        data = id_photos.load(key, variant)
+        if data is None:
+            return Response(status=404)
+        response = Response(data, mimetype='image/jpeg')
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.max_age = 365 * 24 * 3600
+    response.cache_control.immutable = True
+    return response
+
 @app.route('/admin/employees/<int:emp_id>/status', methods=['POST'])
 @master_admin_required
 def change_employee_status(emp_id):
@@ -453,7 +500,6 @@ def change_employee_status(emp_id):
 @app.route('/admin/employees/<int:emp_id>/resign', methods=['POST'])
 @master_admin_required
 def resign_employee(emp_id):
-    emp = Employee.get_by_id(emp_id)
     Employee.mark_resigned(emp_id)
     ActivityLog.log(session['admin_id'], session['admin_name'], 'RESIGN', 'employee', emp_id, f"Marked employee as resigned", request.remote_addr)
     flash('Employee marked as resigned', 'success')
@@ -464,7 +510,7 @@ def resign_employee(emp_id):
 def admin_attendance():
     from datetime import datetime, date, timedelta
     
-    employees = Employee.get_all()
+    employees = Employee.get_all(projection='roster')
     today = get_manila_now().strftime('%Y-%m-%d')
     
     date_from = request.args.get('date_from', today)
@@ -551,32 +597,63 @@ def create_payroll_period():
         data['start_date'],
         data['end_date']
     )
-    PayrollRecord.generate_for_period(period_id)
-    flash('Payroll period created and records generated', 'success')
-    return redirect(url_for('admin_payroll'))
+    jobs.enqueue_payroll_generation(period_id, session.get('admin_id'))
+    flash('Payroll period created; records are being generated', 'success')
+    return redirect(url_for('view_payroll', period_id=period_id))
 
 @app.route('/admin/payroll/<int:period_id>')
 @login_required
 def view_payroll(period_id):
     period = PayrollPeriod.get_by_id(period_id)
-    records = PayrollRecord.get_by_period(period_id)
-    
-    records_with_deductions = []
-    for record in records:
-        deductions = PayrollRecord.get_deduction_items(record['id'])
-        records_with_deductions.append({
-            'record': record,
-            'deductions': deductions
-        })
+    active_job = BackgroundJob.get_active(jobs.PAYROLL_GENERATE, jobs.payroll_job_key(period_id))
+    export_job = BackgroundJob.get_latest(jobs.PAYSLIP_EXPORT, jobs.payroll_job_key(period_id))
+    if export_job and export_job['status'] == 'succeeded' and not os.path.exists(jobs.export_path(export_job['id'])):
+        export_job = None
+    register_job = BackgroundJob.get_latest(jobs.PAYSLIP_REGISTER, jobs.payroll_job_key(period_id))
+    if register_job and register_job['status'] == 'succeeded' and \
+            not os.path.exists(jobs.export_path(register_job['id'], jobs.PAYSLIP_REGISTER)):
+        register_job = None
+    # ?preview=<job id> shows that preview job: its progress, then its diff
+    preview_job = preview = None
+    preview_id = request.args.get('preview', type=int)
+    if preview_id and period and not period['is_locked']:
+        preview_job = BackgroundJob.get_by_id(preview_id)
+        if not preview_job or preview_job['job_type'] != jobs.PAYROLL_PREVIEW \
+                or preview_job['payload'].get('period_id') != period_id:
+            preview_job = None
+        elif preview_job['status'] == 'succeeded':
+            preview = preview_job['result']['diff']
+    records = PayrollRecord.get_by_period(period_id, with_deductions=True)
+    records_with_deductions = [{'record': record, 'deductions': record['deductions']} for record in records]
     
     return render_template('admin/payroll_view.html', 
                          period=period, 
-                         records=records_with_deductions)
+                         records=records_with_deductions,
+                         active_job=active_job,
+                         export_job=export_job,
+                         register_job=register_job,
+                         export_in_background=len(records) > PAYSLIP_ZIP_STREAM_MAX,
+                         preview_job=preview_job,
+                         preview=preview)
+
+@app.route('/admin/payroll/<int:period_id>/preview', methods=['POST'])
+@login_required
+def preview_payroll(period_id):
+    job_id, _ = jobs.enqueue_payroll_preview(period_id, session.get('admin_id'))
+    return redirect(url_for('view_payroll', period_id=period_id, preview=job_id))
 
 @app.route('/admin/payroll/<int:period_id>/lock', methods=['POST'])
 @master_admin_required
 def lock_payroll(period_id):
-    PayrollPeriod.lock(period_id)
+    if BackgroundJob.get_active(jobs.PAYROLL_GENERATE, jobs.payroll_job_key(period_id)):
+        flash('Payroll for this period is still being generated; lock it when that finishes', 'error')
+        return redirect(url_for('view_payroll', period_id=period_id))
+    try:
+        PayrollPeriod.lock(period_id)
+    except PayrollInProgress:
+        flash('Payroll for this period is still being generated; lock it when that finishes', 'error')
+        return redirect(url_for('view_payroll', period_id=period_id))
+    jobs.enqueue_payslip_prerender(period_id, session.get('admin_id'))
     flash('Payroll period locked', 'success')
     return redirect(url_for('view_payroll', period_id=period_id))
 
@@ -587,78 +664,142 @@ def regenerate_payroll(period_id):
     if period['is_locked']:
         flash('Cannot regenerate locked payroll period', 'error')
     else:
-        PayrollRecord.generate_for_period(period_id)
-        flash('Payroll records regenerated', 'success')
+        full = request.form.get('full') == '1'
+        _, created = jobs.enqueue_payroll_generation(period_id, session.get('admin_id'), full=full)
+        if created:
+            flash('Payroll regeneration started', 'success')
+        else:
+            flash('Payroll for this period is already being generated', 'error')
     return redirect(url_for('view_payroll', period_id=period_id))
 
+@app.route('/admin/jobs/<int:job_id>/download')
+@login_required
+def download_job_result(job_id):
+    job = BackgroundJob.get_by_id(job_id)
+    if not job or job['job_type'] not in jobs.EXPORT_FORMATS or job['status'] != 'succeeded' \
+            or not os.path.exists(jobs.export_path(job_id, job['job_type'])):
+        flash('Export not available; please export again', 'error')
+        return redirect(url_for('admin_payroll'))
+    return send_file(jobs.export_path(job_id, job['job_type']), mimetype=jobs.EXPORT_FORMATS[job['job_type']][1],
+                     as_attachment=True, download_name=job['result']['filename'])
+
+@app.route('/admin/jobs/<int:job_id>')
+@login_required
+def job_status(job_id):
+    job = BackgroundJob.get_by_id(job_id)
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify({
+        'id': job['id'],
+        'type': job['job_type'],
+        'status': job['status'],
+        'progress': job['progress'],
+        'total': job['progress_total'],
+        'message': job['message'],
+        'error': job['error'],
+        'result': job['result']
+    })
+
 @app.route('/admin/payroll/record/<int:record_id>/pdf')
 @login_required
 def download_payslip_pdf(record_id):
-    conn = get_db()
-    cursor = get_cursor(conn)
-    
-    cursor.execute('''
-        SELECT pr.*, e.first_name, e.last_name, e.employee_id as emp_code,
-               e.position, b.name as branch_name
-        FROM payroll_records pr
-        JOIN employees e ON pr.employee_id = e.id
-        LEFT JOIN branches b ON e.branch_id = b.id
-        WHERE pr.id = %s
-    ''', (record_id,))
-    record = cursor.fetchone()
+    # Locked periods never change: serve the pre-rendered copy from the cache,
+    # unless it was rendered with an older template
+    entry = PayrollRecord.get_payslip_cache_entry(record_id)
+    if entry and entry['is_locked'] and entry['payslip_sha256'] \
+            and entry['payslip_template_version'] == PAYSLIP_TEMPLATE_VERSION:
+        path = payslip_cache.get(entry['payslip_sha256'])
+        if path:
+            return _send_cached_payslip(path, entry['payslip_sha256'], entry['filename'])
     
-    if not record:
-        conn.close()
+    payslips = PayrollRecord.get_payslip_inputs(record_id=record_id)
+    if not payslips:
         flash('Payroll record not found', 'error')
         return redirect(url_for('admin_payroll'))
+    payslip = payslips[0]
     
-    cursor.execute('SELECT * FROM payroll_periods WHERE id = %s', (record['payroll_period_id'],))
-    period = cursor.fetchone()
-    
-    cursor.execute('SELECT * FROM payroll_deduction_items WHERE payroll_record_id = %s', (record_id,))
-    deductions = cursor.fetchall()
-    conn.close()
-    
-    payroll_data = {
-        'locked_daily_rate': record['locked_daily_rate'],
-        'days_worked': record['days_worked'],
-        'regular_pay': record['regular_pay'],
-        'overtime_pay': record['overtime_pay'],
-        'holiday_pay': record['holiday_pay'],
-        'tardiness_deduction': record['tardiness_deduction'],
-        'undertime_deduction': record['undertime_deduction'],
-        'gross_pay': record['gross_pay'],
-        'total_deductions': record['total_deductions'],
-        'net_pay': record['net_pay']
-    }
-    
-    employee_data = {
-        'first_name': record['first_name'],
-        'last_name': record['last_name'],
-        'employee_id': record['emp_code'],
-        'position': record['position'],
-        'branch_name': record['branch_name']
-    }
-    
-    period_data = {
-        'name': period['name'],
-        'start_date': period['start_date'],
-        'end_date': period['end_date']
-    }
-    
-    deductions_list = [dict(d) for d in deductions]
-    
-    pdf_buffer = generate_payslip_pdf(payroll_data, employee_data, period_data, deductions_list)
+    pdf_buffer = generate_payslip_pdf(payslip['payroll_data'], payslip['employee_data'],
+                                      payslip['period_data'], payslip['deductions'])
     
-    filename = f"Payslip_{record['first_name']}_{record['last_name']}_{period['name'].replace(' ', '_')}.pdf"
+    if entry and entry['is_locked']:
+        key = payslip_cache.cache_key(payslip)
+        path = payslip_cache.put(key, pdf_buffer.getvalue())
+        PayrollRecord.set_payslip_hashes([(record_id, key)], PAYSLIP_TEMPLATE_VERSION)
+        return _send_cached_payslip(path, key, payslip['filename'])
     
     return send_file(
         pdf_buffer,
         mimetype='application/pdf',
         as_attachment=True,
-        download_name=filename
+        download_name=payslip['filename']
+    )
+
+def _send_cached_payslip(path, key, filename):
+    return send_file(
+        path,
+        mimetype='application/pdf',
+        as_attachment=True,
+        download_name=filename,
+        etag=key,
+        last_modified=os.path.getmtime(path),
+        conditional=True
     )
 
+@app.route('/admin/payroll/<int:period_id>/payslips.zip')
+@login_required
+def download_period_payslips_zip(period_id):
+    period = PayrollPeriod.get_by_id(period_id)
+    if not period:
+        flash('Payroll period not found', 'error')
+        return redirect(url_for('admin_payroll'))
+    payslips = PayrollRecord.get_payslip_inputs(period_id=period_id)
+    if len(payslips) > PAYSLIP_ZIP_STREAM_MAX:
+        jobs.enqueue_payslip_export(period_id, session.get('admin_id'))
+        flash('This period has too many payslips to download directly; they are being exported', 'success')
+        return redirect(url_for('view_payroll', period_id=period_id))
+    filename = f"Payslips_{period['name'].replace(' ', '_')}.zip"
+    # Everything the archive needs is loaded, so the stream runs without the
+    # request context: the pooled connection goes back at teardown instead of
+    # being held while the client downloads. Rendering stays in this process
+    # (workers=1); process pools are for the job worker.
+    return Response(
+        iter_payslip_zip(payslips, workers=1),
+        mimetype='application/zip',
+        headers={'Content-Disposition': f'attachment; filename="{filename}"'}
+    )
+
+@app.route('/admin/payroll/<int:period_id>/payslips.pdf')
+@login_required
+def download_period_payslips_pdf(period_id):
+    period = PayrollPeriod.get_by_id(period_id)
+    if not period:
+        flash('Payroll period not found', 'error')
+        return redirect(url_for('admin_payroll'))
+    payslips = PayrollRecord.get_payslip_inputs(period_id=period_id)
+    if len(payslips) > PAYSLIP_PDF_INLINE_MAX:
+        jobs.enqueue_payslip_register(period_id, session.get('admin_id'))
+        flash('This period has too many payslips to print directly; the register is being prepared', 'success')
+        return redirect(url_for('view_payroll', period_id=period_id))
+    # The inputs are loaded; don't hold a pooled connection while rendering
+    db_pool.release_request_connection()
+    pdf_file = generate_period_payslips_pdf(payslips)
+    return send_file(
+        pdf_file,
+        mimetype='application/pdf',
+        as_attachment=True,
+        download_name=f"Payslips_{period['name'].replace(' ', '_')}.pdf"
+    )
+
+@app.route('/admin/payroll/<int:period_id>/payslips/export', methods=['POST'])
+@login_required
+def export_period_payslips(period_id):
+    _, created = jobs.enqueue_payslip_export(period_id, session.get('admin_id'))
+    if created:
+        flash('Payslip export started', 'success')
+    else:
+        flash('Payslips for this period are already being exported', 'error')
+    return redirect(url_for('view_payroll', period_id=period_id))
+
 @app.route('/admin/13th-month')
 @login_required
 def thirteenth_month():
@@ -927,150 +1068,239 @@ def database_reset():
     flash('All employee and attendance data has been deleted', 'success')
     return redirect(url_for('admin_settings'))
 
+def _roster_etag(branch_id):
+    version = Employee.roster_version(branch_id)
+    return hashlib.sha256(f'{branch_id}|{version}'.encode()).hexdigest()[:32]
+
 @app.route('/tablet')
 def tablet_station():
-    employees = Employee.get_active()
-    return render_template('tablet/station.html', employees=employees)
+    # A station can be pinned to one branch with ?branch_id=
+    branch_id = request.args.get('branch_id', type=int)
+    return render_template('tablet/station.html', employees=Employee.get_roster(branch_id),
+                           branch_id=branch_id, roster_etag=_roster_etag(branch_id))
 
 @app.route('/api/verify-pin', methods=['POST'])
 def verify_pin():
+    """
+    Check an employee's PIN. Kiosks also send the id of the punch they are
+    about to make and get back a punch token for it, which is what a punch
+    queued offline carries instead of the PIN (see /api/kiosk/sync).
+    """
     data = request.json
     employee_id = data.get('employee_id')
     pin = data.get('pin')
+    punch_id = data.get('punch_id')
     
     if Employee.verify_pin(employee_id, pin):
         status = Attendance.get_today_status(employee_id)
         has_open_record = status is not None
-        return jsonify({
+        result = {
             'success': True, 
             'has_open_record': has_open_record,
             'current_purpose': status['time_in_purpose'] if has_open_record else None
-        })
+        }
+        if punch_id and PUNCH_KEY_RE.match(str(punch_id)):
+            result['punch_token'] = _punch_tokens().dumps({'employee_id': int(employee_id), 'punch_id': punch_id})
+        return jsonify(result)
     return jsonify({'success': False, 'message': 'Invalid PIN'})
 
+def _punch_tokens():
+    """Signs punch tokens: proof that a punch's employee entered their PIN when it was made."""
+    return URLSafeTimedSerializer(app.secret_key, salt='kiosk-punch')
+
+# Room for the multipart `payload` field and part headers next to the photo
+PUNCH_FORM_OVERHEAD = 64 * 1024
+# Kiosk-generated punch ids, used as idempotency keys
+PUNCH_KEY_RE = re.compile(r'^[0-9A-Za-z-]{8,64}$')
+
+def _read_punch_request():
+    """
+    (data, photo bytes) of a punch. Kiosks post multipart/form-data with the
+    fields as JSON in `payload` and the raw JPEG as the `photo` part; the
+    original JSON body with a base64 data URL is still accepted. Either way
+    werkzeug receives the whole body before it is parsed, so its size is
+    capped with max_content_length and the photo is checked once decoded.
+    Raises ValueError (InvalidPhoto for the photo) on a malformed request.
+    """
+    if request.mimetype == 'multipart/form-data':
+        request.max_content_length = photo_pipeline.PHOTO_MAX_BYTES + PUNCH_FORM_OVERHEAD
+        try:
+            data = json.loads(request.form.get('payload') or '{}')
+            upload = request.files.get('photo')
+        except RequestEntityTooLarge:
+            raise photo_pipeline.InvalidPhoto("Photo is too large")
+        except ValueError:
+            raise ValueError("Invalid punch data")
+        if not isinstance(data, dict):
+            raise ValueError("Invalid punch data")
+        return data, photo_pipeline.read_upload(upload.stream) if upload else None
+    # Base64 is 4/3 the size of the photo it encodes
+    request.max_content_length = photo_pipeline.PHOTO_MAX_BYTES * 4 // 3 + PUNCH_FORM_OVERHEAD
+    try:
+        data = request.get_json(silent=True)
+    except RequestEntityTooLarge:
+        raise photo_pipeline.InvalidPhoto("Photo is too large")
+    if not isinstance(data, dict):
+        raise ValueError("Invalid punch data")
+    photo_data = data.get('photo')
+    if not photo_data:
+        return data, None
+    try:
+        photo_bytes = base64.b64decode(str(photo_data).split(',', 1)[-1], validate=True)
+    except ValueError:
+        raise photo_pipeline.InvalidPhoto("Photo must be a JPEG image")
+    return data, photo_pipeline.check_photo(photo_bytes)
+
 @app.route('/api/record-attendance', methods=['POST'])
 def record_attendance():
-    data = request.json
+    """
+    Record a punch. Kiosks send an Idempotency-Key header that stays the same
+    when a punch is resubmitted; repeats get the first submission's response.
+    """
+    try:
+        data, photo_bytes = _read_punch_request()
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    idempotency_key = request.headers.get('Idempotency-Key')
+    if idempotency_key and not PUNCH_KEY_RE.match(idempotency_key):
+        return jsonify({'success': False, 'message': 'Invalid Idempotency-Key'}), 400
+    dedupe_key = f"{data.get('employee_id')}:{data.get('action')}:{idempotency_key}" if idempotency_key else None
+    payload, status = punch_dedupe.run_once(
+        dedupe_key, lambda: _record_punch(data, photo_bytes, idempotency_key))
+    return jsonify(payload), status
+
+def _record_punch(data, photo_bytes, idempotency_key):
+    """(response payload, status) of recording one punch from the kiosk."""
     employee_id = data.get('employee_id')
     action = data.get('action')
     purpose = data.get('purpose', 'clock_in' if action == 'time_in' else 'clock_out')
-    photo_data = data.get('photo')
     early_start_approved = data.get('early_start_approved', False)
     official_overtime_approved = data.get('official_overtime_approved', False)
     is_remote_field = data.get('is_remote_field', False)
     remote_field_hours = data.get('remote_field_hours', 0)
     
-    if photo_data:
-        photo_data = photo_data.split(',')[1]
-        photo_bytes = base64.b64decode(photo_data)
+    # The photo is processed after the punch commits; the row holds a pending
+    # reference until photo_pipeline swaps in the stored path.
+    photo_path = None
+    if photo_bytes:
         timestamp = get_manila_now().strftime('%Y%m%d_%H%M%S')
-        filename = f"{employee_id}_{purpose}_{timestamp}.jpg"
-        
-        from PIL import Image, ImageDraw, ImageFont
-        from io import BytesIO
-        img = Image.open(BytesIO(photo_bytes))
-        img = img.convert('RGB')
-        max_size = (640, 480)
-        img.thumbnail(max_size, Image.Resampling.LANCZOS)
-        
-        # Add purpose label overlay
-        draw = ImageDraw.Draw(img)
-        
-        # Purpose label mapping for display
-        purpose_labels = {
-            'clock_in': 'CLOCK IN',
-            'clock_out': 'CLOCK OUT',
-            'lunch_break_in': 'LUNCH BREAK - IN',
-            'lunch_break_out': 'LUNCH BREAK - OUT',
-            'snack_break_in': 'SNACK BREAK - IN',
-            'snack_break_out': 'SNACK BREAK - OUT',
-            'emergency_in': 'EMERGENCY - IN',
-            'emergency_out': 'EMERGENCY - OUT',
-            'early_start': 'EARLY START',
-            'remote_field': 'REMOTE/FIELD',
-            'official_overtime': 'OVERTIME',
-            'unapproved_undertime_out': 'UNDERTIME - OUT'
-        }
-        
-        purpose_text = purpose_labels.get(purpose, purpose.upper().replace('_', ' '))
-        
-        # Try to use a better font, fallback to default
-        try:
-            font = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf", 24)
-        except:
-            font = ImageFont.load_default()
-        
-        # Get text size for background rectangle
-        bbox = draw.textbbox((0, 0), purpose_text, font=font)
-        text_width = bbox[2] - bbox[0]
-        text_height = bbox[3] - bbox[1]
-        
-        # Position at top center
-        img_width, img_height = img.size
-        x = (img_width - text_width) // 2
-        y = 10
-        
-        # Draw semi-transparent background
-        padding = 10
-        draw.rectangle(
-            [(x - padding, y - padding), (x + text_width + padding, y + text_height + padding)],
-            fill=(0, 0, 0, 180)
-        )
-        
-        # Draw text in white
-        draw.text((x, y), purpose_text, fill=(255, 255, 255), font=font)
-        
-        output = BytesIO()
-        img.save(output, 'JPEG', quality=60, optimize=True)
-        output.seek(0)
-        
-        # Try Supabase Storage first, fallback to local storage
-        if supabase_client:
-            try:
-                file_bytes = output.read()
-                output.seek(0)  # Reset for potential fallback
-                
-                # Upload to Supabase Storage
-                response = supabase_client.storage.from_('attendance-photos').upload(
-                    path=filename,
-                    file=file_bytes,
-                    file_options={"content-type": "image/jpeg", "upsert": "true"}
-                )
-                
-                # Get public URL
-                photo_path = supabase_client.storage.from_('attendance-photos').get_public_url(filename)
-                print(f"Photo uploaded to Supabase Storage: {photo_path}")
-            except Exception as e:
-                import traceback
-                print(f"Supabase Storage upload failed: {e}")
-                print(traceback.format_exc())
-                # Fallback to local storage
-                filepath = os.path.join(UPLOAD_FOLDER, filename)
-                output.seek(0)
-                with open(filepath, 'wb') as f:
-                    f.write(output.read())
-                photo_path = f"static/uploads/{filename}"
-                print(f"Fallback: Photo saved locally to {photo_path}")
-        else:
-            # No Supabase client, use local storage
-            print("Supabase client not initialized, saving locally")
-            filepath = os.path.join(UPLOAD_FOLDER, filename)
-            output.seek(0)
-            with open(filepath, 'wb') as f:
-                f.write(output.read())
-            photo_path = f"static/uploads/{filename}"
-            print(f"Photo saved locally to {photo_path}")
-    else:
-        photo_path = None
+        filename = photo_pipeline.photo_filename(employee_id, purpose, timestamp)
+        photo_path = photo_pipeline.pending_ref(filename)
     
     if action == 'time_in':
-        record_id, message = Attendance.time_in(employee_id, photo_path, purpose, early_start_approved, is_remote_field=is_remote_field, remote_field_hours=remote_field_hours)
+        record_id, message, replayed = Attendance.time_in(employee_id, photo_path, purpose, early_start_approved, is_remote_field=is_remote_field, remote_field_hours=remote_field_hours, idempotency_key=idempotency_key)
     else:
-        record_id, message = Attendance.time_out(employee_id, photo_path, purpose, official_overtime_approved)
+        record_id, message, replayed = Attendance.time_out(employee_id, photo_path, purpose, official_overtime_approved, idempotency_key=idempotency_key)
     
     if record_id:
-        return jsonify({'success': True, 'message': message})
-    return jsonify({'success': False, 'message': message})
+        # A replayed punch already has its photo from the first submission
+        if photo_bytes and not replayed:
+            column = 'time_in_photo' if action == 'time_in' else 'time_out_photo'
+            photo_pipeline.submit(record_id, column, filename, photo_bytes, purpose)
+        return {'success': True, 'message': message}, 200
+    return {'success': False, 'message': message}, 200
+
+# Punches a kiosk may replay per sync request, the oldest queued punch the
+# server still accepts, and how far ahead of the server a kiosk clock may run
+KIOSK_SYNC_BATCH_MAX = 20
+KIOSK_PUNCH_MAX_AGE = timedelta(days=3)
+KIOSK_CLOCK_SKEW = timedelta(minutes=5)
+# A punch must be made within this long after its PIN check
+PUNCH_TOKEN_WINDOW = timedelta(minutes=10)
+
+def _parse_queued_punch(item, received_at):
+    """A validated punch dict from one entry of a kiosk sync batch; ValueError if unusable."""
+    if not isinstance(item, dict) or not PUNCH_KEY_RE.match(str(item.get('client_id', ''))):
+        raise ValueError("Missing punch id")
+    action = item.get('action')
+    if action not in ('time_in', 'time_out'):
+        raise ValueError("Unknown action")
+    try:
+        employee_id = int(item.get('employee_id'))
+        punched_at = datetime.fromisoformat(str(item.get('punched_at')))
+    except (TypeError, ValueError):
+        raise ValueError("Invalid employee or punch time")
+    if punched_at.tzinfo is None:
+        raise ValueError("Punch time has no time zone")
+    if punched_at > received_at + KIOSK_CLOCK_SKEW or punched_at < received_at - KIOSK_PUNCH_MAX_AGE:
+        raise ValueError("Punch time is out of range")
+    try:
+        claims, verified_at = _punch_tokens().loads(
+            str(item.get('punch_token') or ''), max_age=KIOSK_PUNCH_MAX_AGE.total_seconds(), return_timestamp=True)
+    except BadSignature:
+        raise ValueError("Punch has no valid PIN check")
+    if claims.get('employee_id') != employee_id or claims.get('punch_id') != item['client_id']:
+        raise ValueError("Punch has no valid PIN check")
+    if not verified_at - KIOSK_CLOCK_SKEW <= punched_at <= verified_at + PUNCH_TOKEN_WINDOW:
+        raise ValueError("Punch time does not match its PIN check")
+    return {
+        'client_id': item['client_id'],
+        'employee_id': employee_id,
+        'action': action,
+        'purpose': item.get('purpose') or ('clock_in' if action == 'time_in' else 'clock_out'),
+        'punched_at': punched_at.astimezone(MANILA_TZ),
+        'photo_path': None,
+        'early_start_approved': bool(item.get('early_start_approved')),
+        'official_overtime_approved': bool(item.get('official_overtime_approved')),
+        'is_remote_field': bool(item.get('is_remote_field')),
+        'remote_field_hours': float(item.get('remote_field_hours') or 0),
+    }
+
+@app.route('/api/kiosk/sync', methods=['POST'])
+def kiosk_sync():
+    """
+    Replay punches a kiosk queued while offline. The body is multipart with a
+    `punches` JSON list (client_id, employee_id, action, purpose, punched_at
+    as ISO 8601, the punch_token /api/verify-pin issued for it and the
+    approval fields) and each punch's JPEG as
+    the `photo_<client_id>` part. The batch is recorded in one transaction;
+    punches missing from `results` hit a database error and should be sent
+    again.
+    """
+    request.max_content_length = KIOSK_SYNC_BATCH_MAX * (photo_pipeline.PHOTO_MAX_BYTES + PUNCH_FORM_OVERHEAD)
+    try:
+        items = json.loads(request.form.get('punches') or '[]')
+        uploads = request.files
+    except RequestEntityTooLarge:
+        return jsonify({'success': False, 'message': 'Sync batch is too large'}), 413
+    except ValueError:
+        return jsonify({'success': False, 'message': 'Invalid sync batch'}), 400
+    if not isinstance(items, list) or len(items) > KIOSK_SYNC_BATCH_MAX:
+        return jsonify({'success': False, 'message': f'Send at most {KIOSK_SYNC_BATCH_MAX} punches per batch'}), 400
+    
+    received_at = get_manila_now()
+    results = []
+    punches = []
+    photos = {}
+    for item in items:
+        try:
+            punch = _parse_queued_punch(item, received_at)
+            upload = uploads.get(f"photo_{punch['client_id']}")
+            if upload:
+                filename = photo_pipeline.photo_filename(
+                    punch['employee_id'], punch['purpose'], punch['punched_at'].strftime('%Y%m%d_%H%M%S'))
+                photos[punch['client_id']] = (filename, photo_pipeline.read_upload(upload.stream))
+                punch['photo_path'] = photo_pipeline.pending_ref(filename)
+        except ValueError as e:
+            results.append({'client_id': item.get('client_id') if isinstance(item, dict) else None,
+                            'success': False, 'message': str(e)})
+            continue
+        punches.append(punch)
+    
+    # Oldest first, so a clock-in queued before its clock-out is recorded first
+    punches.sort(key=lambda p: p['punched_at'])
+    recorded = KioskPunch.record_batch(punches) if punches else {}
+    for punch in punches:
+        outcome = recorded.get(punch['client_id'])
+        if not outcome:
+            continue
+        if outcome['success'] and not outcome['duplicate'] and punch['client_id'] in photos:
+            filename, photo_bytes = photos[punch['client_id']]
+            column = 'time_in_photo' if punch['action'] == 'time_in' else 'time_out_photo'
+            photo_pipeline.submit(outcome['attendance_id'], column, filename, photo_bytes, punch['purpose'])
+        results.append({'client_id': punch['client_id'], 'success': outcome['success'],
+                        'message': outcome['message'], 'duplicate': outcome['duplicate']})
+    return jsonify({'success': True, 'results': results})
 
 @app.route('/api/verify-auth-code', methods=['POST'])
 def verify_auth_code():
@@ -1107,8 +1337,20 @@ def verify_auth_code():
 
 @app.route('/api/employees')
 def api_employees():
-    employees = Employee.get_active()
-    return jsonify([dict(e) for e in employees])
+    """
+    Kiosk roster: id, code, name and branch of active employees, optionally
+    for one ?branch_id. The ETag is the roster version, so tablets polling
+    with If-None-Match get a 304 until an employee or branch changes.
+    """
+    branch_id = request.args.get('branch_id', type=int)
+    etag = _roster_etag(branch_id)
+    if etag in request.if_none_match:
+        response = Response(status=304)
+    else:
+        response = jsonify([dict(e) for e in Employee.get_roster(branch_id)])
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    return response
 
 @app.route('/api/reverse-geocode', methods=['POST'])
 def reverse_geocode():
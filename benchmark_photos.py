@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark of the punch photo stage.
+
+Compares the old labelling step (full JPEG decode, font loaded and label
+measured on every photo) with photo_pipeline.label_punch_photo() on
+synthetic camera frames, and reports the whole stage the server runs,
+photo_pipeline.render_punch_variants() (labelling plus the JPEG and WebP
+full and thumbnail renditions), all as CPU time per photo. No database is
+needed.
+
+Usage:
+    python3 benchmark_photos.py [iterations]
+"""
+import sys
+import time
+from io import BytesIO
+
+from PIL import Image, ImageDraw, ImageFont
+
+import photo_pipeline
+
+FRAME_SIZES = [(1280, 720), (1920, 1080), (4032, 3024)]
+
+
+def make_frame(size):
+    """A noisy JPEG roughly as hard to decode as a real camera frame."""
+    img = Image.merge('RGB', [Image.effect_noise(size, sigma).convert('L') for sigma in (40, 60, 80)])
+    output = BytesIO()
+    img.save(output, 'JPEG', quality=85)
+    return output.getvalue()
+
+
+def label_full_decode(photo_bytes, purpose):
+    """The labelling step as it was before draft decoding and font caching."""
+    img = Image.open(BytesIO(photo_bytes))
+    img = img.convert('RGB')
+    img.thumbnail(photo_pipeline.PHOTO_SIZE, Image.Resampling.LANCZOS)
+    draw = ImageDraw.Draw(img)
+    purpose_text = photo_pipeline.PURPOSE_LABELS.get(purpose, purpose.upper().replace('_', ' '))
+    try:
+        font = ImageFont.truetype(photo_pipeline.LABEL_FONT_PATH, 24)
+    except OSError:
+        font = ImageFont.load_default()
+    bbox = draw.textbbox((0, 0), purpose_text, font=font)
+    text_width = bbox[2] - bbox[0]
+    text_height = bbox[3] - bbox[1]
+    x = (img.size[0] - text_width) // 2
+    y = 10
+    padding = 10
+    draw.rectangle(
+        [(x - padding, y - padding), (x + text_width + padding, y + text_height + padding)],
+        fill=(0, 0, 0, 180)
+    )
+    draw.text((x, y), purpose_text, fill=(255, 255, 255), font=font)
+    return img
+
+
+def render_variants(photo_bytes, purpose):
+    return photo_pipeline.render_punch_variants(photo_bytes, purpose, 'benchmark.full.jpg')
+
+
+def cpu_per_photo(render, frame, iterations):
+    render(frame, 'clock_in')
+    start = time.process_time()
+    for _ in range(iterations):
+        render(frame, 'clock_in')
+    return (time.process_time() - start) / iterations
+
+
+def main(argv):
+    iterations = int(argv[1]) if len(argv) > 1 else 20
+    print(f"{'frame':>11}  {'full decode':>12}  {'draft decode':>12}  {'saving':>7}  {'all variants':>12}")
+    for size in FRAME_SIZES:
+        frame = make_frame(size)
+        before = cpu_per_photo(label_full_decode, frame, iterations)
+        after = cpu_per_photo(photo_pipeline.label_punch_photo, frame, iterations)
+        stage = cpu_per_photo(render_variants, frame, iterations)
+        print(f"{size[0]:>5}x{size[1]:<5}  {before * 1000:>9.1f} ms  {after * 1000:>9.1f} ms  {1 - after / before:>6.0%}"
+              f"  {stage * 1000:>9.1f} ms")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
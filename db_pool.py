@@ -0,0 +1,273 @@
+"""
+Process-wide PostgreSQL connection pool used by models.get_db().
+
+Inside a Flask app context every get_db() call shares one borrowed connection,
+which is handed back to the pool in teardown_appcontext. Outside an app context
+(scripts, background workers) each get_db() borrows its own connection and
+close() returns it to the pool instead of disconnecting.
+
+In request scope each get_db() ... close() is a unit of work and the request
+holds one transaction at a time. Units opened inside another (a model method
+calling another) are counted on g: their commit() is deferred, and the work
+is committed when the outermost unit closes, or at teardown if a unit never
+closed. A transaction left aborted by a unit that raised is rolled back the
+next time the request borrows the connection.
+"""
+import os
+import threading
+import time
+import logging
+
+import psycopg2
+from psycopg2 import extensions, pool
+
+logger = logging.getLogger(__name__)
+
+POOL_MIN_SIZE = int(os.environ.get('DB_POOL_MIN_SIZE', '1'))
+POOL_MAX_SIZE = int(os.environ.get('DB_POOL_MAX_SIZE', '10'))
+# Seconds to wait for a free connection before giving up
+POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', '30'))
+# Connections idle longer than this are pinged with SELECT 1 before being reused
+HEALTH_CHECK_INTERVAL = float(os.environ.get('DB_POOL_HEALTH_CHECK_SECONDS', '30'))
+
+
+class PoolTimeout(RuntimeError):
+    pass
+
+
+class ConnectionPool:
+    def __init__(self, dsn, min_size=POOL_MIN_SIZE, max_size=POOL_MAX_SIZE,
+                 timeout=POOL_TIMEOUT, health_check_interval=HEALTH_CHECK_INTERVAL):
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+        self._pool = pool.ThreadedConnectionPool(min_size, max_size, dsn)
+        # ThreadedConnectionPool raises as soon as it is exhausted; the semaphore
+        # makes callers queue for a free slot instead.
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._last_used = {}
+
+    def getconn(self):
+        if not self._slots.acquire(timeout=self.timeout):
+            raise PoolTimeout(f"No database connection available after {self.timeout:.0f}s")
+        try:
+            return self._checked(self._pool.getconn())
+        except Exception:
+            self._slots.release()
+            raise
+
+    def putconn(self, conn):
+        broken = conn.closed != 0
+        if not broken:
+            try:
+                reset_connection(conn)
+            except psycopg2.Error:
+                broken = True
+        self._last_used[id(conn)] = time.monotonic()
+        try:
+            self._pool.putconn(conn, close=broken)
+        finally:
+            self._slots.release()
+
+    def closeall(self):
+        self._pool.closeall()
+
+    def _checked(self, conn):
+        if conn.closed:
+            return self._replace(conn)
+        idle = time.monotonic() - self._last_used.get(id(conn), 0)
+        if idle < self.health_check_interval:
+            return conn
+        try:
+            cursor = conn.cursor()
+            cursor.execute('SELECT 1')
+            cursor.close()
+            conn.rollback()
+        except psycopg2.Error as e:
+            logger.warning(f"Discarding unhealthy pooled connection: {type(e).__name__}")
+            return self._replace(conn)
+        return conn
+
+    def _replace(self, conn):
+        self._last_used.pop(id(conn), None)
+        self._pool.putconn(conn, close=True)
+        return self._pool.getconn()
+
+
+def reset_connection(conn):
+    """Discard any uncommitted work so the next borrower starts clean."""
+    if conn.closed:
+        return
+    if conn.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+        conn.rollback()
+    if conn.autocommit:
+        conn.autocommit = False
+
+
+class PooledConnection:
+    """psycopg2 connection proxy whose close() releases instead of disconnecting."""
+
+    def __init__(self, conn, release):
+        object.__setattr__(self, '_conn', conn)
+        object.__setattr__(self, '_release', release)
+
+    def close(self):
+        release = self._release
+        if release is not None:
+            object.__setattr__(self, '_release', None)
+            release(self._conn)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._conn, name, value)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self._conn.commit()
+        else:
+            self._conn.rollback()
+        self.close()
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+# Pools inherited across fork() are parked here rather than closed: closing
+# them would send a terminate message on the parent's sockets.
+_orphaned_pools = []
+
+
+def get_pool(dsn):
+    global _pool, _pool_pid
+    pid = os.getpid()
+    if _pool is not None and _pool_pid == pid:
+        return _pool
+    with _pool_lock:
+        if _pool is not None and _pool_pid != pid:
+            _orphaned_pools.append(_pool)
+            _pool = None
+        if _pool is None:
+            _pool = ConnectionPool(dsn)
+            _pool_pid = pid
+        return _pool
+
+
+def _flask_g():
+    try:
+        from flask import g, has_app_context
+    except ImportError:
+        return None
+    return g if has_app_context() else None
+
+
+class RequestUnit(PooledConnection):
+    """
+    One get_db() ... close() unit on the request's shared connection. The
+    request's transaction belongs to the outermost unit: a nested unit's
+    commit() is deferred until the outermost one closes (or teardown), and its
+    rollback() undoes only its own work.
+    """
+
+    def __init__(self, conn, savepoint):
+        super().__init__(conn, None)
+        object.__setattr__(self, '_savepoint', savepoint)
+        object.__setattr__(self, '_open', True)
+
+    def commit(self):
+        g = _flask_g()
+        if g.get('_db_conn_depth', 0) > 1:
+            g._db_commit_pending = True
+        else:
+            self._conn.commit()
+            g._db_commit_pending = False
+
+    def rollback(self):
+        g = _flask_g()
+        if g.get('_db_conn_depth', 0) > 1 and self._savepoint is not None:
+            _execute(self._conn, f'ROLLBACK TO SAVEPOINT {self._savepoint}')
+        else:
+            self._conn.rollback()
+            g._db_commit_pending = False
+
+    def close(self):
+        if not self._open:
+            return
+        object.__setattr__(self, '_open', False)
+        g = _flask_g()
+        g._db_conn_depth = max(g.get('_db_conn_depth', 1) - 1, 0)
+        if g._db_conn_depth == 0:
+            _end_transaction(self._conn, g)
+
+
+def _execute(conn, sql):
+    cursor = conn.cursor()
+    try:
+        cursor.execute(sql)
+    finally:
+        cursor.close()
+
+
+def _end_transaction(conn, g):
+    """Commit work a nested unit committed, discard the rest."""
+    if g.pop('_db_commit_pending', False) and \
+            conn.get_transaction_status() == extensions.TRANSACTION_STATUS_INTRANS:
+        conn.commit()
+    else:
+        reset_connection(conn)
+
+
+def connect(dsn):
+    """Borrow a connection: request-scoped inside Flask, per-call elsewhere."""
+    shared = get_pool(dsn)
+    g = _flask_g()
+    if g is None:
+        return PooledConnection(shared.getconn(), shared.putconn)
+
+    conn = g.get('_db_conn')
+    if conn is not None and conn.closed:
+        shared.putconn(conn)
+        conn = None
+    if conn is None:
+        conn = shared.getconn()
+        g._db_conn = conn
+        g._db_conn_depth = 0
+    elif conn.get_transaction_status() == extensions.TRANSACTION_STATUS_INERROR:
+        # A unit failed and never closed; its transaction is dead anyway
+        logger.warning("Rolling back a failed unit of work that was not closed")
+        reset_connection(conn)
+        g._db_conn_depth = 0
+        g._db_commit_pending = False
+    savepoint = None
+    if g._db_conn_depth > 0 and not conn.autocommit and \
+            conn.get_transaction_status() == extensions.TRANSACTION_STATUS_INTRANS:
+        savepoint = f'unit_{g._db_conn_depth}'
+        _execute(conn, f'SAVEPOINT {savepoint}')
+    g._db_conn_depth += 1
+    return RequestUnit(conn, savepoint)
+
+
+def release_request_connection(exc=None):
+    """Teardown: commit what units left committed unless the request failed, then return the connection."""
+    g = _flask_g()
+    if g is None:
+        return
+    conn = g.pop('_db_conn', None)
+    g.pop('_db_conn_depth', None)
+    commit_pending = g.pop('_db_commit_pending', False)
+    if conn is None or _pool is None or _pool_pid != os.getpid():
+        return
+    if commit_pending and exc is None and not conn.closed and \
+            conn.get_transaction_status() == extensions.TRANSACTION_STATUS_INTRANS:
+        try:
+            conn.commit()
+        except psycopg2.Error:
+            logger.exception("Could not commit the request's pending work")
+    _pool.putconn(conn)
+
+
+def init_app(app):
+    app.teardown_appcontext(release_request_connection)
@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+"""
+Employee ID photo store.
+
+ID photos used to be stored as base64 data URLs in employees.id_photo, so
+every employee query carried them. They are now stored as JPEG objects
+(Supabase Storage when configured, plus a local copy that doubles as a read
+cache) under the SHA-256 of the full-size image, with a small thumbnail next
+to it. employees.id_photo holds only the reference `idphoto:<sha256>`, and
+because objects are content-addressed, /admin/id-photos/<key>/<variant>.jpg
+can be cached by browsers indefinitely.
+
+The local copy alone is not durable (Railway's disk is wiped on every
+deploy), so without Supabase new photos stay inline as data URLs and the
+migration refuses to run.
+
+Usage:
+    DATABASE_URL=<your-postgres-url> python3 id_photos.py migrate   # move base64 photos out of the table
+"""
+import os
+import re
+import base64
+import sys
+import hashlib
+import logging
+import tempfile
+from io import BytesIO
+
+from models import Employee
+from photo_pipeline import open_scaled
+
+logger = logging.getLogger(__name__)
+
+ID_PHOTO_DIR = os.environ.get('ID_PHOTO_DIR',
+                              os.path.join(os.path.dirname(os.path.abspath(__file__)), 'id_photos'))
+ID_PHOTO_BUCKET = 'employee-id-photos'
+REF_PREFIX = 'idphoto:'
+KEY_RE = re.compile(r'^[0-9a-f]{64}$')
+
+# Longest side in pixels and JPEG quality of each stored variant
+VARIANTS = {
+    'full': ((400, 400), 70),
+    'thumb': ((96, 96), 75),
+}
+
+MIGRATE_BATCH_SIZE = 50
+
+_storage_client = None
+
+
+def configure(storage_client=None):
+    global _storage_client
+    _storage_client = storage_client
+
+
+def is_durable():
+    """True when photos are kept in an object store that outlives the local disk."""
+    return _storage_client is not None
+
+
+def is_ref(value):
+    return bool(value) and str(value).startswith(REF_PREFIX)
+
+
+def key_of(value):
+    return str(value)[len(REF_PREFIX):]
+
+
+def object_name(key, variant):
+    return f'{key}.jpg' if variant == 'full' else f'{key}_{variant}.jpg'
+
+
+def _local_path(key, variant):
+    return os.path.join(ID_PHOTO_DIR, key[:2], object_name(key, variant))
+
+
+def _write_local(key, variant, data):
+    path = _local_path(key, variant)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, partial = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.part')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.replace(partial, path)
+
+
+def _encode(img, variant):
+    size, quality = VARIANTS[variant]
+    img = img.copy()
+    img.thumbnail(size)
+    output = BytesIO()
+    img.save(output, format='JPEG', quality=quality)
+    return output.getvalue()
+
+
+def _encode_variants(image_bytes):
+    img = open_scaled(image_bytes, VARIANTS['full'][0])
+    return {variant: _encode(img, variant) for variant in VARIANTS}
+
+
+def save(image_bytes):
+    """Store an uploaded photo and its variants; returns the `idphoto:` reference."""
+    return _store(_encode_variants(image_bytes))
+
+
+def _store(encoded):
+    key = hashlib.sha256(encoded['full']).hexdigest()
+    for variant, data in encoded.items():
+        _write_local(key, variant, data)
+        if _storage_client:
+            _storage_client.storage.from_(ID_PHOTO_BUCKET).upload(
+                path=object_name(key, variant),
+                file=data,
+                file_options={"content-type": "image/jpeg", "upsert": "true"}
+            )
+    return f'{REF_PREFIX}{key}'
+
+
+def save_data_url(value):
+    """
+    Store a `data:image/...` ID photo; returns its `idphoto:` reference, or
+    the data URL itself when there is no durable store or the upload fails,
+    so the photo is never lost. Raises ValueError if value is not an image.
+    """
+    image_bytes = decode_data_url(value)
+    if not image_bytes:
+        raise ValueError("Not an image data URL")
+    encoded = _encode_variants(image_bytes)
+    if not is_durable():
+        return value
+    try:
+        return _store(encoded)
+    except Exception:
+        logger.warning("Could not upload an ID photo; keeping it inline", exc_info=True)
+        return value
+
+
+def load(key, variant):
+    """JPEG bytes of a stored photo variant, or None."""
+    if not KEY_RE.match(key) or variant not in VARIANTS:
+        return None
+    path = _local_path(key, variant)
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            return f.read()
+    if not _storage_client:
+        return None
+    try:
+        data = _storage_client.storage.from_(ID_PHOTO_BUCKET).download(object_name(key, variant))
+    except Exception:
+        logger.warning(f"Could not download ID photo {key} ({variant})", exc_info=True)
+        return None
+    _write_local(key, variant, data)
+    return data
+
+
+def decode_data_url(value):
+    """Image bytes of a `data:image/...;base64,` URL, or None."""
+    match = re.match(r'data:image/(jpeg|png|webp);base64,(.+)', value or '', re.S)
+    if not match:
+        return None
+    return base64.b64decode(match.group(2))
+
+
+def migrate_inline_photos(batch_size=MIGRATE_BATCH_SIZE, progress=None):
+    """
+    Move base64 ID photos from employees.id_photo into the store, a batch at
+    a time, so it can be stopped and re-run. Returns (moved, skipped).
+    """
+    if not is_durable():
+        raise RuntimeError("No durable ID photo store is configured (set SUPABASE_URL and SUPABASE_KEY)")
+    moved = skipped = 0
+    total = Employee.count_inline_id_photos()
+    after_id = 0
+    while True:
+        batch = Employee.get_inline_id_photos(after_id, batch_size)
+        if not batch:
+            break
+        for row in batch:
+            after_id = row['id']
+            try:
+                ref = save(decode_data_url(row['id_photo']))
+            except Exception:
+                logger.exception(f"Could not move the ID photo of employee {row['id']}")
+                skipped += 1
+                continue
+            if Employee.replace_id_photo(row['id'], row['id_photo'], ref):
+                moved += 1
+            else:
+                skipped += 1
+        if progress:
+            progress(moved + skipped, total)
+    return moved, skipped
+
+
+def main(argv):
+    command = argv[1] if len(argv) > 1 else None
+    if not os.environ.get('DATABASE_URL') or command != 'migrate':
+        print("Usage: DATABASE_URL=<your-postgres-url> python3 id_photos.py migrate")
+        return 1
+    supabase_url = os.environ.get('SUPABASE_URL', '')
+    supabase_key = os.environ.get('SUPABASE_KEY', '')
+    if supabase_url and supabase_key:
+        from supabase import create_client
+        configure(create_client(supabase_url, supabase_key))
+    if not is_durable():
+        print("❌ Set SUPABASE_URL and SUPABASE_KEY first: the local disk alone would lose the photos on the next deploy")
+        return 1
+    moved, skipped = migrate_inline_photos(progress=lambda done, total: print(f"  {done}/{total}"))
+    print(f"✅ Moved {moved} ID photos" + (f", skipped {skipped} (see log)" if skipped else ''))
+    return 0
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main(sys.argv))
@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+"""
+Background job worker.
+
+Web requests queue slow work (payroll generation, bulk payslip exports) with
+BackgroundJob.enqueue() and return straight away; a worker claims queued jobs
+with FOR UPDATE SKIP LOCKED, so any number of workers can share the queue.
+Progress is written to the job row, which the payroll pages poll via
+/admin/jobs/<id>.
+
+Each web process also runs one embedded worker thread unless
+EMBEDDED_JOB_WORKER=0, so jobs run without a separate service. Larger
+deployments can switch that off and run dedicated workers instead.
+
+Usage:
+    DATABASE_URL=<your-postgres-url> python3 jobs.py          # run until interrupted
+    DATABASE_URL=<your-postgres-url> python3 jobs.py --once   # drain the queue and exit
+"""
+import os
+import sys
+import time
+import logging
+import tempfile
+import threading
+
+from models import BackgroundJob, PayrollPeriod, PayrollRecord
+from pdf_payslip import (iter_payslip_zip, iter_rendered_payslips, generate_period_payslips_pdf,
+                         PAYSLIP_TEMPLATE_VERSION)
+import payslip_cache
+
+logger = logging.getLogger(__name__)
+
+POLL_INTERVAL = float(os.environ.get('JOB_POLL_SECONDS', '5'))
+EMBEDDED_WORKER = os.environ.get('EMBEDDED_JOB_WORKER', '1').lower() in ('1', 'true', 'yes')
+# Progress writes are throttled so fast jobs don't turn into UPDATE storms
+PROGRESS_MIN_INTERVAL = 0.5
+# Running jobs touch their heartbeat this often, whether or not they report
+# progress; must stay well below JOB_STALE_SECONDS
+HEARTBEAT_INTERVAL = float(os.environ.get('JOB_HEARTBEAT_SECONDS', '60'))
+
+# Finished payslip ZIPs and registers; must be shared storage if workers run on other hosts
+EXPORT_DIR = os.environ.get('EXPORT_DIR', os.path.join(tempfile.gettempdir(), 'attendance-exports'))
+EXPORT_MAX_AGE_SECONDS = 24 * 3600
+
+PAYROLL_GENERATE = 'payroll_generate'
+PAYSLIP_EXPORT = 'payslip_export'
+PAYSLIP_REGISTER = 'payslip_register'
+PAYSLIP_PRERENDER = 'payslip_prerender'
+PAYROLL_PREVIEW = 'payroll_preview'
+
+HANDLERS = {}
+
+
+def handler(job_type):
+    def register(func):
+        HANDLERS[job_type] = func
+        return func
+    return register
+
+
+def payroll_job_key(period_id):
+    return f'period:{period_id}'
+
+
+def enqueue_payroll_generation(period_id, created_by=None, full=False):
+    """Queue (or join an already queued) generation for a period; returns (job_id, created)."""
+    job_id, created = BackgroundJob.enqueue(PAYROLL_GENERATE, {'period_id': period_id, 'full': full},
+                                            payroll_job_key(period_id), created_by)
+    wake()
+    return job_id, created
+
+
+@handler(PAYROLL_GENERATE)
+def run_payroll_generation(job, progress):
+    period_id = job['payload']['period_id']
+    period = PayrollPeriod.get_by_id(period_id)
+    if not period:
+        raise ValueError(f"Payroll period {period_id} no longer exists")
+    if period['is_locked']:
+        raise ValueError("Payroll period is locked")
+    full = job['payload'].get('full', False)
+    PayrollRecord.generate_for_period(period_id, progress=progress, full=full)
+    return {'period_id': period_id, 'full': full}
+
+
+def enqueue_payroll_preview(period_id, created_by=None):
+    """Queue (or join) a dry run of a period's generation; returns (job_id, created)."""
+    job_id, created = BackgroundJob.enqueue(PAYROLL_PREVIEW, {'period_id': period_id},
+                                            payroll_job_key(period_id), created_by)
+    wake()
+    return job_id, created
+
+
+@handler(PAYROLL_PREVIEW)
+def run_payroll_preview(job, progress):
+    """Recompute every record of a period without writing; the result holds the diff."""
+    period_id = job['payload']['period_id']
+    diff = PayrollRecord.generate_for_period(period_id, progress=progress, dry_run=True)
+    if diff is None:
+        raise ValueError(f"Payroll period {period_id} no longer exists")
+    return {'period_id': period_id, 'diff': diff}
+
+
+def enqueue_payslip_export(period_id, created_by=None):
+    job_id, created = BackgroundJob.enqueue(PAYSLIP_EXPORT, {'period_id': period_id},
+                                            payroll_job_key(period_id), created_by)
+    wake()
+    return job_id, created
+
+
+# File extension and MIME type of each export job's result
+EXPORT_FORMATS = {
+    PAYSLIP_EXPORT: ('zip', 'application/zip'),
+    PAYSLIP_REGISTER: ('pdf', 'application/pdf'),
+}
+
+
+def export_path(job_id, job_type=PAYSLIP_EXPORT):
+    return os.path.join(EXPORT_DIR, f'payslips-{job_id}.{EXPORT_FORMATS[job_type][0]}')
+
+
+@handler(PAYSLIP_EXPORT)
+def run_payslip_export(job, progress):
+    period_id = job['payload']['period_id']
+    period = PayrollPeriod.get_by_id(period_id)
+    if not period:
+        raise ValueError(f"Payroll period {period_id} no longer exists")
+    payslips = PayrollRecord.get_payslip_inputs(period_id=period_id)
+    
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    _remove_old_exports()
+    path = export_path(job['id'])
+    partial = path + '.part'
+    with open(partial, 'wb') as f:
+        for chunk in iter_payslip_zip(payslips, progress=lambda done, total: progress(done, total, 'Rendering payslips')):
+            f.write(chunk)
+    os.replace(partial, path)
+    return {'period_id': period_id, 'count': len(payslips),
+            'filename': f"Payslips_{period['name'].replace(' ', '_')}.zip"}
+
+
+def enqueue_payslip_register(period_id, created_by=None):
+    job_id, created = BackgroundJob.enqueue(PAYSLIP_REGISTER, {'period_id': period_id},
+                                            payroll_job_key(period_id), created_by)
+    wake()
+    return job_id, created
+
+
+@handler(PAYSLIP_REGISTER)
+def run_payslip_register(job, progress):
+    """Render a period's payslips into one printable PDF, one per page."""
+    period_id = job['payload']['period_id']
+    period = PayrollPeriod.get_by_id(period_id)
+    if not period:
+        raise ValueError(f"Payroll period {period_id} no longer exists")
+    payslips = PayrollRecord.get_payslip_inputs(period_id=period_id)
+    
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    _remove_old_exports()
+    path = export_path(job['id'], PAYSLIP_REGISTER)
+    partial = path + '.part'
+    with open(partial, 'wb') as f:
+        generate_period_payslips_pdf(payslips, output=f,
+                                     progress=lambda done, total: progress(done, total, 'Laying out payslips'))
+    os.replace(partial, path)
+    return {'period_id': period_id, 'count': len(payslips),
+            'filename': f"Payslips_{period['name'].replace(' ', '_')}.pdf"}
+
+
+def _remove_old_exports():
+    cutoff = time.time() - EXPORT_MAX_AGE_SECONDS
+    for name in os.listdir(EXPORT_DIR):
+        path = os.path.join(EXPORT_DIR, name)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except OSError:
+            pass
+
+
+def enqueue_payslip_prerender(period_id, created_by=None):
+    job_id, created = BackgroundJob.enqueue(PAYSLIP_PRERENDER, {'period_id': period_id},
+                                            payroll_job_key(period_id), created_by)
+    wake()
+    return job_id, created
+
+
+@handler(PAYSLIP_PRERENDER)
+def run_payslip_prerender(job, progress):
+    """Render every payslip of a locked period into the payslip cache."""
+    period_id = job['payload']['period_id']
+    period = PayrollPeriod.get_by_id(period_id)
+    if not period:
+        raise ValueError(f"Payroll period {period_id} no longer exists")
+    if not period['is_locked']:
+        raise ValueError("Payroll period is not locked")
+    payslips = PayrollRecord.get_payslip_inputs(period_id=period_id)
+    
+    hashes, pending = [], []
+    for payslip in payslips:
+        key = payslip_cache.cache_key(payslip)
+        if payslip_cache.get(key):
+            hashes.append((payslip['record_id'], key))
+        else:
+            # Rendered under its cache key so results can be matched up out of order
+            pending.append(dict(payslip, filename=key))
+    record_ids = {payslip['filename']: payslip['record_id'] for payslip in pending}
+    for done, (key, pdf_bytes) in enumerate(iter_rendered_payslips(pending), 1):
+        payslip_cache.put(key, pdf_bytes)
+        hashes.append((record_ids[key], key))
+        progress(done, len(pending), 'Rendering payslips')
+    PayrollRecord.set_payslip_hashes(hashes, PAYSLIP_TEMPLATE_VERSION)
+    return {'period_id': period_id, 'count': len(payslips), 'rendered': len(pending)}
+
+
+def run_job(job):
+    func = HANDLERS.get(job['job_type'])
+    if func is None:
+        BackgroundJob.fail(job['id'], f"Unknown job type: {job['job_type']}")
+        return False
+
+    last_write = [0.0]
+
+    def progress(done, total, message=None):
+        now = time.monotonic()
+        if done < total and now - last_write[0] < PROGRESS_MIN_INTERVAL:
+            return
+        last_write[0] = now
+        BackgroundJob.update_progress(job['id'], done, total, message)
+
+    stop_heartbeat = threading.Event()
+    threading.Thread(target=_heartbeat, args=(job['id'], stop_heartbeat),
+                     name=f"job-{job['id']}-heartbeat", daemon=True).start()
+    try:
+        result = func(job, progress)
+    except Exception as e:
+        logger.exception(f"Job {job['id']} ({job['job_type']}) failed")
+        BackgroundJob.fail(job['id'], str(e))
+        return False
+    finally:
+        stop_heartbeat.set()
+    BackgroundJob.finish(job['id'], result)
+    return True
+
+
+def _heartbeat(job_id, stop):
+    """Keep a running job from looking stale through stages that report no progress."""
+    while not stop.wait(HEARTBEAT_INTERVAL):
+        try:
+            BackgroundJob.heartbeat(job_id)
+        except Exception:
+            logger.warning(f"Could not record the heartbeat of job {job_id}", exc_info=True)
+
+
+_wake = threading.Event()
+
+
+def wake():
+    """Nudge this process's embedded worker so a fresh job starts immediately."""
+    _wake.set()
+
+
+def work(poll_interval=POLL_INTERVAL, once=False):
+    """Claim and run jobs until stopped (or, with once=True, until the queue is empty)."""
+    while True:
+        try:
+            job = BackgroundJob.claim_next()
+        except Exception:
+            logger.exception("Could not claim a background job")
+            job = None
+        if job is not None:
+            run_job(job)
+            continue
+        if once:
+            return
+        _wake.wait(poll_interval)
+        _wake.clear()
+
+
+_embedded_pid = None
+_embedded_lock = threading.Lock()
+
+
+def start_embedded_worker():
+    """Start the in-process worker thread once per process (safe to call on every request)."""
+    global _embedded_pid
+    if not EMBEDDED_WORKER or _embedded_pid == os.getpid():
+        return
+    with _embedded_lock:
+        if _embedded_pid == os.getpid():
+            return
+        _embedded_pid = os.getpid()
+        threading.Thread(target=work, name='job-worker', daemon=True).start()
+
+
+def main(argv):
+    if not os.environ.get('DATABASE_URL'):
+        print("ERROR: DATABASE_URL environment variable is not set.")
+        print("Usage: DATABASE_URL=<your-postgres-url> python3 jobs.py [--once]")
+        return 1
+    once = '--once' in argv[1:]
+    try:
+        work(once=once)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main(sys.argv))
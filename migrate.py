@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+"""
+Versioned schema migrations.
+
+Migrations live in migrations/ as NNNN_description.sql, or NNNN_description.py
+defining upgrade(cursor). Each one runs in its own transaction and its version
+is recorded in the schema_version table, so a database is only ever migrated
+forward once. Web workers just compare versions at startup (schema_status()).
+
+SQL files whose first line is `-- migrate: no-transaction` run statement by
+statement in autocommit mode, which CREATE INDEX CONCURRENTLY requires. A
+failed concurrent build leaves an INVALID index behind that IF NOT EXISTS
+would skip, so such an index is dropped before its CREATE runs again.
+
+Usage:
+    DATABASE_URL=<your-postgres-url> python3 migrate.py                # apply pending migrations
+    DATABASE_URL=<your-postgres-url> python3 migrate.py status         # show current/latest version
+    DATABASE_URL=<your-postgres-url> python3 migrate.py check-indexes  # verify managed indexes
+    DATABASE_URL=<your-postgres-url> python3 migrate.py rebuild-indexes  # rebuild invalid managed indexes
+"""
+import os
+import re
+import sys
+import importlib.util
+import logging
+
+import psycopg2
+
+from models import get_db, get_cursor
+
+logger = logging.getLogger(__name__)
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+MIGRATION_FILE_RE = re.compile(r'^(\d{4})_([a-z0-9_]+)\.(sql|py)$')
+NO_TRANSACTION_MARKER = '-- migrate: no-transaction'
+CONCURRENT_INDEX_RE = re.compile(
+    r'^CREATE\s+(?:UNIQUE\s+)?INDEX\s+CONCURRENTLY\s+IF\s+NOT\s+EXISTS\s+(\w+)', re.I)
+# Arbitrary key shared by every migration runner so only one applies at a time
+MIGRATION_LOCK_KEY = 7245100
+
+# Indexes shipped by migrations (0005_hot_path_indexes.sql and later), each
+# with the hot query it exists for. check_indexes() EXPLAINs these probes.
+MANAGED_INDEXES = [
+    ('idx_attendance_employee_date', 'attendance',
+     "SELECT * FROM attendance WHERE employee_id = 0 AND date = CURRENT_DATE ORDER BY time_in"),
+    ('idx_attendance_open', 'attendance',
+     "SELECT * FROM attendance WHERE employee_id = 0 AND time_out IS NULL ORDER BY id DESC LIMIT 1"),
+    ('idx_payroll_records_period_employee', 'payroll_records',
+     "SELECT * FROM payroll_records WHERE payroll_period_id = 0"),
+    ('idx_payroll_deduction_items_record', 'payroll_deduction_items',
+     "SELECT * FROM payroll_deduction_items WHERE payroll_record_id = 0"),
+    ('idx_activity_logs_created_at', 'activity_logs',
+     "SELECT * FROM activity_logs ORDER BY created_at DESC LIMIT 100"),
+    ('idx_attendance_time_in_key', 'attendance',
+     "SELECT id FROM attendance WHERE time_in_key = 'probe'"),
+    ('idx_attendance_time_out_key', 'attendance',
+     "SELECT id FROM attendance WHERE time_out_key = 'probe'"),
+]
+
+
+class Migration:
+    def __init__(self, version, name, path):
+        self.version = version
+        self.name = name
+        self.path = path
+
+    @property
+    def transactional(self):
+        if not self.path.endswith('.sql'):
+            return True
+        with open(self.path, 'r') as f:
+            return f.readline().strip() != NO_TRANSACTION_MARKER
+
+    def statements(self):
+        """Split a no-transaction SQL file into single statements."""
+        with open(self.path, 'r') as f:
+            sql = '\n'.join(line for line in f.read().splitlines() if not line.strip().startswith('--'))
+        return [stmt.strip() for stmt in sql.split(';') if stmt.strip()]
+
+    def apply(self, cursor):
+        if self.path.endswith('.sql'):
+            with open(self.path, 'r') as f:
+                cursor.execute(f.read())
+        else:
+            spec = importlib.util.spec_from_file_location(f'migration_{self.version:04d}', self.path)
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+            module.upgrade(cursor)
+
+
+def discover_migrations():
+    migrations = []
+    for filename in sorted(os.listdir(MIGRATIONS_DIR)):
+        match = MIGRATION_FILE_RE.match(filename)
+        if match:
+            migrations.append(Migration(int(match.group(1)), match.group(2), os.path.join(MIGRATIONS_DIR, filename)))
+    versions = [m.version for m in migrations]
+    if len(versions) != len(set(versions)):
+        raise RuntimeError("Duplicate migration version numbers in migrations/")
+    return migrations
+
+
+def latest_version():
+    migrations = discover_migrations()
+    return migrations[-1].version if migrations else 0
+
+
+def current_version(cursor):
+    cursor.execute("SELECT to_regclass('schema_version') IS NOT NULL AS present")
+    if not cursor.fetchone()['present']:
+        return 0
+    cursor.execute("SELECT COALESCE(MAX(version), 0) AS version FROM schema_version")
+    return cursor.fetchone()['version']
+
+
+def schema_status():
+    """Cheap startup check: returns (current_version, latest_version)."""
+    conn = get_db()
+    cursor = get_cursor(conn)
+    try:
+        version = current_version(cursor)
+    finally:
+        conn.close()
+    return version, latest_version()
+
+
+def apply_migrations(target=None):
+    """Apply pending migrations in order. Returns the list of versions applied."""
+    conn = get_db()
+    cursor = get_cursor(conn)
+    applied = []
+    try:
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                name TEXT NOT NULL,
+                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        conn.commit()
+
+        # Session-level lock: a second runner (another deploy, another worker
+        # with AUTO_MIGRATE) waits here and then finds nothing left to do.
+        cursor.execute("SELECT pg_advisory_lock(%s)", (MIGRATION_LOCK_KEY,))
+        try:
+            version = current_version(cursor)
+            conn.commit()
+            for migration in discover_migrations():
+                if migration.version <= version or (target is not None and migration.version > target):
+                    continue
+                logger.info(f"Applying migration {migration.version:04d}_{migration.name}")
+                del conn.notices[:]
+                if migration.transactional:
+                    try:
+                        migration.apply(cursor)
+                        cursor.execute("INSERT INTO schema_version (version, name) VALUES (%s, %s)",
+                                       (migration.version, migration.name))
+                        conn.commit()
+                        for notice in conn.notices:
+                            logger.info(notice.strip())
+                        del conn.notices[:]
+                    except Exception:
+                        conn.rollback()
+                        raise
+                else:
+                    # Statements must be idempotent (IF NOT EXISTS): a failure
+                    # part-way leaves earlier ones applied and the file is
+                    # simply re-run next time.
+                    conn.autocommit = True
+                    try:
+                        for statement in migration.statements():
+                            _drop_if_invalid(cursor, statement)
+                            cursor.execute(statement)
+                        cursor.execute("INSERT INTO schema_version (version, name) VALUES (%s, %s)",
+                                       (migration.version, migration.name))
+                    finally:
+                        conn.autocommit = False
+                applied.append(migration.version)
+        finally:
+            cursor.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK_KEY,))
+            conn.commit()
+    finally:
+        conn.close()
+    return applied
+
+
+def _invalid_index(cursor, name):
+    cursor.execute('''
+        SELECT NOT i.indisvalid AS invalid
+        FROM pg_index i
+        JOIN pg_class c ON c.oid = i.indexrelid
+        WHERE c.relname = %s AND pg_table_is_visible(c.oid)
+    ''', (name,))
+    row = cursor.fetchone()
+    return bool(row and row['invalid'])
+
+
+def _drop_if_invalid(cursor, statement):
+    """Before a CREATE INDEX CONCURRENTLY IF NOT EXISTS, drop a leftover invalid build of it."""
+    match = CONCURRENT_INDEX_RE.match(statement)
+    if match and _invalid_index(cursor, match.group(1)):
+        logger.warning(f"Dropping invalid index {match.group(1)} left by a failed build")
+        cursor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {match.group(1)}")
+
+
+def rebuild_invalid_indexes():
+    """
+    Drop and re-create every invalid managed index from the migration that
+    defines it, concurrently. Returns the names rebuilt.
+    """
+    statements = {}
+    for migration in discover_migrations():
+        if not migration.transactional:
+            for statement in migration.statements():
+                match = CONCURRENT_INDEX_RE.match(statement)
+                if match:
+                    statements[match.group(1)] = statement
+    conn = get_db()
+    cursor = get_cursor(conn)
+    rebuilt = []
+    conn.autocommit = True
+    try:
+        for name, _, _ in MANAGED_INDEXES:
+            if name in statements and _invalid_index(cursor, name):
+                _drop_if_invalid(cursor, statements[name])
+                cursor.execute(statements[name])
+                rebuilt.append(name)
+    finally:
+        conn.autocommit = False
+        conn.close()
+    return rebuilt
+
+
+def check_indexes():
+    """
+    Verify every managed index exists, is valid, and can serve its probe query.
+
+    Returns a list of dicts (name, exists, valid, usable, chosen). `usable`
+    EXPLAINs the probe with sequential scans disabled, so it holds even on
+    small tables; `chosen` is whether the planner picks the index as-is.
+    """
+    conn = get_db()
+    cursor = get_cursor(conn)
+    results = []
+    try:
+        for name, table, probe in MANAGED_INDEXES:
+            cursor.execute('''
+                SELECT i.indisvalid AS valid
+                FROM pg_index i
+                JOIN pg_class c ON c.oid = i.indexrelid
+                WHERE c.relname = %s AND i.indrelid = to_regclass(%s)
+            ''', (name, table))
+            row = cursor.fetchone()
+            result = {'name': name, 'exists': row is not None, 'valid': bool(row and row['valid']),
+                      'usable': False, 'chosen': False}
+            if result['valid']:
+                result['chosen'] = name in _explain(cursor, probe)
+                cursor.execute("SET LOCAL enable_seqscan = off")
+                result['usable'] = name in _explain(cursor, probe)
+            conn.rollback()
+            results.append(result)
+    finally:
+        conn.close()
+    return results
+
+
+def _explain(cursor, query):
+    cursor.execute(f"EXPLAIN {query}")
+    return '\n'.join(row['QUERY PLAN'] for row in cursor.fetchall())
+
+
+def main(argv):
+    command = argv[1] if len(argv) > 1 else 'up'
+    if not os.environ.get('DATABASE_URL'):
+        print("ERROR: DATABASE_URL environment variable is not set.")
+        print("Usage: DATABASE_URL=<your-postgres-url> python3 migrate.py [up|status|check-indexes|rebuild-indexes]")
+        return 1
+
+    try:
+        if command == 'status':
+            current, latest = schema_status()
+            print(f"Schema version: {current} (latest available: {latest})")
+            return 0 if current >= latest else 2
+        if command == 'up':
+            applied = apply_migrations()
+            if applied:
+                print(f"✅ Applied migrations: {', '.join(f'{v:04d}' for v in applied)}")
+            else:
+                print("✅ Schema is up to date")
+            return 0
+        if command == 'check-indexes':
+            ok = True
+            for result in check_indexes():
+                healthy = result['valid'] and result['usable']
+                ok = ok and healthy
+                status = '✅' if healthy else '❌'
+                if not result['exists']:
+                    detail = 'missing'
+                elif not result['valid']:
+                    detail = 'INVALID (run `python3 migrate.py rebuild-indexes`)'
+                else:
+                    detail = 'used by planner' if result['chosen'] else 'usable (planner prefers seq scan at current table size)'
+                print(f"{status} {result['name']}: {detail}")
+            return 0 if ok else 2
+        if command == 'rebuild-indexes':
+            rebuilt = rebuild_invalid_indexes()
+            if rebuilt:
+                print(f"✅ Rebuilt indexes: {', '.join(rebuilt)}")
+            else:
+                print("✅ No invalid indexes")
+            return 0
+    except (psycopg2.Error, RuntimeError) as e:
+        print(f"\n❌ Migration failed: {str(e)}")
+        return 1
+
+    print(f"Unknown command: {command}")
+    return 1
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main(sys.argv))
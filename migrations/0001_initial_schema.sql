@@ -0,0 +1,191 @@
+-- Core schema, formerly created by init_db() on every worker boot.
+-- Every statement is idempotent so this also applies cleanly to databases
+-- that were bootstrapped by init_db().
+
+CREATE TABLE IF NOT EXISTS branches (
+    id SERIAL PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    address TEXT,
+    gps_latitude REAL,
+    gps_longitude REAL,
+    gps_radius_meters INTEGER DEFAULT 100,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS employees (
+    id SERIAL PRIMARY KEY,
+    employee_id TEXT NOT NULL UNIQUE,
+    first_name TEXT NOT NULL,
+    last_name TEXT NOT NULL,
+    branch_id INTEGER,
+    daily_rate REAL NOT NULL DEFAULT 0,
+    start_time TEXT DEFAULT '08:00',
+    end_time TEXT DEFAULT '17:00',
+    pin_hash TEXT NOT NULL,
+    photo_path TEXT,
+    is_active INTEGER DEFAULT 1,
+    is_resigned INTEGER DEFAULT 0,
+    resigned_date DATE,
+    status TEXT DEFAULT 'active',
+    status_reason TEXT,
+    status_date DATE,
+    id_photo TEXT,
+    cv_file TEXT,
+    date_of_birth DATE,
+    gender TEXT,
+    civil_status TEXT,
+    address TEXT,
+    phone TEXT,
+    email TEXT,
+    sss_number TEXT,
+    philhealth_number TEXT,
+    pagibig_number TEXT,
+    tin_number TEXT,
+    emergency_contact_name TEXT,
+    emergency_contact_phone TEXT,
+    emergency_contact_relationship TEXT,
+    reference_name TEXT,
+    reference_phone TEXT,
+    reference_company TEXT,
+    date_hired DATE,
+    position TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (branch_id) REFERENCES branches(id)
+);
+
+CREATE TABLE IF NOT EXISTS attendance (
+    id SERIAL PRIMARY KEY,
+    employee_id INTEGER NOT NULL,
+    date DATE NOT NULL,
+    time_in TIMESTAMP,
+    time_out TIMESTAMP,
+    time_in_photo TEXT,
+    time_out_photo TEXT,
+    time_in_purpose TEXT DEFAULT 'clock_in',
+    time_out_purpose TEXT,
+    is_holiday INTEGER DEFAULT 0,
+    holiday_type TEXT,
+    is_overtime_approved INTEGER DEFAULT 0,
+    overtime_hours REAL DEFAULT 0,
+    tardiness_minutes INTEGER DEFAULT 0,
+    undertime_minutes INTEGER DEFAULT 0,
+    early_start_approved INTEGER DEFAULT 0,
+    early_start_minutes INTEGER DEFAULT 0,
+    official_overtime_approved INTEGER DEFAULT 0,
+    official_overtime_minutes INTEGER DEFAULT 0,
+    requires_admin_review INTEGER DEFAULT 0,
+    admin_review_reason TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (employee_id) REFERENCES employees(id)
+);
+
+CREATE TABLE IF NOT EXISTS payroll_periods (
+    id SERIAL PRIMARY KEY,
+    name TEXT NOT NULL,
+    start_date DATE NOT NULL,
+    end_date DATE NOT NULL,
+    is_locked INTEGER DEFAULT 0,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS statutory_deductions (
+    id SERIAL PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    is_percentage INTEGER DEFAULT 0,
+    employee_rate REAL DEFAULT 0,
+    employer_rate REAL DEFAULT 0,
+    is_active INTEGER DEFAULT 1,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS payroll_records (
+    id SERIAL PRIMARY KEY,
+    payroll_period_id INTEGER NOT NULL,
+    employee_id INTEGER NOT NULL,
+    locked_daily_rate REAL NOT NULL,
+    days_worked REAL DEFAULT 0,
+    regular_pay REAL DEFAULT 0,
+    overtime_pay REAL DEFAULT 0,
+    holiday_pay REAL DEFAULT 0,
+    tardiness_deduction REAL DEFAULT 0,
+    undertime_deduction REAL DEFAULT 0,
+    gross_pay REAL DEFAULT 0,
+    total_deductions REAL DEFAULT 0,
+    net_pay REAL DEFAULT 0,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (payroll_period_id) REFERENCES payroll_periods(id),
+    FOREIGN KEY (employee_id) REFERENCES employees(id)
+);
+
+CREATE TABLE IF NOT EXISTS payroll_deduction_items (
+    id SERIAL PRIMARY KEY,
+    payroll_record_id INTEGER NOT NULL,
+    deduction_id INTEGER NOT NULL,
+    deduction_name TEXT NOT NULL,
+    employee_amount REAL DEFAULT 0,
+    employer_amount REAL DEFAULT 0,
+    FOREIGN KEY (payroll_record_id) REFERENCES payroll_records(id),
+    FOREIGN KEY (deduction_id) REFERENCES statutory_deductions(id)
+);
+
+CREATE TABLE IF NOT EXISTS holidays (
+    id SERIAL PRIMARY KEY,
+    date DATE NOT NULL UNIQUE,
+    name TEXT NOT NULL,
+    type TEXT NOT NULL CHECK(type IN ('regular', 'special'))
+);
+
+CREATE TABLE IF NOT EXISTS settings (
+    id SERIAL PRIMARY KEY,
+    key TEXT NOT NULL UNIQUE,
+    value TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS admins (
+    id SERIAL PRIMARY KEY,
+    username TEXT NOT NULL UNIQUE,
+    password_hash TEXT NOT NULL,
+    full_name TEXT NOT NULL,
+    role TEXT DEFAULT 'sub_admin',
+    is_active INTEGER DEFAULT 1,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS activity_logs (
+    id SERIAL PRIMARY KEY,
+    admin_id INTEGER,
+    admin_name TEXT,
+    action TEXT NOT NULL,
+    target_type TEXT,
+    target_id INTEGER,
+    details TEXT,
+    ip_address TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (admin_id) REFERENCES admins(id)
+);
+
+CREATE TABLE IF NOT EXISTS admin_auth_codes (
+    id SERIAL PRIMARY KEY,
+    code TEXT NOT NULL UNIQUE,
+    code_type TEXT NOT NULL CHECK(code_type IN ('early_start', 'overtime', 'remote_field')),
+    allowable_hours REAL DEFAULT 0,
+    description TEXT,
+    is_active INTEGER DEFAULT 1,
+    uses_remaining INTEGER DEFAULT -1,
+    valid_until DATE,
+    created_by INTEGER,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (created_by) REFERENCES admins(id)
+);
+
+-- Columns added after the first production deployments
+ALTER TABLE attendance ADD COLUMN IF NOT EXISTS requires_admin_review INTEGER DEFAULT 0;
+ALTER TABLE attendance ADD COLUMN IF NOT EXISTS admin_review_reason TEXT;
+ALTER TABLE attendance ADD COLUMN IF NOT EXISTS is_remote_field INTEGER DEFAULT 0;
+ALTER TABLE attendance ADD COLUMN IF NOT EXISTS remote_field_hours REAL DEFAULT 0;
+
+ALTER TABLE admin_auth_codes ADD COLUMN IF NOT EXISTS allowable_hours REAL DEFAULT 0;
+ALTER TABLE admin_auth_codes DROP CONSTRAINT IF EXISTS admin_auth_codes_code_type_check;
+ALTER TABLE admin_auth_codes ADD CONSTRAINT admin_auth_codes_code_type_check
+    CHECK (code_type IN ('early_start', 'overtime', 'remote_field'));
@@ -43,16 +43,25 @@ CREATE TABLE IF NOT EXISTS employee_schedules (
     saturday_end_time TIME DEFAULT '17:00',
     
     -- Constraints
-    CONSTRAINT valid_date_range CHECK (effective_to IS NULL OR effective_from <= effective_to),
-    CONSTRAINT one_current_schedule_per_employee UNIQUE (employee_id, effective_to) DEFERRABLE INITIALLY DEFERRED
+    CONSTRAINT valid_date_range CHECK (effective_to IS NULL OR effective_from <= effective_to)
 );
 
+-- Added separately so databases where init_db() already created the table pick it up too
+DO $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'one_current_schedule_per_employee') THEN
+        ALTER TABLE employee_schedules
+            ADD CONSTRAINT one_current_schedule_per_employee UNIQUE (employee_id, effective_to) DEFERRABLE INITIALLY DEFERRED;
+    END IF;
+END $$;
+
 -- Create indexes for performance
-CREATE INDEX idx_employee_schedules_employee_id ON employee_schedules(employee_id);
-CREATE INDEX idx_employee_schedules_dates ON employee_schedules(effective_from, effective_to);
-CREATE INDEX idx_employee_schedules_current ON employee_schedules(employee_id, effective_to) WHERE effective_to IS NULL;
+CREATE INDEX IF NOT EXISTS idx_employee_schedules_employee_id ON employee_schedules(employee_id);
+CREATE INDEX IF NOT EXISTS idx_employee_schedules_dates ON employee_schedules(effective_from, effective_to);
+CREATE INDEX IF NOT EXISTS idx_employee_schedules_current ON employee_schedules(employee_id, effective_to) WHERE effective_to IS NULL;
 
--- Migrate existing employee schedules from employees table
+-- Migrate existing employee schedules from employees table (only for employees
+-- that do not have a schedule yet)
 INSERT INTO employee_schedules (
     employee_id, 
     effective_from, 
@@ -65,19 +74,20 @@ INSERT INTO employee_schedules (
     saturday_is_working, saturday_start_time, saturday_end_time,
     sunday_is_working, sunday_start_time, sunday_end_time
 )
-SELECT 
+SELECT
     id as employee_id,
     CURRENT_DATE as effective_from,
     NULL as effective_to,
-    true, start_time, end_time,  -- Monday
-    true, start_time, end_time,  -- Tuesday
-    true, start_time, end_time,  -- Wednesday
-    true, start_time, end_time,  -- Thursday
-    true, start_time, end_time,  -- Friday
-    true, start_time, end_time,  -- Saturday
-    false, NULL, NULL            -- Sunday (rest day)
-FROM employees
-WHERE start_time IS NOT NULL AND end_time IS NOT NULL;
+    true, start_time::time, end_time::time,  -- Monday
+    true, start_time::time, end_time::time,  -- Tuesday
+    true, start_time::time, end_time::time,  -- Wednesday
+    true, start_time::time, end_time::time,  -- Thursday
+    true, start_time::time, end_time::time,  -- Friday
+    true, start_time::time, end_time::time,  -- Saturday
+    false, NULL, NULL                        -- Sunday (rest day)
+FROM employees e
+WHERE start_time IS NOT NULL AND end_time IS NOT NULL
+AND NOT EXISTS (SELECT 1 FROM employee_schedules s WHERE s.employee_id = e.id);
 
 -- Add comment to the table
 COMMENT ON TABLE employee_schedules IS 'Stores employee work schedules with day-by-day configuration and history tracking';
@@ -0,0 +1,26 @@
+"""Default admin account, settings, branch and statutory deductions."""
+from werkzeug.security import generate_password_hash
+
+
+def upgrade(cursor):
+    cursor.execute("SELECT COUNT(*) as cnt FROM admins")
+    if cursor.fetchone()['cnt'] == 0:
+        cursor.execute("INSERT INTO admins (username, password_hash, full_name, role) VALUES (%s, %s, %s, %s)",
+                      ('admin', generate_password_hash('admin123'), 'Master Administrator', 'master_admin'))
+
+    cursor.execute("SELECT COUNT(*) as cnt FROM settings WHERE key = 'grace_period'")
+    if cursor.fetchone()['cnt'] == 0:
+        cursor.execute("INSERT INTO settings (key, value) VALUES (%s, %s)", ('grace_period', '10'))
+        cursor.execute("INSERT INTO settings (key, value) VALUES (%s, %s)", ('work_start_time', '08:00'))
+        cursor.execute("INSERT INTO settings (key, value) VALUES (%s, %s)", ('work_end_time', '17:00'))
+        cursor.execute("INSERT INTO settings (key, value) VALUES (%s, %s)", ('work_hours', '8'))
+
+    cursor.execute("SELECT COUNT(*) as cnt FROM branches")
+    if cursor.fetchone()['cnt'] == 0:
+        cursor.execute("INSERT INTO branches (name, address) VALUES (%s, %s)", ('Main Branch', 'Default Address'))
+
+    cursor.execute("SELECT COUNT(*) as cnt FROM statutory_deductions")
+    if cursor.fetchone()['cnt'] == 0:
+        cursor.execute("INSERT INTO statutory_deductions (name, is_percentage, employee_rate, employer_rate) VALUES (%s, %s, %s, %s)", ('SSS', 1, 4.5, 9.5))
+        cursor.execute("INSERT INTO statutory_deductions (name, is_percentage, employee_rate, employer_rate) VALUES (%s, %s, %s, %s)", ('PhilHealth', 1, 2.5, 2.5))
+        cursor.execute("INSERT INTO statutory_deductions (name, is_percentage, employee_rate, employer_rate) VALUES (%s, %s, %s, %s)", ('Pag-IBIG', 0, 100, 100))
@@ -0,0 +1,24 @@
+-- migrate: no-transaction
+-- Indexes for the kiosk punch path, payroll views and activity log. Built
+-- CONCURRENTLY so live attendance writes are not blocked during a deploy;
+-- `python migrate.py check-indexes` verifies they are valid and usable.
+
+-- Attendance.time_in / get_today_all_events / daily metrics: (employee_id, date)
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_attendance_employee_date
+    ON attendance (employee_id, date);
+
+-- Open-record lookups: employee_id = ? AND time_out IS NULL ORDER BY id DESC LIMIT 1
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_attendance_open
+    ON attendance (employee_id, id DESC) WHERE time_out IS NULL;
+
+-- PayrollRecord.get_by_period
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_payroll_records_period
+    ON payroll_records (payroll_period_id);
+
+-- PayrollRecord.get_deduction_items
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_payroll_deduction_items_record
+    ON payroll_deduction_items (payroll_record_id);
+
+-- ActivityLog.get_all: ORDER BY created_at DESC LIMIT n
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_activity_logs_created_at
+    ON activity_logs (created_at DESC);
@@ -0,0 +1,28 @@
+-- Queue for work that is too slow for a web request (payroll generation).
+-- Workers claim queued rows with FOR UPDATE SKIP LOCKED; see jobs.py.
+CREATE TABLE IF NOT EXISTS background_jobs (
+    id SERIAL PRIMARY KEY,
+    job_type TEXT NOT NULL,
+    dedupe_key TEXT,
+    payload JSONB NOT NULL DEFAULT '{}'::jsonb,
+    status TEXT NOT NULL DEFAULT 'queued'
+        CHECK (status IN ('queued', 'running', 'succeeded', 'failed')),
+    progress INTEGER NOT NULL DEFAULT 0,
+    progress_total INTEGER NOT NULL DEFAULT 0,
+    message TEXT,
+    result JSONB,
+    error TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    created_by INTEGER REFERENCES admins(id) ON DELETE SET NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    started_at TIMESTAMP,
+    heartbeat_at TIMESTAMP,
+    finished_at TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_background_jobs_queued
+    ON background_jobs (id) WHERE status IN ('queued', 'running');
+
+-- At most one queued/running job per (type, key), e.g. one generation per period
+CREATE UNIQUE INDEX IF NOT EXISTS idx_background_jobs_active_key
+    ON background_jobs (job_type, dedupe_key) WHERE status IN ('queued', 'running');
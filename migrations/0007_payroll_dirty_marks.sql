@@ -0,0 +1,66 @@
+-- Employee/dates whose payroll inputs changed, per unlocked period, so a
+-- regeneration only recomputes the affected employees.
+CREATE TABLE IF NOT EXISTS payroll_dirty_marks (
+    payroll_period_id INTEGER NOT NULL REFERENCES payroll_periods(id) ON DELETE CASCADE,
+    employee_id INTEGER NOT NULL REFERENCES employees(id) ON DELETE CASCADE,
+    work_date DATE NOT NULL,
+    marked_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (payroll_period_id, employee_id, work_date)
+);
+
+-- Incremental regeneration upserts on (period, employee). Duplicate records
+-- left by older code are not deleted: all but the newest of each pair move to
+-- the *_duplicates archive tables, and each pair is logged by the migration.
+CREATE TABLE IF NOT EXISTS payroll_records_duplicates (
+    LIKE payroll_records,
+    archived_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+CREATE TABLE IF NOT EXISTS payroll_deduction_items_duplicates (
+    LIKE payroll_deduction_items,
+    archived_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TEMP TABLE superseded_payroll_records ON COMMIT DROP AS
+SELECT pr.id, pr.payroll_period_id, pr.employee_id
+FROM payroll_records pr
+WHERE EXISTS (
+    SELECT 1 FROM payroll_records newer
+    WHERE newer.payroll_period_id = pr.payroll_period_id
+      AND newer.employee_id = pr.employee_id
+      AND newer.id > pr.id
+);
+
+DO $$
+DECLARE
+    pair RECORD;
+BEGIN
+    FOR pair IN
+        SELECT payroll_period_id, employee_id, COUNT(*) AS copies
+        FROM superseded_payroll_records
+        GROUP BY payroll_period_id, employee_id
+        ORDER BY payroll_period_id, employee_id
+    LOOP
+        RAISE NOTICE 'Archived % older payroll record(s) of employee % in period % to payroll_records_duplicates',
+            pair.copies, pair.employee_id, pair.payroll_period_id;
+    END LOOP;
+END $$;
+
+INSERT INTO payroll_deduction_items_duplicates
+SELECT di.* FROM payroll_deduction_items di
+WHERE di.payroll_record_id IN (SELECT id FROM superseded_payroll_records);
+
+INSERT INTO payroll_records_duplicates
+SELECT pr.* FROM payroll_records pr
+WHERE pr.id IN (SELECT id FROM superseded_payroll_records);
+
+DELETE FROM payroll_deduction_items
+WHERE payroll_record_id IN (SELECT id FROM superseded_payroll_records);
+
+DELETE FROM payroll_records
+WHERE id IN (SELECT id FROM superseded_payroll_records);
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_payroll_records_period_employee
+    ON payroll_records (payroll_period_id, employee_id);
+
+-- Superseded by the unique index above (same leading column)
+DROP INDEX IF EXISTS idx_payroll_records_period;
@@ -0,0 +1,19 @@
+-- Per-employee, per-calendar-year basic pay (year of the period start date),
+-- kept current by payroll generation and locking; read by the 13th-month report.
+CREATE TABLE IF NOT EXISTS payroll_yearly_totals (
+    year INTEGER NOT NULL,
+    employee_id INTEGER NOT NULL REFERENCES employees(id) ON DELETE CASCADE,
+    total_basic DOUBLE PRECISION NOT NULL DEFAULT 0,
+    period_count INTEGER NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (year, employee_id)
+);
+
+CREATE INDEX IF NOT EXISTS idx_payroll_periods_start_date ON payroll_periods (start_date);
+
+INSERT INTO payroll_yearly_totals (year, employee_id, total_basic, period_count)
+SELECT EXTRACT(YEAR FROM pp.start_date)::int, pr.employee_id, SUM(pr.regular_pay), COUNT(*)
+FROM payroll_records pr
+JOIN payroll_periods pp ON pr.payroll_period_id = pp.id
+GROUP BY 1, 2
+ON CONFLICT (year, employee_id) DO NOTHING;
@@ -0,0 +1,3 @@
+-- Cache key of the payslip PDF rendered for a record (see payslip_cache.py);
+-- set once its period is locked, cleared whenever the record is rewritten.
+ALTER TABLE payroll_records ADD COLUMN IF NOT EXISTS payslip_sha256 TEXT;
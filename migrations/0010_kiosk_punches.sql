@@ -0,0 +1,14 @@
+-- Outcome of every punch a kiosk queued while offline and replayed through
+-- /api/kiosk/sync, keyed by the id the kiosk generated for it, so a batch
+-- sent twice (the kiosk never saw the response) is not punched twice.
+CREATE TABLE IF NOT EXISTS kiosk_punches (
+    client_id TEXT PRIMARY KEY,
+    employee_id INTEGER NOT NULL REFERENCES employees(id),
+    action TEXT NOT NULL CHECK (action IN ('time_in', 'time_out')),
+    purpose TEXT NOT NULL,
+    punched_at TIMESTAMPTZ NOT NULL,
+    attendance_id INTEGER REFERENCES attendance(id) ON DELETE SET NULL,
+    success BOOLEAN NOT NULL DEFAULT FALSE,
+    message TEXT,
+    received_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
@@ -0,0 +1,14 @@
+-- migrate: no-transaction
+-- Idempotency key the kiosk sent with each punch, so a resubmitted clock-in
+-- or clock-out returns the row it already wrote instead of writing again.
+-- The unique indexes are built CONCURRENTLY so live punches are not blocked.
+
+ALTER TABLE attendance ADD COLUMN IF NOT EXISTS time_in_key TEXT;
+
+ALTER TABLE attendance ADD COLUMN IF NOT EXISTS time_out_key TEXT;
+
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS idx_attendance_time_in_key
+    ON attendance (time_in_key) WHERE time_in_key IS NOT NULL;
+
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS idx_attendance_time_out_key
+    ON attendance (time_out_key) WHERE time_out_key IS NOT NULL;
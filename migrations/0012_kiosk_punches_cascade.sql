@@ -0,0 +1,5 @@
+-- Deleting an employee (e.g. DatabaseManager.reset_all_data) also removes
+-- their synced kiosk punch outcomes, like the other per-employee tables.
+ALTER TABLE kiosk_punches DROP CONSTRAINT IF EXISTS kiosk_punches_employee_id_fkey;
+ALTER TABLE kiosk_punches ADD CONSTRAINT kiosk_punches_employee_id_fkey
+    FOREIGN KEY (employee_id) REFERENCES employees(id) ON DELETE CASCADE;
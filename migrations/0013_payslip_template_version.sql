@@ -0,0 +1,3 @@
+-- Template version payroll_records.payslip_sha256 was rendered with; a cached
+-- payslip from an older template is treated as missing and rendered again.
+ALTER TABLE payroll_records ADD COLUMN IF NOT EXISTS payslip_template_version TEXT;
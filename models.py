@@ -1,17 +1,46 @@
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2.extras import RealDictCursor, execute_values, Json
 import os
+import logging
 from datetime import datetime, date, timedelta
 import pytz
+import db_pool
 from werkzeug.security import generate_password_hash, check_password_hash
 
+logger = logging.getLogger(__name__)
+
 MANILA_TZ = pytz.timezone('Asia/Manila')
 
+# Payroll computation fan-out: worker processes (1 = serial) and how employees
+# are split between them ('branch' keeps each branch together, 'hash' spreads
+# employees evenly by id).
+PAYROLL_WORKERS = int(os.environ.get('PAYROLL_WORKERS', '1'))
+PAYROLL_SHARD_BY = os.environ.get('PAYROLL_SHARD_BY', 'branch')
+# Below this many employees process start-up costs more than it saves
+PAYROLL_PARALLEL_MIN_EMPLOYEES = 200
+# Advisory-lock namespace for payroll generation; the second key is the period id
+PAYROLL_LOCK_NAMESPACE = 7245101
+# Advisory-lock namespace for payroll_yearly_totals; the second key is the year
+PAYROLL_TOTALS_LOCK_NAMESPACE = 7245102
+# A running job whose heartbeat is older than this is assumed dead and re-queued
+JOB_STALE_SECONDS = int(os.environ.get('JOB_STALE_SECONDS', '900'))
+JOB_MAX_ATTEMPTS = 3
+# payroll_records amounts compared by PayrollRecord.diff_records()
+PAYROLL_DIFF_FIELDS = (
+    'locked_daily_rate', 'days_worked', 'regular_pay', 'overtime_pay', 'holiday_pay',
+    'tardiness_deduction', 'undertime_deduction', 'gross_pay', 'total_deductions', 'net_pay'
+)
+
+
+class PayrollInProgress(RuntimeError):
+    """Another session is already generating payroll for the same period."""
+
 def get_manila_now():
     """Get current datetime in Asia/Manila timezone"""
     return datetime.now(MANILA_TZ)
 
 def get_db():
+    """Borrow a pooled connection; close() hands it back (see db_pool)."""
     database_url = os.environ.get('DATABASE_URL')
     if not database_url:
         raise RuntimeError(
@@ -20,8 +49,7 @@ def get_db():
             "In the Deployments pane, add DATABASE_URL to your production secrets."
         )
     try:
-        conn = psycopg2.connect(database_url)
-        return conn
+        return db_pool.connect(database_url)
     except psycopg2.OperationalError as e:
         error_msg = str(e)
         if "could not translate host name" in error_msg:
@@ -35,294 +63,28 @@ def get_db():
 def get_cursor(conn):
     return conn.cursor(cursor_factory=RealDictCursor)
 
-def init_db():
-    conn = get_db()
-    conn.autocommit = True  # Keep autocommit ON to prevent transaction issues
-    cursor = get_cursor(conn)
-    
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS branches (
-            id SERIAL PRIMARY KEY,
-            name TEXT NOT NULL UNIQUE,
-            address TEXT,
-            gps_latitude REAL,
-            gps_longitude REAL,
-            gps_radius_meters INTEGER DEFAULT 100,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS employees (
-            id SERIAL PRIMARY KEY,
-            employee_id TEXT NOT NULL UNIQUE,
-            first_name TEXT NOT NULL,
-            last_name TEXT NOT NULL,
-            branch_id INTEGER,
-            daily_rate REAL NOT NULL DEFAULT 0,
-            start_time TEXT DEFAULT '08:00',
-            end_time TEXT DEFAULT '17:00',
-            pin_hash TEXT NOT NULL,
-            photo_path TEXT,
-            is_active INTEGER DEFAULT 1,
-            is_resigned INTEGER DEFAULT 0,
-            resigned_date DATE,
-            status TEXT DEFAULT 'active',
-            status_reason TEXT,
-            status_date DATE,
-            id_photo TEXT,
-            cv_file TEXT,
-            date_of_birth DATE,
-            gender TEXT,
-            civil_status TEXT,
-            address TEXT,
-            phone TEXT,
-            email TEXT,
-            sss_number TEXT,
-            philhealth_number TEXT,
-            pagibig_number TEXT,
-            tin_number TEXT,
-            emergency_contact_name TEXT,
-            emergency_contact_phone TEXT,
-            emergency_contact_relationship TEXT,
-            reference_name TEXT,
-            reference_phone TEXT,
-            reference_company TEXT,
-            date_hired DATE,
-            position TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (branch_id) REFERENCES branches(id)
-        )
-    ''')
-    
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS attendance (
-            id SERIAL PRIMARY KEY,
-            employee_id INTEGER NOT NULL,
-            date DATE NOT NULL,
-            time_in TIMESTAMP,
-            time_out TIMESTAMP,
-            time_in_photo TEXT,
-            time_out_photo TEXT,
-            time_in_purpose TEXT DEFAULT 'clock_in',
-            time_out_purpose TEXT,
-            is_holiday INTEGER DEFAULT 0,
-            holiday_type TEXT,
-            is_overtime_approved INTEGER DEFAULT 0,
-            overtime_hours REAL DEFAULT 0,
-            tardiness_minutes INTEGER DEFAULT 0,
-            undertime_minutes INTEGER DEFAULT 0,
-            early_start_approved INTEGER DEFAULT 0,
-            early_start_minutes INTEGER DEFAULT 0,
-            official_overtime_approved INTEGER DEFAULT 0,
-            official_overtime_minutes INTEGER DEFAULT 0,
-            requires_admin_review INTEGER DEFAULT 0,
-            admin_review_reason TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (employee_id) REFERENCES employees(id)
-        )
-    ''')
-    
-    try:
-        cursor.execute("ALTER TABLE attendance ADD COLUMN IF NOT EXISTS requires_admin_review INTEGER DEFAULT 0")
-        cursor.execute("ALTER TABLE attendance ADD COLUMN IF NOT EXISTS admin_review_reason TEXT")
-        cursor.execute("ALTER TABLE attendance ADD COLUMN IF NOT EXISTS is_remote_field INTEGER DEFAULT 0")
-        cursor.execute("ALTER TABLE attendance ADD COLUMN IF NOT EXISTS remote_field_hours REAL DEFAULT 0")
-        
-        # Migration for admin_auth_codes
-        cursor.execute("ALTER TABLE admin_auth_codes ADD COLUMN IF NOT EXISTS allowable_hours REAL DEFAULT 0")
-        # Update check constraint for code_type if possible, or just handle it via code
-        try:
-            cursor.execute("ALTER TABLE admin_auth_codes DROP CONSTRAINT IF EXISTS admin_auth_codes_code_type_check")
-            cursor.execute("ALTER TABLE admin_auth_codes ADD CONSTRAINT admin_auth_codes_code_type_check CHECK (code_type IN ('early_start', 'overtime', 'remote_field'))")
-        except:
-            pass
-    except:
-        pass
-    
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS payroll_periods (
-            id SERIAL PRIMARY KEY,
-            name TEXT NOT NULL,
-            start_date DATE NOT NULL,
-            end_date DATE NOT NULL,
-            is_locked INTEGER DEFAULT 0,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS statutory_deductions (
-            id SERIAL PRIMARY KEY,
-            name TEXT NOT NULL UNIQUE,
-            is_percentage INTEGER DEFAULT 0,
-            employee_rate REAL DEFAULT 0,
-            employer_rate REAL DEFAULT 0,
-            is_active INTEGER DEFAULT 1,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS payroll_records (
-            id SERIAL PRIMARY KEY,
-            payroll_period_id INTEGER NOT NULL,
-            employee_id INTEGER NOT NULL,
-            locked_daily_rate REAL NOT NULL,
-            days_worked REAL DEFAULT 0,
-            regular_pay REAL DEFAULT 0,
-            overtime_pay REAL DEFAULT 0,
-            holiday_pay REAL DEFAULT 0,
-            tardiness_deduction REAL DEFAULT 0,
-            undertime_deduction REAL DEFAULT 0,
-            gross_pay REAL DEFAULT 0,
-            total_deductions REAL DEFAULT 0,
-            net_pay REAL DEFAULT 0,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (payroll_period_id) REFERENCES payroll_periods(id),
-            FOREIGN KEY (employee_id) REFERENCES employees(id)
-        )
-    ''')
-    
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS payroll_deduction_items (
-            id SERIAL PRIMARY KEY,
-            payroll_record_id INTEGER NOT NULL,
-            deduction_id INTEGER NOT NULL,
-            deduction_name TEXT NOT NULL,
-            employee_amount REAL DEFAULT 0,
-            employer_amount REAL DEFAULT 0,
-            FOREIGN KEY (payroll_record_id) REFERENCES payroll_records(id),
-            FOREIGN KEY (deduction_id) REFERENCES statutory_deductions(id)
-        )
-    ''')
-    
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS holidays (
-            id SERIAL PRIMARY KEY,
-            date DATE NOT NULL UNIQUE,
-            name TEXT NOT NULL,
-            type TEXT NOT NULL CHECK(type IN ('regular', 'special'))
-        )
-    ''')
-    
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS settings (
-            id SERIAL PRIMARY KEY,
-            key TEXT NOT NULL UNIQUE,
-            value TEXT NOT NULL
-        )
-    ''')
-    
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS admins (
-            id SERIAL PRIMARY KEY,
-            username TEXT NOT NULL UNIQUE,
-            password_hash TEXT NOT NULL,
-            full_name TEXT NOT NULL,
-            role TEXT DEFAULT 'sub_admin',
-            is_active INTEGER DEFAULT 1,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS activity_logs (
-            id SERIAL PRIMARY KEY,
-            admin_id INTEGER,
-            admin_name TEXT,
-            action TEXT NOT NULL,
-            target_type TEXT,
-            target_id INTEGER,
-            details TEXT,
-            ip_address TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (admin_id) REFERENCES admins(id)
-        )
-    ''')
-    
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS admin_auth_codes (
-            id SERIAL PRIMARY KEY,
-            code TEXT NOT NULL UNIQUE,
-            code_type TEXT NOT NULL CHECK(code_type IN ('early_start', 'overtime', 'remote_field')),
-            allowable_hours REAL DEFAULT 0,
-            description TEXT,
-            is_active INTEGER DEFAULT 1,
-            uses_remaining INTEGER DEFAULT -1,
-            valid_until DATE,
-            created_by INTEGER,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (created_by) REFERENCES admins(id)
-        )
-    ''')
-    
-    cursor.execute("SELECT COUNT(*) as cnt FROM admins")
-    if cursor.fetchone()['cnt'] == 0:
-        from werkzeug.security import generate_password_hash
-        cursor.execute("INSERT INTO admins (username, password_hash, full_name, role) VALUES (%s, %s, %s, %s)", 
-                      ('admin', generate_password_hash('admin123'), 'Master Administrator', 'master_admin'))
-    
-    cursor.execute("SELECT COUNT(*) as cnt FROM settings WHERE key = 'grace_period'")
-    if cursor.fetchone()['cnt'] == 0:
-        cursor.execute("INSERT INTO settings (key, value) VALUES (%s, %s)", ('grace_period', '10'))
-        cursor.execute("INSERT INTO settings (key, value) VALUES (%s, %s)", ('work_start_time', '08:00'))
-        cursor.execute("INSERT INTO settings (key, value) VALUES (%s, %s)", ('work_end_time', '17:00'))
-        cursor.execute("INSERT INTO settings (key, value) VALUES (%s, %s)", ('work_hours', '8'))
-    
-    cursor.execute("SELECT COUNT(*) as cnt FROM branches")
-    if cursor.fetchone()['cnt'] == 0:
-        cursor.execute("INSERT INTO branches (name, address) VALUES (%s, %s)", ('Main Branch', 'Default Address'))
-    
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS employee_schedules (
-            id SERIAL PRIMARY KEY,
-            employee_id INTEGER NOT NULL REFERENCES employees(id) ON DELETE CASCADE,
-            effective_from DATE NOT NULL,
-            effective_to DATE,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            created_by INTEGER REFERENCES admins(id),
-            sunday_is_working BOOLEAN DEFAULT false,
-            sunday_start_time TIME,
-            sunday_end_time TIME,
-            monday_is_working BOOLEAN DEFAULT true,
-            monday_start_time TIME DEFAULT '08:00',
-            monday_end_time TIME DEFAULT '17:00',
-            tuesday_is_working BOOLEAN DEFAULT true,
-            tuesday_start_time TIME DEFAULT '08:00',
-            tuesday_end_time TIME DEFAULT '17:00',
-            wednesday_is_working BOOLEAN DEFAULT true,
-            wednesday_start_time TIME DEFAULT '08:00',
-            wednesday_end_time TIME DEFAULT '17:00',
-            thursday_is_working BOOLEAN DEFAULT true,
-            thursday_start_time TIME DEFAULT '08:00',
-            thursday_end_time TIME DEFAULT '17:00',
-            friday_is_working BOOLEAN DEFAULT true,
-            friday_start_time TIME DEFAULT '08:00',
-            friday_end_time TIME DEFAULT '17:00',
-            saturday_is_working BOOLEAN DEFAULT true,
-            saturday_start_time TIME DEFAULT '08:00',
-            saturday_end_time TIME DEFAULT '17:00',
-            CONSTRAINT valid_date_range CHECK (effective_to IS NULL OR effective_from <= effective_to)
-        )
-    ''')
-    try:
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_employee_schedules_employee_id ON employee_schedules(employee_id)")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_employee_schedules_dates ON employee_schedules(effective_from, effective_to)")
-        cursor.execute("ALTER TABLE employee_schedules ADD CONSTRAINT one_current_schedule_per_employee UNIQUE (employee_id, effective_to) DEFERRABLE INITIALLY DEFERRED")
-    except Exception:
-        pass  # Indexes/constraints may already exist
-
-    cursor.execute("SELECT COUNT(*) as cnt FROM statutory_deductions")
-    if cursor.fetchone()['cnt'] == 0:
-        cursor.execute("INSERT INTO statutory_deductions (name, is_percentage, employee_rate, employer_rate) VALUES (%s, %s, %s, %s)", ('SSS', 1, 4.5, 9.5))
-        cursor.execute("INSERT INTO statutory_deductions (name, is_percentage, employee_rate, employer_rate) VALUES (%s, %s, %s, %s)", ('PhilHealth', 1, 2.5, 2.5))
-        cursor.execute("INSERT INTO statutory_deductions (name, is_percentage, employee_rate, employer_rate) VALUES (%s, %s, %s, %s)", ('Pag-IBIG', 0, 100, 100))
-    
-    conn.close()  # No commit needed - autocommit is True
-
 class Employee:
+    # Named column sets for employee reads. Callers ask for the narrowest one,
+    # so hot paths never load the PIN hash, ID photo or government IDs.
+    ROSTER_COLUMNS = ['id', 'employee_id', 'first_name', 'last_name', 'branch_id', 'is_active', 'is_resigned']
+    PROJECTIONS = {
+        'roster': ROSTER_COLUMNS,
+        'payroll': ROSTER_COLUMNS + ['daily_rate', 'start_time', 'end_time'],
+        'list': ROSTER_COLUMNS + ['daily_rate', 'position', 'status', 'id_photo'],
+        'files': ['id', 'id_photo', 'cv_file'],
+        'detail': ROSTER_COLUMNS + [
+            'daily_rate', 'start_time', 'end_time', 'photo_path', 'resigned_date', 'status', 'status_reason',
+            'status_date', 'id_photo', 'cv_file', 'date_of_birth', 'gender', 'civil_status', 'address', 'phone',
+            'email', 'sss_number', 'philhealth_number', 'pagibig_number', 'tin_number', 'emergency_contact_name',
+            'emergency_contact_phone', 'emergency_contact_relationship', 'reference_name', 'reference_phone',
+            'reference_company', 'date_hired', 'position', 'created_at', 'updated_at'
+        ],
+    }
+    
+    @staticmethod
+    def _columns(projection):
+        return ', '.join(f'e.{column}' for column in Employee.PROJECTIONS[projection])
+    
     @staticmethod
     def create(employee_id, first_name, last_name, branch_id, daily_rate, pin, start_time='08:00', end_time='17:00', **kwargs):
         conn = get_db()
@@ -362,19 +124,19 @@ class Employee:
             return None
     
     @staticmethod
-    def get_all(include_resigned=False):
+    def get_all(include_resigned=False, projection='detail'):
         conn = get_db()
         cursor = get_cursor(conn)
         if include_resigned:
-            cursor.execute('''
-                SELECT e.*, b.name as branch_name 
+            cursor.execute(f'''
+                SELECT {Employee._columns(projection)}, b.name as branch_name 
                 FROM employees e 
                 LEFT JOIN branches b ON e.branch_id = b.id
                 ORDER BY e.last_name, e.first_name
             ''')
         else:
-            cursor.execute('''
-                SELECT e.*, b.name as branch_name 
+            cursor.execute(f'''
+                SELECT {Employee._columns(projection)}, b.name as branch_name 
                 FROM employees e 
                 LEFT JOIN branches b ON e.branch_id = b.id
                 WHERE e.is_resigned = FALSE
@@ -385,20 +147,20 @@ class Employee:
         return employees
     
     @staticmethod
-    def get_by_id(emp_id):
+    def get_by_id(emp_id, projection='detail'):
         conn = get_db()
         cursor = get_cursor(conn)
-        cursor.execute('SELECT * FROM employees WHERE id = %s', (emp_id,))
+        cursor.execute(f'SELECT {Employee._columns(projection)} FROM employees e WHERE e.id = %s', (emp_id,))
         employee = cursor.fetchone()
         conn.close()
         return employee
     
     @staticmethod
-    def get_active():
+    def get_active(projection='detail'):
         conn = get_db()
         cursor = get_cursor(conn)
-        cursor.execute('''
-            SELECT e.*, b.name as branch_name 
+        cursor.execute(f'''
+            SELECT {Employee._columns(projection)}, b.name as branch_name 
             FROM employees e 
             LEFT JOIN branches b ON e.branch_id = b.id
             WHERE e.is_active = TRUE AND e.is_resigned = FALSE
@@ -408,6 +170,78 @@ class Employee:
         conn.close()
         return employees
     
+    @staticmethod
+    def get_roster(branch_id=None):
+        """Active employees as kiosks list them: id, code, name and branch."""
+        conn = get_db()
+        cursor = get_cursor(conn)
+        cursor.execute('''
+            SELECT e.id, e.employee_id, e.first_name, e.last_name, e.branch_id, b.name AS branch_name
+            FROM employees e
+            LEFT JOIN branches b ON e.branch_id = b.id
+            WHERE e.is_active = TRUE AND e.is_resigned = FALSE
+              AND (%s::int IS NULL OR e.branch_id = %s)
+            ORDER BY e.last_name, e.first_name
+        ''', (branch_id, branch_id))
+        employees = cursor.fetchall()
+        conn.close()
+        return employees
+    
+    @staticmethod
+    def roster_version(branch_id=None):
+        """
+        A string that changes whenever get_roster(branch_id) would: every
+        employee write bumps updated_at, hires and departures change the
+        count, and branch renames change the branch digest.
+        """
+        conn = get_db()
+        cursor = get_cursor(conn)
+        cursor.execute('''
+            SELECT MAX(e.updated_at) AS updated_at,
+                   COUNT(*) FILTER (WHERE e.is_active = TRUE AND e.is_resigned = FALSE
+                                      AND (%s::int IS NULL OR e.branch_id = %s)) AS count,
+                   (SELECT md5(string_agg(b.id || ':' || b.name, ',' ORDER BY b.id)) FROM branches b) AS branches
+            FROM employees e
+        ''', (branch_id, branch_id))
+        row = cursor.fetchone()
+        conn.close()
+        return f"{row['updated_at']}|{row['count']}|{row['branches']}"
+    
+    @staticmethod
+    def count_inline_id_photos():
+        conn = get_db()
+        cursor = get_cursor(conn)
+        cursor.execute("SELECT COUNT(*) AS count FROM employees WHERE id_photo LIKE 'data:%%'")
+        count = cursor.fetchone()['count']
+        conn.close()
+        return count
+    
+    @staticmethod
+    def get_inline_id_photos(after_id, limit):
+        """Employees (id, id_photo) still holding a base64 ID photo, in id order after after_id."""
+        conn = get_db()
+        cursor = get_cursor(conn)
+        cursor.execute('''
+            SELECT id, id_photo FROM employees
+            WHERE id_photo LIKE 'data:%%' AND id > %s
+            ORDER BY id LIMIT %s
+        ''', (after_id, limit))
+        rows = cursor.fetchall()
+        conn.close()
+        return rows
+    
+    @staticmethod
+    def replace_id_photo(emp_id, old_value, new_value):
+        """Swap an employee's ID photo unless it was changed meanwhile; returns whether it was swapped."""
+        conn = get_db()
+        cursor = get_cursor(conn)
+        cursor.execute('UPDATE employees SET id_photo = %s WHERE id = %s AND id_photo = %s',
+                       (new_value, emp_id, old_value))
+        replaced = cursor.rowcount == 1
+        conn.commit()
+        conn.close()
+        return replaced
+    
     @staticmethod
     def update(emp_id, employee_id, first_name, last_name, branch_id, daily_rate, pin=None, start_time=None, end_time=None, **kwargs):
         conn = get_db()
@@ -449,7 +283,12 @@ class Employee:
         set_clause += ', updated_at = CURRENT_TIMESTAMP'
         values.append(emp_id)
         
-        cursor.execute(f'UPDATE employees SET {set_clause} WHERE id = %s', values)
+        cursor.execute('SELECT daily_rate, start_time, end_time FROM employees WHERE id = %s FOR UPDATE', (emp_id,))
+        before = cursor.fetchone()
+        cursor.execute(f'UPDATE employees SET {set_clause} WHERE id = %s RETURNING daily_rate, start_time, end_time', values)
+        after = cursor.fetchone()
+        if before and after and dict(before) != dict(after):
+            PayrollDirtyMark.mark_from(cursor, emp_id)
         conn.commit()
         conn.close()
     
@@ -497,13 +336,40 @@ class Attendance:
     def calculate_daily_metrics(employee_id, target_date):
         
         # 1. Get Employee Details
-        emp = Employee.get_by_id(employee_id)
+        emp = Employee.get_by_id(employee_id, 'payroll')
         if not emp:
             return None
 
         # 2. Get Schedule for the day
         schedule = EmployeeSchedule.get_active_schedule_for_date(employee_id, target_date)
         
+        def load_day():
+            conn = get_db()
+            cursor = get_cursor(conn)
+            cursor.execute('''
+                SELECT * FROM attendance 
+                WHERE employee_id = %s AND date = %s
+                ORDER BY time_in
+            ''', (employee_id, target_date.isoformat()))
+            records = cursor.fetchall()
+            
+            # Also check for holidays while connection is open
+            cursor.execute("SELECT * FROM holidays WHERE date = %s", (target_date.isoformat(),))
+            holiday = cursor.fetchone()
+            
+            conn.close()
+            return records, holiday
+        
+        return Attendance._build_daily_metrics(emp, schedule, target_date, load_day)
+
+    @staticmethod
+    def _build_daily_metrics(emp, schedule, target_date, load_day):
+        """
+        Daily metrics for one employee/date from already-loaded inputs.
+
+        load_day() returns (attendance records ordered by time_in, holiday row
+        or None) and is only called for scheduled working days.
+        """
         # Default metrics
         metrics = {
             'date': target_date.isoformat(),
@@ -561,21 +427,8 @@ class Attendance:
         if scheduled_end < scheduled_start:
             scheduled_end += timedelta(days=1)
             
-        # 3. Get Attendance Records for the day
-        conn = get_db()
-        cursor = get_cursor(conn)
-        cursor.execute('''
-            SELECT * FROM attendance 
-            WHERE employee_id = %s AND date = %s
-            ORDER BY time_in
-        ''', (employee_id, target_date.isoformat()))
-        records = cursor.fetchall()
-        
-        # Also check for holidays while connection is open
-        cursor.execute("SELECT * FROM holidays WHERE date = %s", (target_date.isoformat(),))
-        holiday = cursor.fetchone()
-        
-        conn.close()
+        # 3. Get Attendance Records (and holiday) for the day
+        records, holiday = load_day()
         
         metrics['records'] = records
         
@@ -652,12 +505,18 @@ class Attendance:
 
     @staticmethod
     def get_summary_by_date_range(start_date, end_date, employee_id=None):
-        
+        """
+        Per-employee attendance summary for a date range.
+
+        Employees, schedules, attendance rows and holidays for the whole range
+        are loaded in four queries and every day is computed in memory with
+        the same rules as calculate_daily_metrics().
+        """
         # 1. Get list of employees
         if employee_id:
-            employees = [Employee.get_by_id(employee_id)]
+            employees = [emp for emp in [Employee.get_by_id(employee_id, 'payroll')] if emp]
         else:
-            employees = Employee.get_active()
+            employees = Employee.get_active('payroll')
             
         if not employees:
             return []
@@ -668,6 +527,41 @@ class Attendance:
         while current_date <= end_date:
             date_list.append(current_date)
             current_date += timedelta(days=1)
+        
+        employee_ids = [emp['id'] for emp in employees]
+        conn = get_db()
+        cursor = get_cursor(conn)
+        cursor.execute('''
+            SELECT * FROM employee_schedules
+            WHERE employee_id = ANY(%s)
+            AND effective_from <= %s
+            AND (effective_to IS NULL OR effective_to >= %s)
+            ORDER BY employee_id, effective_from DESC
+        ''', (employee_ids, end_date.isoformat(), start_date.isoformat()))
+        schedules_by_employee = {}
+        for schedule in cursor.fetchall():
+            schedules_by_employee.setdefault(schedule['employee_id'], []).append(schedule)
+        
+        cursor.execute('''
+            SELECT * FROM attendance
+            WHERE employee_id = ANY(%s) AND date BETWEEN %s AND %s
+            ORDER BY employee_id, date, time_in
+        ''', (employee_ids, start_date.isoformat(), end_date.isoformat()))
+        records_by_day = {}
+        for record in cursor.fetchall():
+            records_by_day.setdefault((record['employee_id'], str(record['date'])[:10]), []).append(record)
+        
+        cursor.execute("SELECT * FROM holidays WHERE date BETWEEN %s AND %s",
+                       (start_date.isoformat(), end_date.isoformat()))
+        holidays_by_day = {str(h['date'])[:10]: h for h in cursor.fetchall()}
+        conn.close()
+        
+        def schedule_for(emp_id, d):
+            # Same pick as get_active_schedule_for_date: latest effective_from covering d
+            for schedule in schedules_by_employee.get(emp_id, []):
+                if schedule['effective_from'] <= d and (schedule['effective_to'] is None or schedule['effective_to'] >= d):
+                    return schedule
+            return None
             
         # 3. Aggregate metrics for each employee
         summary_list = []
@@ -689,7 +583,11 @@ class Attendance:
             }
             
             for d in date_list:
-                daily_metrics = Attendance.calculate_daily_metrics(emp['id'], d)
+                day_key = (emp['id'], d.isoformat())
+                daily_metrics = Attendance._build_daily_metrics(
+                    emp, schedule_for(emp['id'], d), d,
+                    lambda: (records_by_day.get(day_key, []), holidays_by_day.get(day_key[1]))
+                )
                 if daily_metrics:
                     emp_summary['daily_metrics'].append(daily_metrics)
                     
@@ -712,57 +610,149 @@ class Attendance:
             
         return summary_list
 
+    # One round trip per punch: the open-record check, the employee's
+    # schedule, the grace period, the first clock-in of the day and the
+    # holiday are all read by the INSERT itself. Times are compared in
+    # Asia/Manila. A punch whose idempotency key is already recorded returns
+    # that row with replayed = TRUE; no row comes back when an open record
+    # already exists.
+    TIME_IN_SQL = """
+        WITH params AS (
+            SELECT %(employee_id)s::int AS employee_id, %(today)s::date AS today, %(now)s::timestamptz AS now
+        ),
+        replayed AS (
+            SELECT id FROM attendance WHERE time_in_key = %(idempotency_key)s
+        ),
+        schedule AS (
+            SELECT p.*,
+                   (p.today + COALESCE(NULLIF(left(e.start_time::text, 5), ''), '08:00')::time)
+                       AT TIME ZONE 'Asia/Manila' AS start_at,
+                   (SELECT value::int FROM settings WHERE key = 'grace_period') AS grace_period,
+                   EXISTS (SELECT 1 FROM attendance a
+                           WHERE a.employee_id = p.employee_id AND a.date = p.today
+                             AND a.time_in_purpose = 'clock_in') AS has_clock_in
+            FROM params p
+            LEFT JOIN employees e ON e.id = p.employee_id
+        ),
+        shift AS (
+            -- The shift start nearest to now, so night shifts straddling midnight line up
+            SELECT s.*,
+                   CASE WHEN s.now - s.start_at > interval '12 hours' THEN s.start_at + interval '24 hours'
+                        WHEN s.now - s.start_at < interval '-12 hours' THEN s.start_at - interval '24 hours'
+                        ELSE s.start_at END AS shift_start,
+                   %(check_schedule)s AND NOT s.has_clock_in AS first_clock_in
+            FROM schedule s
+        ),
+        inserted AS (
+            INSERT INTO attendance (employee_id, date, time_in, time_in_photo, time_in_purpose, time_in_purpose_label, tardiness_minutes, is_holiday, holiday_type, early_start_approved, early_start_minutes, is_remote_field, remote_field_hours, time_in_key)
+            SELECT sh.employee_id, sh.today, %(now)s, %(photo_path)s, %(purpose)s, %(purpose_label)s,
+                   CASE WHEN sh.first_clock_in AND sh.now > sh.shift_start + sh.grace_period * interval '1 minute'
+                        THEN trunc(extract(epoch FROM sh.now - sh.shift_start) / 60) ELSE 0 END,
+                   h.date IS NOT NULL, h.type,
+                   sh.first_clock_in AND sh.now < sh.shift_start AND %(early_start_approved)s,
+                   CASE WHEN sh.first_clock_in AND sh.now < sh.shift_start
+                        THEN trunc(extract(epoch FROM sh.shift_start - sh.now) / 60) ELSE 0 END,
+                   %(is_remote_field)s, %(remote_field_hours)s, %(idempotency_key)s
+            FROM shift sh
+            LEFT JOIN holidays h ON h.date = sh.today
+            WHERE NOT EXISTS (SELECT 1 FROM replayed)
+              AND NOT EXISTS (SELECT 1 FROM attendance a
+                              WHERE a.employee_id = sh.employee_id AND a.date = sh.today AND a.time_out IS NULL)
+            ON CONFLICT (time_in_key) WHERE time_in_key IS NOT NULL DO NOTHING
+            RETURNING id
+        )
+        SELECT id, FALSE AS replayed FROM inserted
+        UNION ALL
+        SELECT id, TRUE AS replayed FROM replayed
+    """
+
+    # Closes the latest open record in one round trip, computing undertime,
+    # approved overtime and the next-day review flag from the employee's
+    # schedule, and marks the day dirty for payroll like
+    # PayrollDirtyMark.mark_dates. A replayed idempotency key returns the
+    # record it closed; no row comes back when nothing is open.
+    TIME_OUT_SQL = """
+        WITH params AS (
+            SELECT %(employee_id)s::int AS employee_id, %(today)s::date AS today, %(now)s::timestamptz AS now
+        ),
+        replayed AS (
+            SELECT id FROM attendance WHERE time_out_key = %(idempotency_key)s
+        ),
+        open_record AS (
+            SELECT a.id, a.date FROM attendance a, params p
+            WHERE a.employee_id = p.employee_id AND a.time_out IS NULL
+              AND NOT EXISTS (SELECT 1 FROM replayed)
+            ORDER BY a.id DESC
+            LIMIT 1
+        ),
+        schedule AS (
+            SELECT o.id, o.date, p.today, p.now,
+                   (o.date + w.end_time) AT TIME ZONE 'Asia/Manila' AS end_at,
+                   extract(hour FROM w.end_time) < extract(hour FROM w.start_time) AS is_night_shift
+            FROM open_record o
+            CROSS JOIN params p
+            LEFT JOIN employees e ON e.id = p.employee_id
+            CROSS JOIN LATERAL (
+                SELECT COALESCE(NULLIF(left(e.start_time::text, 5), ''), '08:00')::time AS start_time,
+                       COALESCE(NULLIF(left(e.end_time::text, 5), ''), '17:00')::time AS end_time
+            ) w
+        ),
+        shift AS (
+            SELECT s.*,
+                   CASE WHEN s.is_night_shift THEN s.end_at + interval '24 hours' ELSE s.end_at END AS shift_end,
+                   %(check_schedule)s AND s.today > s.date
+                       AND NOT %(official_overtime_approved)s AND NOT s.is_night_shift AS needs_review
+            FROM schedule s
+        ),
+        outcome AS (
+            SELECT sh.id, sh.date, sh.needs_review,
+                   %(check_schedule)s AND NOT sh.needs_review AND sh.now >= sh.shift_end
+                       AND %(official_overtime_approved)s AS overtime_approved,
+                   %(check_schedule)s AND NOT sh.needs_review AND sh.now < sh.shift_end AS is_undertime,
+                   sh.now, sh.shift_end
+            FROM shift sh
+        ),
+        closed AS (
+            UPDATE attendance a
+            SET time_out = %(now)s, time_out_photo = %(photo_path)s, time_out_purpose = %(purpose)s,
+                time_out_purpose_label = %(purpose_label)s,
+                undertime_minutes = CASE WHEN o.is_undertime
+                                         THEN trunc(extract(epoch FROM o.shift_end - o.now) / 60) ELSE 0 END,
+                official_overtime_approved = o.overtime_approved,
+                official_overtime_minutes = CASE WHEN o.overtime_approved
+                                                 THEN trunc(extract(epoch FROM o.now - o.shift_end) / 60) ELSE 0 END,
+                requires_admin_review = o.needs_review,
+                admin_review_reason = CASE WHEN o.needs_review
+                                           THEN 'Next-day clock-out without overtime approval' END,
+                time_out_key = %(idempotency_key)s
+            FROM outcome o
+            WHERE a.id = o.id AND a.time_out IS NULL
+            RETURNING a.id, a.date
+        ),
+        marked AS (
+            -- Open punches don't count toward payroll, so only the closing punch marks the day
+            INSERT INTO payroll_dirty_marks (payroll_period_id, employee_id, work_date)
+            SELECT p.id, %(employee_id)s, c.date
+            FROM closed c
+            JOIN payroll_periods p ON c.date BETWEEN p.start_date AND p.end_date
+            WHERE COALESCE(p.is_locked::int, 0) = 0
+            ON CONFLICT DO NOTHING
+        )
+        SELECT id, FALSE AS replayed FROM closed
+        UNION ALL
+        SELECT id, TRUE AS replayed FROM replayed
+    """
+
     @staticmethod
-    def time_in(employee_id, photo_path, purpose='clock_in', early_start_approved=False, early_start_code=None, is_remote_field=False, remote_field_hours=0):
-        conn = get_db()
-        cursor = get_cursor(conn)
-        manila_now = get_manila_now()
-        today = manila_now.strftime('%Y-%m-%d')
-        now = manila_now
-        
-        cursor.execute('SELECT * FROM attendance WHERE employee_id = %s AND date = %s AND time_out IS NULL ORDER BY id DESC LIMIT 1', (employee_id, today))
-        open_record = cursor.fetchone()
-        
-        if open_record:
-            conn.close()
-            return None, "You have an open attendance record. Please clock out first."
-        
-        cursor.execute('SELECT start_time, end_time FROM employees WHERE id = %s', (employee_id,))
-        emp_schedule = cursor.fetchone()
-        work_start_raw = emp_schedule['start_time'] if emp_schedule and emp_schedule['start_time'] else '08:00'
-        # Handle TIME type from database (could be time object, string with seconds, or HH:MM)
-        work_start = str(work_start_raw)[:5] if work_start_raw else '08:00'
-        
-        tardiness_minutes = 0
-        early_start_minutes = 0
-        is_early_start_approved = False
-        
-        if purpose == 'clock_in':
-            cursor.execute("SELECT value FROM settings WHERE key = 'grace_period'")
-            grace_period = int(cursor.fetchone()['value'])
-            
-            work_start_time = datetime.strptime(f"{today} {work_start}", "%Y-%m-%d %H:%M")
-            work_start_time = MANILA_TZ.localize(work_start_time)
-            
-            diff_to_start = (now - work_start_time).total_seconds()
-            if diff_to_start > 12 * 3600:
-                work_start_time = work_start_time + timedelta(days=1)
-            elif diff_to_start < -12 * 3600:
-                work_start_time = work_start_time - timedelta(days=1)
-            
-            grace_end = work_start_time + timedelta(minutes=grace_period)
-            
-            cursor.execute('SELECT * FROM attendance WHERE employee_id = %s AND date = %s AND time_in_purpose = %s', (employee_id, today, 'clock_in'))
-            first_clock_in = cursor.fetchone()
-            if not first_clock_in and now > grace_end:
-                diff = now - work_start_time
-                tardiness_minutes = int(diff.total_seconds() / 60)
-            
-            if not first_clock_in and now < work_start_time:
-                diff = work_start_time - now
-                early_start_minutes = int(diff.total_seconds() / 60)
-                if early_start_approved:
-                    is_early_start_approved = True
+    def time_in(employee_id, photo_path, purpose='clock_in', early_start_approved=False, early_start_code=None, is_remote_field=False, remote_field_hours=0, cursor=None, now=None, idempotency_key=None):
+        """
+        Record a clock-in; returns (record_id, message, replayed). A caller
+        that passes its own cursor commits it; now (an aware datetime)
+        backdates a punch queued by an offline kiosk. A repeated
+        idempotency_key returns the original record with replayed=True
+        instead of writing again.
+        """
+        manila_now = (now or get_manila_now()).astimezone(MANILA_TZ)
         
         # Map frontend purpose values to database-allowed values
         purpose_mapping = {
@@ -787,84 +777,40 @@ class Attendance:
         }
         purpose_label = purpose_label_mapping.get(purpose, purpose.replace('_', ' ').title())
         
-        cursor.execute("SELECT date FROM holidays WHERE date = %s", (today,))
-        holiday = cursor.fetchone()
-        is_holiday = True if holiday else False
-        holiday_type = None
-        if holiday:
-            cursor.execute("SELECT type FROM holidays WHERE date = %s", (today,))
-            holiday_type = cursor.fetchone()['type']
-        
-        cursor.execute('''
-            INSERT INTO attendance (employee_id, date, time_in, time_in_photo, time_in_purpose, time_in_purpose_label, tardiness_minutes, is_holiday, holiday_type, early_start_approved, early_start_minutes, is_remote_field, remote_field_hours)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-            RETURNING id
-        ''', (employee_id, today, now.isoformat(), photo_path, db_purpose, purpose_label, tardiness_minutes, is_holiday, holiday_type, is_early_start_approved, early_start_minutes, 1 if is_remote_field else 0, remote_field_hours))
+        conn = None
+        if cursor is None:
+            conn = get_db()
+            cursor = get_cursor(conn)
+        # Tardiness and early start only apply to the day's regular clock-in
+        cursor.execute(Attendance.TIME_IN_SQL, {
+            'employee_id': employee_id,
+            'today': manila_now.strftime('%Y-%m-%d'),
+            'now': manila_now.isoformat(),
+            'photo_path': photo_path,
+            'purpose': db_purpose,
+            'purpose_label': purpose_label,
+            'check_schedule': purpose == 'clock_in',
+            'early_start_approved': bool(early_start_approved),
+            'is_remote_field': 1 if is_remote_field else 0,
+            'remote_field_hours': remote_field_hours,
+            'idempotency_key': idempotency_key,
+        })
         result = cursor.fetchone()
-        conn.commit()
-        record_id = result['id']
-        conn.close()
-        return record_id, f"{purpose.replace('_', ' ').title()} recorded successfully"
+        if not result and idempotency_key:
+            # A concurrent submission with the same key won the insert
+            cursor.execute('SELECT id, TRUE AS replayed FROM attendance WHERE time_in_key = %s', (idempotency_key,))
+            result = cursor.fetchone()
+        if conn:
+            conn.commit()
+            conn.close()
+        if not result:
+            return None, "You have an open attendance record. Please clock out first.", False
+        return result['id'], f"{purpose.replace('_', ' ').title()} recorded successfully", result['replayed']
     
     @staticmethod
-    def time_out(employee_id, photo_path, purpose='clock_out', official_overtime_approved=False, official_overtime_code=None):
-        conn = get_db()
-        cursor = get_cursor(conn)
-        manila_now = get_manila_now()
-        today = manila_now.strftime('%Y-%m-%d')
-        now = manila_now
-        
-        cursor.execute('SELECT * FROM attendance WHERE employee_id = %s AND time_out IS NULL ORDER BY id DESC LIMIT 1', (employee_id,))
-        open_record = cursor.fetchone()
-        
-        if not open_record:
-            conn.close()
-            return None, "No open attendance record. Please clock in first."
-        
-        record_date = str(open_record['date'])
-        
-        cursor.execute('SELECT end_time FROM employees WHERE id = %s', (employee_id,))
-        emp_schedule = cursor.fetchone()
-        work_end_raw = emp_schedule['end_time'] if emp_schedule and emp_schedule['end_time'] else '17:00'
-        # Handle TIME type from database
-        work_end = str(work_end_raw)[:5] if work_end_raw else '17:00'
-        
-        undertime_minutes = 0
-        official_overtime_minutes = 0
-        is_official_overtime_approved = False
-        requires_admin_review = False
-        admin_review_reason = None
-        
-        clock_out_date = now.strftime('%Y-%m-%d')
-        
-        if purpose == 'clock_out' or purpose == 'unapproved_undertime_out':
-            cursor.execute('SELECT start_time FROM employees WHERE id = %s', (employee_id,))
-            start_schedule = cursor.fetchone()
-            work_start_raw = start_schedule['start_time'] if start_schedule and start_schedule['start_time'] else '08:00'
-            # Handle TIME type from database
-            work_start = str(work_start_raw)[:5] if work_start_raw else '08:00'
-            
-            work_end_time = datetime.strptime(f"{record_date} {work_end}", "%Y-%m-%d %H:%M")
-            work_end_time = MANILA_TZ.localize(work_end_time)
-            
-            work_start_hour = int(work_start.split(':')[0])
-            work_end_hour = int(work_end.split(':')[0])
-            is_night_shift = work_end_hour < work_start_hour
-            
-            if is_night_shift:
-                work_end_time = work_end_time + timedelta(days=1)
-            
-            if clock_out_date > record_date and not official_overtime_approved and not is_night_shift:
-                requires_admin_review = True
-                admin_review_reason = "Next-day clock-out without overtime approval"
-            elif now >= work_end_time:
-                if official_overtime_approved:
-                    diff = now - work_end_time
-                    official_overtime_minutes = int(diff.total_seconds() / 60)
-                    is_official_overtime_approved = True
-            else:
-                diff = work_end_time - now
-                undertime_minutes = int(diff.total_seconds() / 60)
+    def time_out(employee_id, photo_path, purpose='clock_out', official_overtime_approved=False, official_overtime_code=None, cursor=None, now=None, idempotency_key=None):
+        """Record a clock-out; arguments and result as for time_in."""
+        manila_now = (now or get_manila_now()).astimezone(MANILA_TZ)
         
         # Map purpose values to database-allowed values
         purpose_mapping = {
@@ -885,17 +831,45 @@ class Attendance:
         }
         purpose_label = purpose_label_mapping.get(purpose, purpose.replace('_', ' ').title())
         
-        cursor.execute('''
-            UPDATE attendance 
-            SET time_out = %s, time_out_photo = %s, time_out_purpose = %s, time_out_purpose_label = %s, undertime_minutes = %s, 
-                official_overtime_approved = %s, official_overtime_minutes = %s,
-                requires_admin_review = %s, admin_review_reason = %s
-            WHERE id = %s
-        ''', (now.isoformat(), photo_path, db_purpose, purpose_label, undertime_minutes, is_official_overtime_approved, 
-              official_overtime_minutes, requires_admin_review, admin_review_reason, open_record['id']))
+        conn = None
+        if cursor is None:
+            conn = get_db()
+            cursor = get_cursor(conn)
+        # Undertime, overtime and next-day review only apply to end-of-shift clock-outs
+        cursor.execute(Attendance.TIME_OUT_SQL, {
+            'employee_id': employee_id,
+            'today': manila_now.strftime('%Y-%m-%d'),
+            'now': manila_now.isoformat(),
+            'photo_path': photo_path,
+            'purpose': db_purpose,
+            'purpose_label': purpose_label,
+            'check_schedule': purpose in ('clock_out', 'unapproved_undertime_out'),
+            'official_overtime_approved': bool(official_overtime_approved),
+            'idempotency_key': idempotency_key,
+        })
+        result = cursor.fetchone()
+        if not result and idempotency_key:
+            # A concurrent submission with the same key closed the record first
+            cursor.execute('SELECT id, TRUE AS replayed FROM attendance WHERE time_out_key = %s', (idempotency_key,))
+            result = cursor.fetchone()
+        if conn:
+            conn.commit()
+            conn.close()
+        if not result:
+            return None, "No open attendance record. Please clock in first.", False
+        return result['id'], f"{purpose.replace('_', ' ').title()} recorded successfully", result['replayed']
+    
+    @staticmethod
+    def resolve_photo(record_id, column, pending_ref, photo_path):
+        """Replace a punch's pending photo reference with the stored photo path (None clears it)."""
+        if column not in ('time_in_photo', 'time_out_photo'):
+            raise ValueError(f"Not a photo column: {column}")
+        conn = get_db()
+        cursor = get_cursor(conn)
+        cursor.execute(f'UPDATE attendance SET {column} = %s WHERE id = %s AND {column} = %s',
+                       (photo_path, record_id, pending_ref))
         conn.commit()
         conn.close()
-        return open_record['id'], f"{purpose.replace('_', ' ').title()} recorded successfully"
     
     @staticmethod
     def get_today_status(employee_id):
@@ -937,7 +911,11 @@ class Attendance:
             UPDATE attendance 
             SET is_overtime_approved = 1, overtime_hours = %s
             WHERE id = %s
+            RETURNING employee_id, date
         ''', (hours, attendance_id))
+        updated = cursor.fetchone()
+        if updated:
+            PayrollDirtyMark.mark_dates(cursor, updated['employee_id'], [updated['date']])
         conn.commit()
         conn.close()
     
@@ -949,6 +927,7 @@ class Attendance:
         record = cursor.fetchone()
         if record:
             cursor.execute('DELETE FROM attendance WHERE id = %s', (attendance_id,))
+            PayrollDirtyMark.mark_dates(cursor, record['employee_id'], [record['date']])
             conn.commit()
         conn.close()
         return record
@@ -967,6 +946,79 @@ class Attendance:
         conn.close()
         return record
 
+class KioskPunch:
+    """
+    Punches a kiosk queued while it could not reach the server, replayed in
+    batches. Each carries an id the kiosk generated; its outcome is kept in
+    kiosk_punches so a replayed punch returns the stored result instead of
+    punching again.
+    """
+    
+    @staticmethod
+    def record_batch(punches):
+        """
+        Record queued punches in one transaction, in the order given. Each
+        dict has client_id, employee_id, action, purpose, punched_at (aware
+        datetime), photo_path and the approval fields time_in and time_out
+        take; the caller has already checked each punch's PIN token.
+
+        Returns {client_id: result dict} with success, message, attendance_id
+        and duplicate. A punch that raises is rolled back alone and left out
+        of the results, so the kiosk sends it again later.
+        """
+        results = {}
+        conn = get_db()
+        cursor = get_cursor(conn)
+        cursor.execute('SELECT id FROM employees WHERE id = ANY(%s)',
+                       (list({p['employee_id'] for p in punches}),))
+        known = {row['id'] for row in cursor.fetchall()}
+        for punch in punches:
+            client_id = punch['client_id']
+            if punch['employee_id'] not in known:
+                results[client_id] = {'success': False, 'message': 'Unknown employee', 'attendance_id': None, 'duplicate': False}
+                continue
+            cursor.execute('SAVEPOINT kiosk_punch')
+            try:
+                cursor.execute('''
+                    INSERT INTO kiosk_punches (client_id, employee_id, action, purpose, punched_at)
+                    VALUES (%s, %s, %s, %s, %s)
+                    ON CONFLICT (client_id) DO NOTHING
+                    RETURNING client_id
+                ''', (client_id, punch['employee_id'], punch['action'], punch['purpose'], punch['punched_at']))
+                if not cursor.fetchone():
+                    cursor.execute('SELECT success, message, attendance_id FROM kiosk_punches WHERE client_id = %s', (client_id,))
+                    results[client_id] = dict(cursor.fetchone(), duplicate=True)
+                    cursor.execute('RELEASE SAVEPOINT kiosk_punch')
+                    continue
+                
+                record_id = None
+                replayed = False
+                # The client id doubles as the idempotency key, so a punch the
+                # server recorded before the kiosk gave up on it is not repeated
+                if punch['action'] == 'time_in':
+                    record_id, message, replayed = Attendance.time_in(
+                        punch['employee_id'], punch['photo_path'], punch['purpose'],
+                        punch['early_start_approved'], is_remote_field=punch['is_remote_field'],
+                        remote_field_hours=punch['remote_field_hours'], cursor=cursor, now=punch['punched_at'],
+                        idempotency_key=client_id)
+                else:
+                    record_id, message, replayed = Attendance.time_out(
+                        punch['employee_id'], punch['photo_path'], punch['purpose'],
+                        punch['official_overtime_approved'], cursor=cursor, now=punch['punched_at'],
+                        idempotency_key=client_id)
+                cursor.execute('''
+                    UPDATE kiosk_punches SET attendance_id = %s, success = %s, message = %s WHERE client_id = %s
+                ''', (record_id, record_id is not None, message, client_id))
+                cursor.execute('RELEASE SAVEPOINT kiosk_punch')
+                results[client_id] = {'success': record_id is not None, 'message': message,
+                                      'attendance_id': record_id, 'duplicate': replayed}
+            except psycopg2.Error:
+                cursor.execute('ROLLBACK TO SAVEPOINT kiosk_punch')
+                logger.exception(f"Queued punch {client_id} was not recorded")
+        conn.commit()
+        conn.close()
+        return results
+
 class AdminAuthCode:
     @staticmethod
     def create(code, code_type, description=None, uses_remaining=-1, valid_until=None, created_by=None, allowable_hours=0):
@@ -1319,232 +1371,489 @@ class PayrollPeriod:
     
     @staticmethod
     def lock(period_id):
+        """
+        Lock a period. Takes the same advisory lock as generate_for_period,
+        so a period is never locked halfway through a run; raises
+        PayrollInProgress if one is running.
+        """
         conn = get_db()
         cursor = get_cursor(conn)
-        cursor.execute('UPDATE payroll_periods SET is_locked = 1 WHERE id = %s', (period_id,))
+        cursor.execute('SELECT pg_try_advisory_xact_lock(%s, %s) AS acquired', (PAYROLL_LOCK_NAMESPACE, period_id))
+        if not cursor.fetchone()['acquired']:
+            conn.close()
+            raise PayrollInProgress(f"Payroll for period {period_id} is being generated")
+        cursor.execute('UPDATE payroll_periods SET is_locked = 1 WHERE id = %s RETURNING start_date', (period_id,))
+        locked = cursor.fetchone()
+        cursor.execute('DELETE FROM payroll_dirty_marks WHERE payroll_period_id = %s', (period_id,))
+        if locked:
+            PayrollRecord.refresh_yearly_totals(cursor, [locked['start_date'].year])
         conn.commit()
         conn.close()
 
+class PayrollDirtyMark:
+    """
+    Employee/dates whose payroll inputs changed, recorded against each
+    unlocked period that covers them. Writers pass their own cursor so the
+    mark commits with the change; generate_for_period consumes the marks.
+    """
+    
+    @staticmethod
+    def mark_dates(cursor, employee_id, dates):
+        cursor.execute('''
+            INSERT INTO payroll_dirty_marks (payroll_period_id, employee_id, work_date)
+            SELECT p.id, %s, d.work_date
+            FROM unnest(%s::date[]) AS d(work_date)
+            JOIN payroll_periods p ON d.work_date BETWEEN p.start_date AND p.end_date
+            WHERE COALESCE(p.is_locked::int, 0) = 0
+            ON CONFLICT DO NOTHING
+        ''', (employee_id, [str(d)[:10] for d in dates]))
+    
+    @staticmethod
+    def mark_from(cursor, employee_id, from_date=None):
+        """Mark every unlocked period date on or after from_date (all of them if None)."""
+        cursor.execute('''
+            INSERT INTO payroll_dirty_marks (payroll_period_id, employee_id, work_date)
+            SELECT p.id, %s, d::date
+            FROM payroll_periods p
+            CROSS JOIN LATERAL generate_series(GREATEST(p.start_date, %s::date), p.end_date, interval '1 day') AS d
+            WHERE COALESCE(p.is_locked::int, 0) = 0
+            ON CONFLICT DO NOTHING
+        ''', (employee_id, str(from_date)[:10] if from_date else None))
+
 class PayrollRecord:
     @staticmethod
-    def generate_for_period(period_id):
+    def generate_for_period(period_id, workers=None, progress=None, full=False, dry_run=False):
+        """
+        (Re)build the payroll records of a period.
+
+        Only employees with dirty marks for the period (attendance, rate or
+        schedule changes since the last run) and active employees without a
+        record are recomputed; records of employees who are no longer active
+        are removed. full=True, or a period with no records yet, recomputes
+        everyone. Recomputed records are diffed against the stored ones and
+        only those that differ are upserted, so unchanged rows are not
+        rewritten.
+
+        dry_run=True recomputes everyone without writing anything (dirty marks
+        are left in place) and returns the diff from diff_records().
+
+        Attendance is read in one ordered scan, records are computed in memory
+        (across `workers` processes, default PAYROLL_WORKERS) and written back
+        in batches inside a single transaction. A transaction-level advisory
+        lock keyed on the period makes concurrent runs for the same period
+        fail fast with PayrollInProgress. `progress(done, total, message)` is
+        called as employees are computed.
+        """
         conn = get_db()
         cursor = get_cursor(conn)
         
+        if not dry_run:
+            cursor.execute('SELECT pg_try_advisory_xact_lock(%s, %s) AS acquired', (PAYROLL_LOCK_NAMESPACE, period_id))
+            if not cursor.fetchone()['acquired']:
+                conn.close()
+                raise PayrollInProgress(f"Payroll for period {period_id} is already being generated")
+        
         cursor.execute('SELECT * FROM payroll_periods WHERE id = %s', (period_id,))
         period = cursor.fetchone()
         if not period:
             conn.close()
             return None
-        
-        cursor.execute('DELETE FROM payroll_records WHERE payroll_period_id = %s', (period_id,))
-        
-        employees = Employee.get_all()
+        if period['is_locked'] and not dry_run:
+            # Locked while this run waited for its turn
+            conn.close()
+            raise ValueError("Payroll period is locked")
         
         cursor.execute("SELECT value FROM settings WHERE key = 'work_hours'")
         default_work_hours = float(cursor.fetchone()['value'])
         
-        for emp in employees:
+        # Look up deduction IDs by name to avoid hardcoded ID assumptions
+        deduction_map = {}
+        cursor.execute("SELECT id, name FROM statutory_deductions WHERE name IN ('SSS', 'PhilHealth', 'Pag-IBIG')")
+        for row in cursor.fetchall():
+            deduction_map[row['name']] = row['id']
+        
+        dirty = set()
+        if not dry_run:
+            # Consume the marks before reading any inputs: a change committed
+            # after this point leaves a fresh mark behind for the next run.
+            cursor.execute('DELETE FROM payroll_dirty_marks WHERE payroll_period_id = %s RETURNING employee_id', (period_id,))
+            dirty = {row['employee_id'] for row in cursor.fetchall()}
+        stored = PayrollRecord._load_stored(cursor, period_id)
+        
+        employees = Employee.get_all(projection='payroll')
+        active_ids = {emp['id'] for emp in employees}
+        if stored and not full and not dry_run:
+            employees = [emp for emp in employees if emp['id'] in dirty or emp['id'] not in stored]
+        
+        cursor.execute('''
+            SELECT * FROM attendance 
+            WHERE date BETWEEN %s AND %s AND employee_id = ANY(%s)
+            ORDER BY employee_id, date, time_in
+        ''', (period['start_date'], period['end_date'], [emp['id'] for emp in employees]))
+        attendance_by_employee = {}
+        for att in cursor.fetchall():
+            attendance_by_employee.setdefault(att['employee_id'], []).append(att)
+        
+        computed = PayrollRecord.compute_for_employees(employees, attendance_by_employee, period, default_work_hours, workers, progress)
+        diff = PayrollRecord.diff_records(stored, computed, employees, active_ids)
+        if dry_run:
+            conn.close()
+            return diff
+        
+        if progress:
+            progress(len(employees), len(employees), f'Saving {len(diff)} changed records')
+        changed_ids = {entry['employee_id'] for entry in diff if entry['status'] != 'removed'}
+        removed_record_ids = [stored[entry['employee_id']]['id'] for entry in diff if entry['status'] == 'removed']
+        replaced_record_ids = removed_record_ids + [stored[emp_id]['id'] for emp_id in changed_ids if emp_id in stored]
+        if replaced_record_ids:
+            cursor.execute('DELETE FROM payroll_deduction_items WHERE payroll_record_id = ANY(%s)', (replaced_record_ids,))
+        if removed_record_ids:
+            cursor.execute('DELETE FROM payroll_records WHERE id = ANY(%s)', (removed_record_ids,))
+        PayrollRecord._upsert_records(cursor, period_id, [rec for rec in computed if rec['employee_id'] in changed_ids], deduction_map)
+        if diff:
+            PayrollRecord.refresh_yearly_totals(cursor, [period['start_date'].year])
+        
+        conn.commit()
+        conn.close()
+        return True
+    
+    @staticmethod
+    def _load_stored(cursor, period_id):
+        """Stored records of a period keyed by employee id, each with a 'deductions' list."""
+        cursor.execute('''
+            SELECT pr.*, e.first_name, e.last_name, e.employee_id as emp_code
+            FROM payroll_records pr
+            JOIN employees e ON pr.employee_id = e.id
+            WHERE pr.payroll_period_id = %s
+        ''', (period_id,))
+        stored = {}
+        for row in cursor.fetchall():
+            stored[row['employee_id']] = dict(row, deductions=[])
+        if stored:
+            by_record = {rec['id']: rec for rec in stored.values()}
             cursor.execute('''
-                SELECT * FROM attendance 
-                WHERE employee_id = %s AND date BETWEEN %s AND %s
-                ORDER BY date, time_in
-            ''', (emp['id'], period['start_date'], period['end_date']))
-            attendance_records = cursor.fetchall()
-            
-            daily_rate = emp['daily_rate']
-            
-            emp_start = emp['start_time'] if emp['start_time'] else '08:00'
-            emp_end = emp['end_time'] if emp['end_time'] else '17:00'
-            try:
-                start_dt = datetime.strptime(emp_start, '%H:%M')
-                end_dt = datetime.strptime(emp_end, '%H:%M')
-                emp_work_hours = (end_dt - start_dt).total_seconds() / 3600
-                if emp_work_hours <= 0:
-                    emp_work_hours = default_work_hours
-            except:
+                SELECT payroll_record_id, deduction_name, employee_amount, employer_amount
+                FROM payroll_deduction_items WHERE payroll_record_id = ANY(%s)
+                ORDER BY id
+            ''', (list(by_record),))
+            for item in cursor.fetchall():
+                by_record[item['payroll_record_id']]['deductions'].append(
+                    (item['deduction_name'], item['employee_amount'], item['employer_amount']))
+        return stored
+    
+    @staticmethod
+    def diff_records(stored, computed, employees, active_ids):
+        """
+        Compare freshly computed records with stored ones.
+
+        Returns one entry per employee whose payroll would change:
+        {'employee_id', 'name', 'emp_code', 'status', 'changes'} where status
+        is 'added', 'changed' or 'removed' and changes is a list of
+        {'field', 'old', 'new'}. Amounts within half a centavo are equal
+        (payroll_records columns are single-precision REAL).
+        """
+        names = {emp['id']: emp for emp in employees}
+        diff = []
+        for rec in computed:
+            emp = names[rec['employee_id']]
+            old = stored.get(rec['employee_id'])
+            changes = []
+            for field in PAYROLL_DIFF_FIELDS:
+                old_value = old[field] if old else None
+                if old_value is None or abs(float(old_value) - float(rec[field])) >= 0.005:
+                    changes.append({'field': field, 'old': old_value, 'new': rec[field]})
+            old_deductions = {name: (ee, er) for name, ee, er in (old['deductions'] if old else [])}
+            for name, ee, er in rec['deductions']:
+                old_ee, old_er = old_deductions.get(name, (None, None))
+                for label, old_value, new_value in ((f'{name} (employee)', old_ee, ee), (f'{name} (employer)', old_er, er)):
+                    if old_value is None or abs(float(old_value) - float(new_value)) >= 0.005:
+                        changes.append({'field': label, 'old': old_value, 'new': new_value})
+            if changes:
+                diff.append({
+                    'employee_id': rec['employee_id'],
+                    'name': f"{emp['first_name']} {emp['last_name']}",
+                    'emp_code': emp['employee_id'],
+                    'status': 'changed' if old else 'added',
+                    'changes': changes
+                })
+        for emp_id, old in stored.items():
+            if emp_id not in active_ids:
+                diff.append({
+                    'employee_id': emp_id,
+                    'name': f"{old['first_name']} {old['last_name']}",
+                    'emp_code': old['emp_code'],
+                    'status': 'removed',
+                    'changes': [{'field': 'net_pay', 'old': old['net_pay'], 'new': None}]
+                })
+        return diff
+    
+    @staticmethod
+    def compute_for_employees(employees, attendance_by_employee, period, default_work_hours, workers=None, progress=None):
+        """
+        Compute payroll for many employees, optionally sharded across a process pool.
+
+        Output is in the order of `employees` whichever path runs, so the
+        parallel result is identical to the serial one.
+        """
+        workers = PAYROLL_WORKERS if workers is None else workers
+        total = len(employees)
+        if workers <= 1 or total < PAYROLL_PARALLEL_MIN_EMPLOYEES:
+            computed = []
+            for emp in employees:
+                computed.append(PayrollRecord.compute_employee_payroll(emp, attendance_by_employee.get(emp['id'], []), period, default_work_hours))
+                if progress and (len(computed) % 25 == 0 or len(computed) == total):
+                    progress(len(computed), total, 'Computing payroll')
+            return computed
+        
+        from concurrent.futures import ProcessPoolExecutor, as_completed
+        
+        shards = {}
+        for emp in employees:
+            if PAYROLL_SHARD_BY == 'hash':
+                key = emp['id'] % workers
+            else:
+                key = emp.get('branch_id')
+            # Plain dicts so rows pickle cheaply into the worker processes
+            shards.setdefault(key, []).append((dict(emp), [dict(att) for att in attendance_by_employee.get(emp['id'], [])]))
+        
+        by_employee = {}
+        with ProcessPoolExecutor(max_workers=min(workers, len(shards))) as pool:
+            futures = [pool.submit(_compute_payroll_shard, shard, dict(period), default_work_hours) for shard in shards.values()]
+            for future in as_completed(futures):
+                for rec in future.result():
+                    by_employee[rec['employee_id']] = rec
+                if progress:
+                    progress(len(by_employee), total, 'Computing payroll')
+        return [by_employee[emp['id']] for emp in employees]
+    
+    @staticmethod
+    def _upsert_records(cursor, period_id, computed, deduction_map):
+        """
+        Bulk-upsert computed records and insert their deduction items; returns
+        {employee_id: record_id}. The caller clears the records' old items.
+        """
+        if not computed:
+            return {}
+        inserted = execute_values(cursor, '''
+            INSERT INTO payroll_records 
+            (payroll_period_id, employee_id, locked_daily_rate, days_worked, regular_pay, 
+             overtime_pay, holiday_pay, tardiness_deduction, undertime_deduction, gross_pay, 
+             total_deductions, net_pay)
+            VALUES %s
+            ON CONFLICT (payroll_period_id, employee_id) DO UPDATE SET
+                locked_daily_rate = EXCLUDED.locked_daily_rate, days_worked = EXCLUDED.days_worked,
+                regular_pay = EXCLUDED.regular_pay, overtime_pay = EXCLUDED.overtime_pay,
+                holiday_pay = EXCLUDED.holiday_pay, tardiness_deduction = EXCLUDED.tardiness_deduction,
+                undertime_deduction = EXCLUDED.undertime_deduction, gross_pay = EXCLUDED.gross_pay,
+                total_deductions = EXCLUDED.total_deductions, net_pay = EXCLUDED.net_pay,
+                payslip_sha256 = NULL, payslip_template_version = NULL
+            RETURNING id, employee_id
+        ''', [
+            (period_id, rec['employee_id'], rec['locked_daily_rate'], rec['days_worked'], rec['regular_pay'],
+             rec['overtime_pay'], rec['holiday_pay'], rec['tardiness_deduction'], rec['undertime_deduction'],
+             rec['gross_pay'], rec['total_deductions'], rec['net_pay'])
+            for rec in computed
+        ], page_size=1000, fetch=True)
+        record_ids = {row['employee_id']: row['id'] for row in inserted}
+        
+        item_rows = []
+        for rec in computed:
+            for ded_name, ee_amt, er_amt in rec['deductions']:
+                ded_id = deduction_map.get(ded_name)
+                if ded_id is not None:
+                    item_rows.append((record_ids[rec['employee_id']], ded_id, ded_name, ee_amt, er_amt))
+        if item_rows:
+            execute_values(cursor, '''
+                INSERT INTO payroll_deduction_items 
+                (payroll_record_id, deduction_id, deduction_name, employee_amount, employer_amount)
+                VALUES %s
+            ''', item_rows, page_size=1000)
+        return record_ids
+    
+    @staticmethod
+    def compute_employee_payroll(emp, attendance_records, period, default_work_hours):
+        """
+        Pure payroll computation for one employee over a period.
+
+        attendance_records must be the employee's rows for the period ordered by
+        date, time_in. Returns the payroll_records column values plus a
+        'deductions' list of (name, employee_amount, employer_amount).
+        """
+        from pdf_payslip import calculate_sss_contribution, calculate_philhealth_contribution, calculate_pagibig_contribution
+        
+        daily_rate = emp['daily_rate']
+        
+        emp_start = emp['start_time'] if emp['start_time'] else '08:00'
+        emp_end = emp['end_time'] if emp['end_time'] else '17:00'
+        try:
+            start_dt = datetime.strptime(emp_start, '%H:%M')
+            end_dt = datetime.strptime(emp_end, '%H:%M')
+            emp_work_hours = (end_dt - start_dt).total_seconds() / 3600
+            if emp_work_hours <= 0:
                 emp_work_hours = default_work_hours
-            
-            hourly_rate = daily_rate / emp_work_hours
-            minute_rate = hourly_rate / 60
-            
-            daily_data = {}
-            emp_work_minutes = emp_work_hours * 60
-            
-            for att in attendance_records:
-                if att['time_in'] and att['time_out']:
-                    att_date = str(att['date'])
-                    requires_review = att.get('requires_admin_review', 0)
-                    
-                    if att_date not in daily_data:
-                        daily_data[att_date] = {
-                            'tardiness': 0,
-                            'undertime': 0,
-                            'overtime_minutes': 0,
-                            'early_start_minutes': 0,
-                            'is_holiday': False,
-                            'holiday_type': None,
-                            'has_clock_in': False,
-                            'has_clock_out': False,
-                            'actual_work_minutes': 0,
-                            'requires_admin_review': False
-                        }
-                    
-                    if requires_review:
-                        daily_data[att_date]['requires_admin_review'] = True
-                    
-                    in_purpose = att['time_in_purpose'] or 'clock_in'
-                    out_purpose = att['time_out_purpose'] or 'clock_out'
-                    
-                    try:
-                        time_in_str = str(att['time_in'])
-                        time_out_str = str(att['time_out'])
-                        
-                        if 'T' in time_in_str:
-                            time_in = datetime.fromisoformat(time_in_str)
-                        else:
-                            time_in = datetime.strptime(time_in_str, '%Y-%m-%d %H:%M:%S')
-                        
-                        if 'T' in time_out_str:
-                            time_out = datetime.fromisoformat(time_out_str)
-                        else:
-                            time_out = datetime.strptime(time_out_str, '%Y-%m-%d %H:%M:%S')
-                        
-                        if time_out < time_in:
-                            segment_minutes = ((24 * 60) - (time_in.hour * 60 + time_in.minute)) + (time_out.hour * 60 + time_out.minute)
-                        else:
-                            segment_minutes = (time_out - time_in).total_seconds() / 60
-                        daily_data[att_date]['actual_work_minutes'] += segment_minutes
-                    except Exception as e:
-                        pass
-                    
-                    if in_purpose == 'clock_in' or in_purpose == 'early_start':
-                        daily_data[att_date]['tardiness'] = att['tardiness_minutes'] or 0
-                        daily_data[att_date]['has_clock_in'] = True
-                        if att['early_start_approved']:
-                            daily_data[att_date]['early_start_minutes'] += att['early_start_minutes'] or 0
-                    
-                    if out_purpose == 'clock_out' or out_purpose == 'unapproved_undertime_out' or out_purpose == 'official_overtime':
-                        daily_data[att_date]['undertime'] = att['undertime_minutes'] or 0
-                        daily_data[att_date]['has_clock_out'] = True
-                        if att['official_overtime_approved']:
-                            daily_data[att_date]['overtime_minutes'] += att['official_overtime_minutes'] or 0
-                    
-                    if att['is_holiday']:
-                        daily_data[att_date]['is_holiday'] = True
-                        daily_data[att_date]['holiday_type'] = att['holiday_type']
-            
-            total_actual_hours = 0
-            total_tardiness = 0
-            total_undertime = 0
-            total_overtime_minutes = 0
-            total_early_start_minutes = 0
-            holiday_pay = 0
-            days_with_attendance = 0
-            
-            for att_date, data in daily_data.items():
-                if data['has_clock_in']:
-                    days_with_attendance += 1
-                    actual_minutes = data['actual_work_minutes']
+        except:
+            emp_work_hours = default_work_hours
+        
+        hourly_rate = daily_rate / emp_work_hours
+        minute_rate = hourly_rate / 60
+        
+        daily_data = {}
+        emp_work_minutes = emp_work_hours * 60
+        
+        for att in attendance_records:
+            if att['time_in'] and att['time_out']:
+                att_date = str(att['date'])
+                requires_review = att.get('requires_admin_review', 0)
+                
+                if att_date not in daily_data:
+                    daily_data[att_date] = {
+                        'tardiness': 0,
+                        'undertime': 0,
+                        'overtime_minutes': 0,
+                        'early_start_minutes': 0,
+                        'is_holiday': False,
+                        'holiday_type': None,
+                        'has_clock_in': False,
+                        'has_clock_out': False,
+                        'actual_work_minutes': 0,
+                        'requires_admin_review': False
+                    }
+                
+                if requires_review:
+                    daily_data[att_date]['requires_admin_review'] = True
+                
+                in_purpose = att['time_in_purpose'] or 'clock_in'
+                out_purpose = att['time_out_purpose'] or 'clock_out'
+                
+                try:
+                    time_in_str = str(att['time_in'])
+                    time_out_str = str(att['time_out'])
                     
-                    actual_hours_today = min(actual_minutes, emp_work_minutes) / 60
-                    total_actual_hours += actual_hours_today
+                    if 'T' in time_in_str:
+                        time_in = datetime.fromisoformat(time_in_str)
+                    else:
+                        time_in = datetime.strptime(time_in_str, '%Y-%m-%d %H:%M:%S')
                     
-                    if not data.get('requires_admin_review', False):
-                        if actual_minutes < emp_work_minutes:
-                            missing_minutes = emp_work_minutes - actual_minutes
-                            total_undertime += missing_minutes
-                        
-                        total_tardiness += data['tardiness']
+                    if 'T' in time_out_str:
+                        time_out = datetime.fromisoformat(time_out_str)
+                    else:
+                        time_out = datetime.strptime(time_out_str, '%Y-%m-%d %H:%M:%S')
                     
-                    total_overtime_minutes += data['overtime_minutes']
-                    total_early_start_minutes += data['early_start_minutes']
+                    if time_out < time_in:
+                        segment_minutes = ((24 * 60) - (time_in.hour * 60 + time_in.minute)) + (time_out.hour * 60 + time_out.minute)
+                    else:
+                        segment_minutes = (time_out - time_in).total_seconds() / 60
+                    daily_data[att_date]['actual_work_minutes'] += segment_minutes
+                except Exception as e:
+                    pass
+                
+                if in_purpose == 'clock_in' or in_purpose == 'early_start':
+                    daily_data[att_date]['tardiness'] = att['tardiness_minutes'] or 0
+                    daily_data[att_date]['has_clock_in'] = True
+                    if att['early_start_approved']:
+                        daily_data[att_date]['early_start_minutes'] += att['early_start_minutes'] or 0
+                
+                if out_purpose == 'clock_out' or out_purpose == 'unapproved_undertime_out' or out_purpose == 'official_overtime':
+                    daily_data[att_date]['undertime'] = att['undertime_minutes'] or 0
+                    daily_data[att_date]['has_clock_out'] = True
+                    if att['official_overtime_approved']:
+                        daily_data[att_date]['overtime_minutes'] += att['official_overtime_minutes'] or 0
+                
+                if att['is_holiday']:
+                    daily_data[att_date]['is_holiday'] = True
+                    daily_data[att_date]['holiday_type'] = att['holiday_type']
+        
+        total_actual_hours = 0
+        total_tardiness = 0
+        total_undertime = 0
+        total_overtime_minutes = 0
+        total_early_start_minutes = 0
+        holiday_pay = 0
+        days_with_attendance = 0
+        
+        for att_date, data in daily_data.items():
+            if data['has_clock_in']:
+                days_with_attendance += 1
+                actual_minutes = data['actual_work_minutes']
+                
+                actual_hours_today = min(actual_minutes, emp_work_minutes) / 60
+                total_actual_hours += actual_hours_today
+                
+                if not data.get('requires_admin_review', False):
+                    if actual_minutes < emp_work_minutes:
+                        missing_minutes = emp_work_minutes - actual_minutes
+                        total_undertime += missing_minutes
                     
-                    if data['is_holiday']:
-                        if data['holiday_type'] == 'regular':
-                            holiday_pay += daily_rate * 1.0
-                        elif data['holiday_type'] == 'special':
-                            holiday_pay += daily_rate * 0.3
-            
-            days_worked = round(total_actual_hours / emp_work_hours, 2) if emp_work_hours > 0 else 0
-            regular_pay = total_actual_hours * hourly_rate
-            overtime_hours = total_overtime_minutes / 60
-            overtime_pay = overtime_hours * hourly_rate * 1.25
-            early_start_pay = (total_early_start_minutes / 60) * hourly_rate
-            tardiness_deduction = total_tardiness * minute_rate
-            undertime_deduction = total_undertime * minute_rate
-            
-            gross_pay = regular_pay + overtime_pay + early_start_pay + holiday_pay
-            
-            from pdf_payslip import calculate_sss_contribution, calculate_philhealth_contribution, calculate_pagibig_contribution
-            
-            monthly_basic_salary = daily_rate * 21.75
-            
-            sss_ee_monthly, sss_er_monthly = calculate_sss_contribution(monthly_basic_salary)
-            philhealth_ee_monthly, philhealth_er_monthly = calculate_philhealth_contribution(monthly_basic_salary)
-            pagibig_ee_monthly, pagibig_er_monthly = calculate_pagibig_contribution(monthly_basic_salary)
-            
-            period_start = datetime.strptime(str(period['start_date']), '%Y-%m-%d')
-            period_end = datetime.strptime(str(period['end_date']), '%Y-%m-%d')
-            period_days = (period_end - period_start).days + 1
-            
-            if period_days >= 28:
-                proration_factor = 1.0
-            elif period_days >= 14:
-                proration_factor = 0.5
-            else:
-                proration_factor = 0.0
-            
-            sss_ee = round(sss_ee_monthly * proration_factor, 2)
-            sss_er = round(sss_er_monthly * proration_factor, 2)
-            philhealth_ee = round(philhealth_ee_monthly * proration_factor, 2)
-            philhealth_er = round(philhealth_er_monthly * proration_factor, 2)
-            pagibig_ee = round(pagibig_ee_monthly * proration_factor, 2)
-            pagibig_er = round(pagibig_er_monthly * proration_factor, 2)
-            
-            total_deductions = sss_ee + philhealth_ee + pagibig_ee
-            
-            cursor.execute('''
-                INSERT INTO payroll_records 
-                (payroll_period_id, employee_id, locked_daily_rate, days_worked, regular_pay, 
-                 overtime_pay, holiday_pay, tardiness_deduction, undertime_deduction, gross_pay, 
-                 total_deductions, net_pay)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                RETURNING id
-            ''', (period_id, emp['id'], daily_rate, days_worked, regular_pay, overtime_pay, 
-                  holiday_pay, tardiness_deduction, undertime_deduction, gross_pay, 0, gross_pay))
-            payroll_record_id = cursor.fetchone()['id']
-            
-            # Look up deduction IDs by name to avoid hardcoded ID assumptions
-            deduction_map = {}
-            cursor.execute("SELECT id, name FROM statutory_deductions WHERE name IN ('SSS', 'PhilHealth', 'Pag-IBIG')")
-            for row in cursor.fetchall():
-                deduction_map[row['name']] = row['id']
-
-            for ded_name, ee_amt, er_amt in [
+                    total_tardiness += data['tardiness']
+                
+                total_overtime_minutes += data['overtime_minutes']
+                total_early_start_minutes += data['early_start_minutes']
+                
+                if data['is_holiday']:
+                    if data['holiday_type'] == 'regular':
+                        holiday_pay += daily_rate * 1.0
+                    elif data['holiday_type'] == 'special':
+                        holiday_pay += daily_rate * 0.3
+        
+        days_worked = round(total_actual_hours / emp_work_hours, 2) if emp_work_hours > 0 else 0
+        regular_pay = total_actual_hours * hourly_rate
+        overtime_hours = total_overtime_minutes / 60
+        overtime_pay = overtime_hours * hourly_rate * 1.25
+        early_start_pay = (total_early_start_minutes / 60) * hourly_rate
+        tardiness_deduction = total_tardiness * minute_rate
+        undertime_deduction = total_undertime * minute_rate
+        
+        gross_pay = regular_pay + overtime_pay + early_start_pay + holiday_pay
+        
+        monthly_basic_salary = daily_rate * 21.75
+        
+        sss_ee_monthly, sss_er_monthly = calculate_sss_contribution(monthly_basic_salary)
+        philhealth_ee_monthly, philhealth_er_monthly = calculate_philhealth_contribution(monthly_basic_salary)
+        pagibig_ee_monthly, pagibig_er_monthly = calculate_pagibig_contribution(monthly_basic_salary)
+        
+        period_start = datetime.strptime(str(period['start_date']), '%Y-%m-%d')
+        period_end = datetime.strptime(str(period['end_date']), '%Y-%m-%d')
+        period_days = (period_end - period_start).days + 1
+        
+        if period_days >= 28:
+            proration_factor = 1.0
+        elif period_days >= 14:
+            proration_factor = 0.5
+        else:
+            proration_factor = 0.0
+        
+        sss_ee = round(sss_ee_monthly * proration_factor, 2)
+        sss_er = round(sss_er_monthly * proration_factor, 2)
+        philhealth_ee = round(philhealth_ee_monthly * proration_factor, 2)
+        philhealth_er = round(philhealth_er_monthly * proration_factor, 2)
+        pagibig_ee = round(pagibig_ee_monthly * proration_factor, 2)
+        pagibig_er = round(pagibig_er_monthly * proration_factor, 2)
+        
+        total_deductions = sss_ee + philhealth_ee + pagibig_ee
+        net_pay = gross_pay - total_deductions
+        
+        return {
+            'employee_id': emp['id'],
+            'locked_daily_rate': daily_rate,
+            'days_worked': days_worked,
+            'regular_pay': regular_pay,
+            'overtime_pay': overtime_pay,
+            'holiday_pay': holiday_pay,
+            'tardiness_deduction': tardiness_deduction,
+            'undertime_deduction': undertime_deduction,
+            'gross_pay': gross_pay,
+            'total_deductions': total_deductions,
+            'net_pay': net_pay,
+            'deductions': [
                 ('SSS', sss_ee, sss_er),
                 ('PhilHealth', philhealth_ee, philhealth_er),
                 ('Pag-IBIG', pagibig_ee, pagibig_er),
-            ]:
-                ded_id = deduction_map.get(ded_name)
-                if ded_id is not None:
-                    cursor.execute('''
-                        INSERT INTO payroll_deduction_items 
-                        (payroll_record_id, deduction_id, deduction_name, employee_amount, employer_amount)
-                        VALUES (%s, %s, %s, %s, %s)
-                    ''', (payroll_record_id, ded_id, ded_name, ee_amt, er_amt))
-            
-            net_pay = gross_pay - total_deductions
-            cursor.execute('''
-                UPDATE payroll_records SET total_deductions = %s, net_pay = %s WHERE id = %s
-            ''', (total_deductions, net_pay, payroll_record_id))
-        
-        conn.commit()
-        conn.close()
-        return True
+            ],
+        }
     
     @staticmethod
-    def get_by_period(period_id):
+    def get_by_period(period_id, with_deductions=False):
+        """Records of a period; with_deductions attaches each record's items as 'deductions'."""
         conn = get_db()
         cursor = get_cursor(conn)
         cursor.execute('''
@@ -1555,51 +1864,195 @@ class PayrollRecord:
             ORDER BY e.last_name, e.first_name
         ''', (period_id,))
         records = cursor.fetchall()
+        if with_deductions:
+            items = PayrollRecord._deduction_items_for_period(cursor, period_id)
+            for record in records:
+                record['deductions'] = items.get(record['id'], [])
         conn.close()
         return records
     
     @staticmethod
-    def get_deduction_items(record_id):
+    def _deduction_items_for_period(cursor, period_id):
+        cursor.execute('''
+            SELECT di.*
+            FROM payroll_deduction_items di
+            JOIN payroll_records pr ON di.payroll_record_id = pr.id
+            WHERE pr.payroll_period_id = %s
+            ORDER BY di.payroll_record_id, di.id
+        ''', (period_id,))
+        items = {}
+        for item in cursor.fetchall():
+            items.setdefault(item['payroll_record_id'], []).append(item)
+        return items
+    
+    @staticmethod
+    def get_payslip_inputs(period_id=None, record_id=None):
+        """
+        Everything generate_payslip_pdf() needs for one record or a whole period,
+        in three queries. Returns plain dicts (picklable for worker processes)
+        with record_id, filename, payroll_data, employee_data, period_data and
+        deductions, ordered by employee name.
+        """
+        conn = get_db()
+        cursor = get_cursor(conn)
+        cursor.execute(f'''
+            SELECT pr.*, e.first_name, e.last_name, e.employee_id as emp_code,
+                   e.position, b.name as branch_name
+            FROM payroll_records pr
+            JOIN employees e ON pr.employee_id = e.id
+            LEFT JOIN branches b ON e.branch_id = b.id
+            WHERE {'pr.id' if record_id is not None else 'pr.payroll_period_id'} = %s
+            ORDER BY e.last_name, e.first_name
+        ''', (record_id if record_id is not None else period_id,))
+        records = cursor.fetchall()
+        if not records:
+            conn.close()
+            return []
+        
+        cursor.execute('SELECT * FROM payroll_periods WHERE id = ANY(%s)',
+                       (list({r['payroll_period_id'] for r in records}),))
+        periods = {p['id']: p for p in cursor.fetchall()}
+        cursor.execute('SELECT * FROM payroll_deduction_items WHERE payroll_record_id = ANY(%s) ORDER BY id',
+                       ([r['id'] for r in records],))
+        deductions = {}
+        for item in cursor.fetchall():
+            deductions.setdefault(item['payroll_record_id'], []).append(dict(item))
+        conn.close()
+        
+        payslips = []
+        for record in records:
+            period = periods[record['payroll_period_id']]
+            payslips.append({
+                'record_id': record['id'],
+                'filename': PayrollRecord.payslip_filename(record['first_name'], record['last_name'], period['name']),
+                'payroll_data': {
+                    'locked_daily_rate': record['locked_daily_rate'],
+                    'days_worked': record['days_worked'],
+                    'regular_pay': record['regular_pay'],
+                    'overtime_pay': record['overtime_pay'],
+                    'holiday_pay': record['holiday_pay'],
+                    'tardiness_deduction': record['tardiness_deduction'],
+                    'undertime_deduction': record['undertime_deduction'],
+                    'gross_pay': record['gross_pay'],
+                    'total_deductions': record['total_deductions'],
+                    'net_pay': record['net_pay']
+                },
+                'employee_data': {
+                    'first_name': record['first_name'],
+                    'last_name': record['last_name'],
+                    'employee_id': record['emp_code'],
+                    'position': record['position'],
+                    'branch_name': record['branch_name']
+                },
+                'period_data': {
+                    'name': period['name'],
+                    'start_date': period['start_date'],
+                    'end_date': period['end_date']
+                },
+                'deductions': deductions.get(record['id'], [])
+            })
+        return payslips
+    
+    @staticmethod
+    def payslip_filename(first_name, last_name, period_name):
+        return f"Payslip_{first_name}_{last_name}_{period_name.replace(' ', '_')}.pdf"
+    
+    @staticmethod
+    def get_payslip_cache_entry(record_id):
+        """
+        One-query lookup for serving a cached payslip: the record's stored
+        payslip_sha256 and the template version it was rendered with, whether
+        its period is locked, and its download filename.
+        """
         conn = get_db()
         cursor = get_cursor(conn)
         cursor.execute('''
-            SELECT * FROM payroll_deduction_items WHERE payroll_record_id = %s
+            SELECT pr.id, pr.payslip_sha256, pr.payslip_template_version, COALESCE(p.is_locked::int, 0) = 1 AS is_locked,
+                   e.first_name, e.last_name, p.name AS period_name
+            FROM payroll_records pr
+            JOIN payroll_periods p ON pr.payroll_period_id = p.id
+            JOIN employees e ON pr.employee_id = e.id
+            WHERE pr.id = %s
         ''', (record_id,))
-        items = cursor.fetchall()
+        row = cursor.fetchone()
         conn.close()
-        return items
+        if not row:
+            return None
+        entry = dict(row)
+        entry['filename'] = PayrollRecord.payslip_filename(row['first_name'], row['last_name'], row['period_name'])
+        return entry
+    
+    @staticmethod
+    def set_payslip_hashes(hashes, template_version):
+        """Record the cache keys of payslips rendered with template_version: [(record_id, sha256), ...]."""
+        if not hashes:
+            return
+        conn = get_db()
+        cursor = get_cursor(conn)
+        execute_values(cursor, '''
+            UPDATE payroll_records pr SET payslip_sha256 = v.sha, payslip_template_version = v.version
+            FROM (VALUES %s) AS v(id, sha, version)
+            WHERE pr.id = v.id
+        ''', [(record_id, sha, template_version) for record_id, sha in hashes], page_size=1000)
+        conn.commit()
+        conn.close()
+    
+    @staticmethod
+    def refresh_yearly_totals(cursor, years):
+        """
+        Rebuild payroll_yearly_totals for the given calendar years in the
+        caller's transaction. Runs for different periods of one year (two
+        generations, or a generation and a lock) take turns on a per-year
+        advisory lock, so each rebuild sees the records the other committed.
+        """
+        years = sorted({int(y) for y in years})
+        for year in years:
+            cursor.execute('SELECT pg_advisory_xact_lock(%s, %s)', (PAYROLL_TOTALS_LOCK_NAMESPACE, year))
+        cursor.execute('''
+            INSERT INTO payroll_yearly_totals (year, employee_id, total_basic, period_count)
+            SELECT y.year, pr.employee_id, SUM(pr.regular_pay), COUNT(*)
+            FROM unnest(%s::int[]) AS y(year)
+            JOIN payroll_periods pp
+              ON pp.start_date >= make_date(y.year, 1, 1) AND pp.start_date < make_date(y.year + 1, 1, 1)
+            JOIN payroll_records pr ON pr.payroll_period_id = pp.id
+            GROUP BY y.year, pr.employee_id
+            ON CONFLICT (year, employee_id) DO UPDATE
+            SET total_basic = EXCLUDED.total_basic, period_count = EXCLUDED.period_count,
+                updated_at = CURRENT_TIMESTAMP
+        ''', (years,))
+        cursor.execute('''
+            DELETE FROM payroll_yearly_totals t
+            WHERE t.year = ANY(%s) AND NOT EXISTS (
+                SELECT 1 FROM payroll_records pr
+                JOIN payroll_periods pp ON pp.id = pr.payroll_period_id
+                WHERE pr.employee_id = t.employee_id
+                  AND pp.start_date >= make_date(t.year, 1, 1) AND pp.start_date < make_date(t.year + 1, 1, 1)
+            )
+        ''', (years,))
     
     @staticmethod
     def get_13th_month(year):
         conn = get_db()
         cursor = get_cursor(conn)
-        
-        employees = Employee.get_all(include_resigned=True)
-        results = []
-        
-        for emp in employees:
-            cursor.execute('''
-                SELECT SUM(regular_pay) as total_basic
-                FROM payroll_records pr
-                JOIN payroll_periods pp ON pr.payroll_period_id = pp.id
-                WHERE pr.employee_id = %s 
-                AND EXTRACT(YEAR FROM pp.start_date) = %s
-            ''', (emp['id'], int(year)))
-            
-            result = cursor.fetchone()
-            total_basic = result['total_basic'] if result['total_basic'] else 0
-            thirteenth_month = total_basic / 12
-            
-            results.append({
-                'employee_id': emp['employee_id'],
-                'name': f"{emp['first_name']} {emp['last_name']}",
-                'total_basic': total_basic,
-                'thirteenth_month': thirteenth_month
-            })
-        
+        cursor.execute('''
+            SELECT e.employee_id, e.first_name, e.last_name, COALESCE(t.total_basic, 0) AS total_basic
+            FROM employees e
+            LEFT JOIN payroll_yearly_totals t ON t.employee_id = e.id AND t.year = %s
+            ORDER BY e.last_name, e.first_name
+        ''', (int(year),))
+        results = [{
+            'employee_id': row['employee_id'],
+            'name': f"{row['first_name']} {row['last_name']}",
+            'total_basic': row['total_basic'],
+            'thirteenth_month': row['total_basic'] / 12
+        } for row in cursor.fetchall()]
         conn.close()
         return results
 
+def _compute_payroll_shard(shard, period, default_work_hours):
+    """Process-pool entry point: compute one shard of (employee, attendance) pairs."""
+    return [PayrollRecord.compute_employee_payroll(emp, records, period, default_work_hours) for emp, records in shard]
+
 class Admin:
     @staticmethod
     def get_by_username(username):
@@ -1724,6 +2177,8 @@ class DatabaseManager:
         cursor.execute('DELETE FROM payroll_deduction_items')
         cursor.execute('DELETE FROM payroll_records')
         cursor.execute('DELETE FROM payroll_periods')
+        cursor.execute('DELETE FROM background_jobs')
+        cursor.execute('DELETE FROM kiosk_punches')
         cursor.execute('DELETE FROM attendance')
         cursor.execute('DELETE FROM employee_schedules')
         cursor.execute('DELETE FROM employees')
@@ -1832,6 +2287,7 @@ class EmployeeSchedule:
             ))
             
             result = cursor.fetchone()
+            PayrollDirtyMark.mark_from(cursor, employee_id, effective_from)
             conn.commit()
             conn.close()
             return result['id']
@@ -1940,3 +2396,155 @@ class EmployeeSchedule:
         schedules = cursor.fetchall()
         conn.close()
         return schedules
+
+
+class BackgroundJob:
+    """Rows of the background_jobs queue; jobs.py runs them."""
+    
+    @staticmethod
+    def enqueue(job_type, payload, dedupe_key=None, created_by=None):
+        """
+        Queue a job and return (job_id, created).
+
+        While a job with the same type and dedupe_key is queued or running no
+        new one is added; its id is returned with created=False instead.
+        """
+        conn = get_db()
+        cursor = get_cursor(conn)
+        cursor.execute('''
+            INSERT INTO background_jobs (job_type, dedupe_key, payload, created_by)
+            VALUES (%s, %s, %s, %s)
+            ON CONFLICT (job_type, dedupe_key) WHERE status IN ('queued', 'running') DO NOTHING
+            RETURNING id
+        ''', (job_type, dedupe_key, Json(payload), created_by))
+        row = cursor.fetchone()
+        created = row is not None
+        if not created:
+            cursor.execute('''
+                SELECT id FROM background_jobs
+                WHERE job_type = %s AND dedupe_key = %s AND status IN ('queued', 'running')
+            ''', (job_type, dedupe_key))
+            row = cursor.fetchone()
+        conn.commit()
+        conn.close()
+        return (row['id'] if row else None), created
+    
+    @staticmethod
+    def get_by_id(job_id):
+        conn = get_db()
+        cursor = get_cursor(conn)
+        cursor.execute('SELECT * FROM background_jobs WHERE id = %s', (job_id,))
+        job = cursor.fetchone()
+        conn.close()
+        return job
+    
+    @staticmethod
+    def get_active(job_type, dedupe_key):
+        conn = get_db()
+        cursor = get_cursor(conn)
+        cursor.execute('''
+            SELECT * FROM background_jobs
+            WHERE job_type = %s AND dedupe_key = %s AND status IN ('queued', 'running')
+        ''', (job_type, dedupe_key))
+        job = cursor.fetchone()
+        conn.close()
+        return job
+    
+    @staticmethod
+    def get_latest(job_type, dedupe_key):
+        conn = get_db()
+        cursor = get_cursor(conn)
+        cursor.execute('''
+            SELECT * FROM background_jobs
+            WHERE job_type = %s AND dedupe_key = %s
+            ORDER BY id DESC LIMIT 1
+        ''', (job_type, dedupe_key))
+        job = cursor.fetchone()
+        conn.close()
+        return job
+    
+    @staticmethod
+    def claim_next():
+        """
+        Atomically take the oldest runnable job, or return None.
+
+        SKIP LOCKED lets concurrent workers pass over rows another worker is
+        claiming. Running jobs whose heartbeat went stale (worker died) are
+        picked up again until they have used JOB_MAX_ATTEMPTS.
+        """
+        conn = get_db()
+        cursor = get_cursor(conn)
+        cursor.execute('''
+            UPDATE background_jobs
+            SET status = 'failed', error = 'Worker stopped responding', finished_at = CURRENT_TIMESTAMP
+            WHERE status = 'running' AND attempts >= %s
+              AND heartbeat_at < CURRENT_TIMESTAMP - make_interval(secs => %s)
+        ''', (JOB_MAX_ATTEMPTS, JOB_STALE_SECONDS))
+        cursor.execute('''
+            UPDATE background_jobs
+            SET status = 'running', attempts = attempts + 1, error = NULL,
+                started_at = CURRENT_TIMESTAMP, heartbeat_at = CURRENT_TIMESTAMP
+            WHERE id = (
+                SELECT id FROM background_jobs
+                WHERE status = 'queued'
+                   OR (status = 'running' AND attempts < %s
+                       AND heartbeat_at < CURRENT_TIMESTAMP - make_interval(secs => %s))
+                ORDER BY id
+                FOR UPDATE SKIP LOCKED
+                LIMIT 1
+            )
+            RETURNING *
+        ''', (JOB_MAX_ATTEMPTS, JOB_STALE_SECONDS))
+        job = cursor.fetchone()
+        conn.commit()
+        conn.close()
+        return job
+    
+    @staticmethod
+    def update_progress(job_id, done, total, message=None):
+        conn = get_db()
+        cursor = get_cursor(conn)
+        cursor.execute('''
+            UPDATE background_jobs
+            SET progress = %s, progress_total = %s, message = COALESCE(%s, message),
+                heartbeat_at = CURRENT_TIMESTAMP
+            WHERE id = %s
+        ''', (done, total, message, job_id))
+        conn.commit()
+        conn.close()
+    
+    @staticmethod
+    def heartbeat(job_id):
+        conn = get_db()
+        cursor = get_cursor(conn)
+        cursor.execute('''
+            UPDATE background_jobs SET heartbeat_at = CURRENT_TIMESTAMP
+            WHERE id = %s AND status = 'running'
+        ''', (job_id,))
+        conn.commit()
+        conn.close()
+    
+    @staticmethod
+    def finish(job_id, result=None):
+        conn = get_db()
+        cursor = get_cursor(conn)
+        cursor.execute('''
+            UPDATE background_jobs
+            SET status = 'succeeded', result = %s, progress = GREATEST(progress, progress_total),
+                finished_at = CURRENT_TIMESTAMP
+            WHERE id = %s
+        ''', (Json(result) if result is not None else None, job_id))
+        conn.commit()
+        conn.close()
+    
+    @staticmethod
+    def fail(job_id, error):
+        conn = get_db()
+        cursor = get_cursor(conn)
+        cursor.execute('''
+            UPDATE background_jobs
+            SET status = 'failed', error = %s, finished_at = CURRENT_TIMESTAMP
+            WHERE id = %s
+        ''', (error, job_id))
+        conn.commit()
+        conn.close()
@@ -0,0 +1,61 @@
+"""
+Content-addressed disk cache of rendered payslip PDFs.
+
+Payslips of locked payroll periods never change, so they are rendered once
+(pre-rendered by a background job when the period is locked) and then served
+straight from disk. Files are named by cache_key(): a SHA-256 of the record
+id, the exact payslip inputs and PAYSLIP_TEMPLATE_VERSION, so a rewritten
+record or a template change can never be answered with a stale file. The
+key stored on a record goes with the template version it was rendered with;
+readers treat a key from another version as a miss.
+"""
+import os
+import json
+import hashlib
+import tempfile
+
+from pdf_payslip import PAYSLIP_TEMPLATE_VERSION
+
+CACHE_DIR = os.environ.get('PAYSLIP_CACHE_DIR',
+                           os.path.join(os.path.dirname(os.path.abspath(__file__)), 'payslip_cache'))
+
+DEDUCTION_FIELDS = ('deduction_name', 'employee_amount', 'employer_amount')
+
+
+def cache_key(payslip):
+    """SHA-256 over a PayrollRecord.get_payslip_inputs() entry and the template version."""
+    material = json.dumps([
+        payslip['record_id'],
+        payslip['payroll_data'],
+        payslip['employee_data'],
+        payslip['period_data'],
+        [{field: item[field] for field in DEDUCTION_FIELDS} for item in payslip['deductions']],
+        PAYSLIP_TEMPLATE_VERSION,
+    ], sort_keys=True, default=str)
+    return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+
+def path_for(key):
+    return os.path.join(CACHE_DIR, key[:2], f'{key}.pdf')
+
+
+def get(key):
+    """Path of the cached PDF for key, or None."""
+    path = path_for(key)
+    return path if os.path.exists(path) else None
+
+
+def put(key, pdf_bytes):
+    """Store a rendered PDF atomically; returns its path."""
+    path = path_for(key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, partial = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(pdf_bytes)
+        os.replace(partial, path)
+    except BaseException:
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+    return path
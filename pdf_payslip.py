@@ -1,17 +1,36 @@
 from reportlab.lib.pagesizes import A4
 from reportlab.lib.units import inch, cm
 from reportlab.lib.colors import HexColor, black, white
-from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer, Image
+from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer, PageBreak, Flowable
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.lib.enums import TA_LEFT, TA_RIGHT, TA_CENTER
+from reportlab.lib.utils import ImageReader
+from PIL import Image
 from io import BytesIO
 import os
+import tempfile
+import zipfile
 
 TEAL_COLOR = HexColor('#0d9488')
 CORAL_COLOR = HexColor('#f87171')
 LIGHT_GRAY = HexColor('#f3f4f6')
 DARK_GRAY = HexColor('#374151')
 
+LOGO_PATHS = ['static/3dbotics_logo.png', 'static/logo.png', 'attached_assets/3DBotics_LOGO_new_1766017505888.png']
+
+# Part of every payslip cache key (payslip_cache.py); bump whenever the
+# rendered output changes so cached PDFs are not served for the old layout
+PAYSLIP_TEMPLATE_VERSION = '2'
+
+LOGO_SIZE = 1.8*inch
+# Resolution the logo is pre-scaled to before it is embedded
+LOGO_DPI = 200
+
+# Worker processes used to render many payslips at once (bulk export)
+PAYSLIP_WORKERS = int(os.environ.get('PAYSLIP_WORKERS', str(min(4, os.cpu_count() or 1))))
+# Below this many payslips rendering inline is cheaper than starting a pool
+PAYSLIP_PARALLEL_MIN = 8
+
 def calculate_sss_contribution(monthly_salary):
     """
     2025 SSS Contribution Calculation (Bracket-based)
@@ -172,29 +191,7 @@ def calculate_all_contributions(monthly_salary):
     }
 
 
-def generate_payslip_pdf(payroll_data, employee_data, period_data, deductions):
-    """
-    Generate a professional PDF payslip with 3DBotics branding.
-    
-    Args:
-        payroll_data: dict with payroll record info (locked_daily_rate, days_worked, etc.)
-        employee_data: dict with employee info (name, position, etc.)
-        period_data: dict with period info (name, start_date, end_date)
-        deductions: list of deduction items
-    
-    Returns:
-        BytesIO buffer containing the PDF
-    """
-    buffer = BytesIO()
-    doc = SimpleDocTemplate(
-        buffer,
-        pagesize=A4,
-        rightMargin=0.5*inch,
-        leftMargin=0.5*inch,
-        topMargin=0.5*inch,
-        bottomMargin=0.5*inch
-    )
-    
+def _payslip_styles():
     styles = getSampleStyleSheet()
     
     title_style = ParagraphStyle(
@@ -242,29 +239,6 @@ def generate_payslip_pdf(payroll_data, employee_data, period_data, deductions):
         fontName='Helvetica-Bold'
     )
     
-    elements = []
-    
-    logo_paths = ['static/3dbotics_logo.png', 'static/logo.png', 'attached_assets/3DBotics_LOGO_new_1766017505888.png']
-    logo_loaded = False
-    for logo_path in logo_paths:
-        if os.path.exists(logo_path):
-            try:
-                logo = Image(logo_path, width=1.8*inch, height=1.8*inch)
-                logo.hAlign = 'CENTER'
-                elements.append(logo)
-                logo_loaded = True
-                break
-            except:
-                continue
-    
-    if not logo_loaded:
-        elements.append(Spacer(1, 0.5*inch))
-    
-    elements.append(Paragraph("3DBotics\u00ae", title_style))
-    elements.append(Paragraph("3D Printing | AI | Robotics", subtitle_style))
-    
-    elements.append(Spacer(1, 0.1*inch))
-    
     payslip_title = ParagraphStyle(
         'PayslipTitle',
         parent=styles['Heading1'],
@@ -273,147 +247,6 @@ def generate_payslip_pdf(payroll_data, employee_data, period_data, deductions):
         alignment=TA_CENTER,
         spaceAfter=10
     )
-    elements.append(Paragraph("PAYSLIP", payslip_title))
-    elements.append(Paragraph(f"Pay Period: {period_data['name']}", subtitle_style))
-    elements.append(Paragraph(f"{period_data['start_date']} to {period_data['end_date']}", subtitle_style))
-    
-    elements.append(Spacer(1, 0.2*inch))
-    
-    emp_info = [
-        ['Employee Name:', f"{employee_data.get('first_name', '')} {employee_data.get('last_name', '')}", 
-         'Employee ID:', employee_data.get('employee_id', '')],
-        ['Position:', employee_data.get('position', 'N/A'), 
-         'Branch:', employee_data.get('branch_name', 'N/A')],
-        ['Daily Rate:', f"P{payroll_data['locked_daily_rate']:,.2f}", 
-         'Days Worked:', f"{payroll_data['days_worked']:.2f}"],
-    ]
-    
-    emp_table = Table(emp_info, colWidths=[1.3*inch, 2.2*inch, 1.3*inch, 2.2*inch])
-    emp_table.setStyle(TableStyle([
-        ('FONTNAME', (0, 0), (0, -1), 'Helvetica-Bold'),
-        ('FONTNAME', (2, 0), (2, -1), 'Helvetica-Bold'),
-        ('FONTSIZE', (0, 0), (-1, -1), 9),
-        ('TEXTCOLOR', (0, 0), (-1, -1), DARK_GRAY),
-        ('BACKGROUND', (0, 0), (-1, -1), LIGHT_GRAY),
-        ('BOTTOMPADDING', (0, 0), (-1, -1), 8),
-        ('TOPPADDING', (0, 0), (-1, -1), 8),
-        ('LEFTPADDING', (0, 0), (-1, -1), 8),
-        ('GRID', (0, 0), (-1, -1), 0.5, HexColor('#d1d5db')),
-    ]))
-    elements.append(emp_table)
-    
-    elements.append(Spacer(1, 0.3*inch))
-    
-    regular_pay = payroll_data.get('regular_pay', 0)
-    overtime_pay = payroll_data.get('overtime_pay', 0)
-    holiday_pay = payroll_data.get('holiday_pay', 0)
-    gross_pay = payroll_data.get('gross_pay', 0)
-    
-    tardiness_ded = payroll_data.get('tardiness_deduction', 0)
-    undertime_ded = payroll_data.get('undertime_deduction', 0)
-    
-    sss_ee = 0
-    philhealth_ee = 0
-    pagibig_ee = 0
-    sss_er = 0
-    philhealth_er = 0
-    pagibig_er = 0
-    
-    for ded in deductions:
-        name = ded['deduction_name'].upper()
-        if 'SSS' in name:
-            sss_ee = ded['employee_amount']
-            sss_er = ded['employer_amount']
-        elif 'PHILHEALTH' in name or 'PHIL' in name:
-            philhealth_ee = ded['employee_amount']
-            philhealth_er = ded['employer_amount']
-        elif 'PAG' in name or 'IBIG' in name:
-            pagibig_ee = ded['employee_amount']
-            pagibig_er = ded['employer_amount']
-    
-    total_statutory_ee = sss_ee + philhealth_ee + pagibig_ee
-    total_deductions = total_statutory_ee + tardiness_ded + undertime_ded
-    net_pay = gross_pay - total_deductions
-    
-    earnings_data = [
-        ['EARNINGS', 'Amount'],
-        ['Basic Pay (Regular)', f"P{regular_pay:,.2f}"],
-        ['Overtime Pay', f"P{overtime_pay:,.2f}"],
-        ['Holiday Pay', f"P{holiday_pay:,.2f}"],
-        ['', ''],
-        ['GROSS PAY', f"P{gross_pay:,.2f}"],
-    ]
-    
-    deductions_data = [
-        ['DEDUCTIONS', 'Amount'],
-        ['SSS (EE Share)', f"P{sss_ee:,.2f}"],
-        ['PhilHealth (EE Share)', f"P{philhealth_ee:,.2f}"],
-        ['Pag-IBIG (EE Share)', f"P{pagibig_ee:,.2f}"],
-        ['Tardiness', f"P{tardiness_ded:,.2f}"],
-        ['TOTAL DEDUCTIONS', f"P{total_deductions:,.2f}"],
-    ]
-    
-    col_width = 3.4*inch
-    
-    earnings_table = Table(earnings_data, colWidths=[col_width*0.6, col_width*0.4])
-    earnings_table.setStyle(TableStyle([
-        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-        ('FONTNAME', (0, -1), (-1, -1), 'Helvetica-Bold'),
-        ('FONTSIZE', (0, 0), (-1, -1), 9),
-        ('BACKGROUND', (0, 0), (-1, 0), TEAL_COLOR),
-        ('TEXTCOLOR', (0, 0), (-1, 0), white),
-        ('BACKGROUND', (0, -1), (-1, -1), HexColor('#d1fae5')),
-        ('ALIGN', (1, 0), (1, -1), 'RIGHT'),
-        ('BOTTOMPADDING', (0, 0), (-1, -1), 6),
-        ('TOPPADDING', (0, 0), (-1, -1), 6),
-        ('LEFTPADDING', (0, 0), (-1, -1), 8),
-        ('GRID', (0, 0), (-1, -1), 0.5, HexColor('#d1d5db')),
-    ]))
-    
-    deductions_table = Table(deductions_data, colWidths=[col_width*0.6, col_width*0.4])
-    deductions_table.setStyle(TableStyle([
-        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-        ('FONTNAME', (0, -1), (-1, -1), 'Helvetica-Bold'),
-        ('FONTSIZE', (0, 0), (-1, -1), 9),
-        ('BACKGROUND', (0, 0), (-1, 0), CORAL_COLOR),
-        ('TEXTCOLOR', (0, 0), (-1, 0), white),
-        ('BACKGROUND', (0, -1), (-1, -1), HexColor('#fee2e2')),
-        ('ALIGN', (1, 0), (1, -1), 'RIGHT'),
-        ('BOTTOMPADDING', (0, 0), (-1, -1), 6),
-        ('TOPPADDING', (0, 0), (-1, -1), 6),
-        ('LEFTPADDING', (0, 0), (-1, -1), 8),
-        ('GRID', (0, 0), (-1, -1), 0.5, HexColor('#d1d5db')),
-    ]))
-    
-    two_column_table = Table([[earnings_table, deductions_table]], colWidths=[col_width, col_width])
-    two_column_table.setStyle(TableStyle([
-        ('VALIGN', (0, 0), (-1, -1), 'TOP'),
-        ('LEFTPADDING', (0, 0), (-1, -1), 0),
-        ('RIGHTPADDING', (0, 0), (-1, -1), 0),
-    ]))
-    elements.append(two_column_table)
-    
-    elements.append(Spacer(1, 0.3*inch))
-    
-    net_pay_table = Table([
-        ['NET PAY', f"P{net_pay:,.2f}"]
-    ], colWidths=[5*inch, 2*inch])
-    net_pay_table.setStyle(TableStyle([
-        ('FONTNAME', (0, 0), (-1, -1), 'Helvetica-Bold'),
-        ('FONTSIZE', (0, 0), (-1, -1), 14),
-        ('BACKGROUND', (0, 0), (-1, -1), TEAL_COLOR),
-        ('TEXTCOLOR', (0, 0), (-1, -1), white),
-        ('ALIGN', (1, 0), (1, 0), 'RIGHT'),
-        ('BOTTOMPADDING', (0, 0), (-1, -1), 12),
-        ('TOPPADDING', (0, 0), (-1, -1), 12),
-        ('LEFTPADDING', (0, 0), (-1, -1), 12),
-        ('RIGHTPADDING', (0, 0), (-1, -1), 12),
-    ]))
-    elements.append(net_pay_table)
-    
-    elements.append(Spacer(1, 0.4*inch))
-    
-    total_employer = sss_er + philhealth_er + pagibig_er
     
     company_title = ParagraphStyle(
         'CompanyTitle',
@@ -425,7 +258,6 @@ def generate_payslip_pdf(payroll_data, employee_data, period_data, deductions):
         spaceAfter=8,
         alignment=TA_CENTER
     )
-    elements.append(Paragraph("COMPANY CONTRIBUTIONS", company_title))
     
     company_subtitle = ParagraphStyle(
         'CompanySubtitle',
@@ -435,33 +267,6 @@ def generate_payslip_pdf(payroll_data, employee_data, period_data, deductions):
         alignment=TA_CENTER,
         spaceAfter=10
     )
-    elements.append(Paragraph("(Employer Share - Paid by Company, NOT Deducted from Employee)", company_subtitle))
-    
-    employer_data = [
-        ['Contribution Type', 'Amount'],
-        ['SSS (ER Share + EC)', f"P{sss_er:,.2f}"],
-        ['PhilHealth (ER Share)', f"P{philhealth_er:,.2f}"],
-        ['Pag-IBIG (ER Share)', f"P{pagibig_er:,.2f}"],
-        ['TOTAL COMPANY CONTRIBUTION', f"P{total_employer:,.2f}"],
-    ]
-    
-    employer_table = Table(employer_data, colWidths=[5*inch, 2*inch])
-    employer_table.setStyle(TableStyle([
-        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-        ('FONTNAME', (0, -1), (-1, -1), 'Helvetica-Bold'),
-        ('FONTSIZE', (0, 0), (-1, -1), 9),
-        ('BACKGROUND', (0, 0), (-1, 0), HexColor('#6366f1')),
-        ('TEXTCOLOR', (0, 0), (-1, 0), white),
-        ('BACKGROUND', (0, -1), (-1, -1), HexColor('#e0e7ff')),
-        ('ALIGN', (1, 0), (1, -1), 'RIGHT'),
-        ('BOTTOMPADDING', (0, 0), (-1, -1), 6),
-        ('TOPPADDING', (0, 0), (-1, -1), 6),
-        ('LEFTPADDING', (0, 0), (-1, -1), 8),
-        ('GRID', (0, 0), (-1, -1), 0.5, HexColor('#d1d5db')),
-    ]))
-    elements.append(employer_table)
-    
-    elements.append(Spacer(1, 0.5*inch))
     
     footer_style = ParagraphStyle(
         'Footer',
@@ -470,9 +275,450 @@ def generate_payslip_pdf(payroll_data, employee_data, period_data, deductions):
         textColor=HexColor('#9ca3af'),
         alignment=TA_CENTER
     )
-    elements.append(Paragraph("This is a computer-generated payslip. No signature required.", footer_style))
-    elements.append(Paragraph("For questions, please contact HR or Payroll Department.", footer_style))
     
-    doc.build(elements)
-    buffer.seek(0)
-    return buffer
+    return {
+        'title': title_style,
+        'subtitle': subtitle_style,
+        'section_header': section_header,
+        'normal': normal_style,
+        'bold': bold_style,
+        'payslip_title': payslip_title,
+        'company_title': company_title,
+        'company_subtitle': company_subtitle,
+        'footer': footer_style,
+    }
+
+
+def _payslip_table_styles():
+    grid = ('GRID', (0, 0), (-1, -1), 0.5, HexColor('#d1d5db'))
+    
+    def amount_table(header_color, total_color):
+        return TableStyle([
+            ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+            ('FONTNAME', (0, -1), (-1, -1), 'Helvetica-Bold'),
+            ('FONTSIZE', (0, 0), (-1, -1), 9),
+            ('BACKGROUND', (0, 0), (-1, 0), header_color),
+            ('TEXTCOLOR', (0, 0), (-1, 0), white),
+            ('BACKGROUND', (0, -1), (-1, -1), total_color),
+            ('ALIGN', (1, 0), (1, -1), 'RIGHT'),
+            ('BOTTOMPADDING', (0, 0), (-1, -1), 6),
+            ('TOPPADDING', (0, 0), (-1, -1), 6),
+            ('LEFTPADDING', (0, 0), (-1, -1), 8),
+            grid,
+        ])
+    
+    return {
+        'employee': TableStyle([
+            ('FONTNAME', (0, 0), (0, -1), 'Helvetica-Bold'),
+            ('FONTNAME', (2, 0), (2, -1), 'Helvetica-Bold'),
+            ('FONTSIZE', (0, 0), (-1, -1), 9),
+            ('TEXTCOLOR', (0, 0), (-1, -1), DARK_GRAY),
+            ('BACKGROUND', (0, 0), (-1, -1), LIGHT_GRAY),
+            ('BOTTOMPADDING', (0, 0), (-1, -1), 8),
+            ('TOPPADDING', (0, 0), (-1, -1), 8),
+            ('LEFTPADDING', (0, 0), (-1, -1), 8),
+            grid,
+        ]),
+        'earnings': amount_table(TEAL_COLOR, HexColor('#d1fae5')),
+        'deductions': amount_table(CORAL_COLOR, HexColor('#fee2e2')),
+        'two_column': TableStyle([
+            ('VALIGN', (0, 0), (-1, -1), 'TOP'),
+            ('LEFTPADDING', (0, 0), (-1, -1), 0),
+            ('RIGHTPADDING', (0, 0), (-1, -1), 0),
+        ]),
+        'net_pay': TableStyle([
+            ('FONTNAME', (0, 0), (-1, -1), 'Helvetica-Bold'),
+            ('FONTSIZE', (0, 0), (-1, -1), 14),
+            ('BACKGROUND', (0, 0), (-1, -1), TEAL_COLOR),
+            ('TEXTCOLOR', (0, 0), (-1, -1), white),
+            ('ALIGN', (1, 0), (1, 0), 'RIGHT'),
+            ('BOTTOMPADDING', (0, 0), (-1, -1), 12),
+            ('TOPPADDING', (0, 0), (-1, -1), 12),
+            ('LEFTPADDING', (0, 0), (-1, -1), 12),
+            ('RIGHTPADDING', (0, 0), (-1, -1), 12),
+        ]),
+        'employer': amount_table(HexColor('#6366f1'), HexColor('#e0e7ff')),
+    }
+
+
+def _prepare_logo():
+    """
+    The first readable logo, scaled down to LOGO_SIZE at LOGO_DPI, flattened
+    onto white and JPEG-encoded, or None. ReportLab embeds JPEG data as-is,
+    so documents no longer decode and re-compress the full-size PNG.
+    """
+    pixels = int(LOGO_SIZE / inch * LOGO_DPI)
+    for logo_path in LOGO_PATHS:
+        if not os.path.isabs(logo_path):
+            logo_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), logo_path)
+        try:
+            with Image.open(logo_path) as image:
+                image = image.convert('RGBA')
+        except (OSError, ValueError):
+            continue
+        image.thumbnail((pixels, pixels), Image.LANCZOS)
+        flat = Image.new('RGB', image.size, (255, 255, 255))
+        flat.paste(image, mask=image.getchannel('A'))
+        buffer = BytesIO()
+        flat.save(buffer, 'JPEG', quality=92)
+        return buffer.getvalue()
+    return None
+
+
+class _Logo(Flowable):
+    """
+    Logo drawn from prepared JPEG bytes. A fresh reader per draw keeps the
+    shared template thread-safe; ReportLab still embeds the image once per
+    document and references it from every later page.
+    """
+    
+    def __init__(self, data, width, height):
+        Flowable.__init__(self)
+        self.data = data
+        self.width = width
+        self.height = height
+        self.hAlign = 'CENTER'
+    
+    def wrap(self, availWidth, availHeight):
+        return self.width, self.height
+    
+    def draw(self):
+        self.canv.drawImage(ImageReader(BytesIO(self.data)), 0, 0, self.width, self.height)
+
+
+def _payslip_doc(output):
+    return SimpleDocTemplate(
+        output,
+        pagesize=A4,
+        rightMargin=0.5*inch,
+        leftMargin=0.5*inch,
+        topMargin=0.5*inch,
+        bottomMargin=0.5*inch
+    )
+
+
+class PayslipTemplate:
+    """
+    The parts of a payslip that do not depend on the employee: paragraph and
+    table styles and the prepared logo. Build it once per process with
+    get_payslip_template() and reuse it for every payslip.
+    """
+    
+    def __init__(self):
+        self.styles = _payslip_styles()
+        self.table_styles = _payslip_table_styles()
+        self.logo = _prepare_logo()
+    
+    def flowables(self, payroll_data, employee_data, period_data, deductions):
+        """The flowables of one payslip page."""
+        styles = self.styles
+        table_styles = self.table_styles
+        title_style = styles['title']
+        subtitle_style = styles['subtitle']
+        payslip_title = styles['payslip_title']
+        company_title = styles['company_title']
+        company_subtitle = styles['company_subtitle']
+        footer_style = styles['footer']
+    
+        elements = []
+    
+        if self.logo:
+            elements.append(_Logo(self.logo, LOGO_SIZE, LOGO_SIZE))
+        else:
+            elements.append(Spacer(1, 0.5*inch))
+    
+        elements.append(Paragraph("3DBotics\u00ae", title_style))
+        elements.append(Paragraph("3D Printing | AI | Robotics", subtitle_style))
+    
+        elements.append(Spacer(1, 0.1*inch))
+    
+        elements.append(Paragraph("PAYSLIP", payslip_title))
+        elements.append(Paragraph(f"Pay Period: {period_data['name']}", subtitle_style))
+        elements.append(Paragraph(f"{period_data['start_date']} to {period_data['end_date']}", subtitle_style))
+    
+        elements.append(Spacer(1, 0.2*inch))
+    
+        emp_info = [
+            ['Employee Name:', f"{employee_data.get('first_name', '')} {employee_data.get('last_name', '')}", 
+             'Employee ID:', employee_data.get('employee_id', '')],
+            ['Position:', employee_data.get('position', 'N/A'), 
+             'Branch:', employee_data.get('branch_name', 'N/A')],
+            ['Daily Rate:', f"P{payroll_data['locked_daily_rate']:,.2f}", 
+             'Days Worked:', f"{payroll_data['days_worked']:.2f}"],
+        ]
+    
+        emp_table = Table(emp_info, colWidths=[1.3*inch, 2.2*inch, 1.3*inch, 2.2*inch])
+        emp_table.setStyle(table_styles['employee'])
+        elements.append(emp_table)
+    
+        elements.append(Spacer(1, 0.3*inch))
+    
+        regular_pay = payroll_data.get('regular_pay', 0)
+        overtime_pay = payroll_data.get('overtime_pay', 0)
+        holiday_pay = payroll_data.get('holiday_pay', 0)
+        gross_pay = payroll_data.get('gross_pay', 0)
+    
+        tardiness_ded = payroll_data.get('tardiness_deduction', 0)
+        undertime_ded = payroll_data.get('undertime_deduction', 0)
+    
+        sss_ee = 0
+        philhealth_ee = 0
+        pagibig_ee = 0
+        sss_er = 0
+        philhealth_er = 0
+        pagibig_er = 0
+    
+        for ded in deductions:
+            name = ded['deduction_name'].upper()
+            if 'SSS' in name:
+                sss_ee = ded['employee_amount']
+                sss_er = ded['employer_amount']
+            elif 'PHILHEALTH' in name or 'PHIL' in name:
+                philhealth_ee = ded['employee_amount']
+                philhealth_er = ded['employer_amount']
+            elif 'PAG' in name or 'IBIG' in name:
+                pagibig_ee = ded['employee_amount']
+                pagibig_er = ded['employer_amount']
+    
+        total_statutory_ee = sss_ee + philhealth_ee + pagibig_ee
+        total_deductions = total_statutory_ee + tardiness_ded + undertime_ded
+        net_pay = gross_pay - total_deductions
+    
+        earnings_data = [
+            ['EARNINGS', 'Amount'],
+            ['Basic Pay (Regular)', f"P{regular_pay:,.2f}"],
+            ['Overtime Pay', f"P{overtime_pay:,.2f}"],
+            ['Holiday Pay', f"P{holiday_pay:,.2f}"],
+            ['', ''],
+            ['GROSS PAY', f"P{gross_pay:,.2f}"],
+        ]
+    
+        deductions_data = [
+            ['DEDUCTIONS', 'Amount'],
+            ['SSS (EE Share)', f"P{sss_ee:,.2f}"],
+            ['PhilHealth (EE Share)', f"P{philhealth_ee:,.2f}"],
+            ['Pag-IBIG (EE Share)', f"P{pagibig_ee:,.2f}"],
+            ['Tardiness', f"P{tardiness_ded:,.2f}"],
+            ['TOTAL DEDUCTIONS', f"P{total_deductions:,.2f}"],
+        ]
+    
+        col_width = 3.4*inch
+    
+        earnings_table = Table(earnings_data, colWidths=[col_width*0.6, col_width*0.4])
+        earnings_table.setStyle(table_styles['earnings'])
+    
+        deductions_table = Table(deductions_data, colWidths=[col_width*0.6, col_width*0.4])
+        deductions_table.setStyle(table_styles['deductions'])
+    
+        two_column_table = Table([[earnings_table, deductions_table]], colWidths=[col_width, col_width])
+        two_column_table.setStyle(table_styles['two_column'])
+        elements.append(two_column_table)
+    
+        elements.append(Spacer(1, 0.3*inch))
+    
+        net_pay_table = Table([
+            ['NET PAY', f"P{net_pay:,.2f}"]
+        ], colWidths=[5*inch, 2*inch])
+        net_pay_table.setStyle(table_styles['net_pay'])
+        elements.append(net_pay_table)
+    
+        elements.append(Spacer(1, 0.4*inch))
+    
+        total_employer = sss_er + philhealth_er + pagibig_er
+    
+        elements.append(Paragraph("COMPANY CONTRIBUTIONS", company_title))
+    
+        elements.append(Paragraph("(Employer Share - Paid by Company, NOT Deducted from Employee)", company_subtitle))
+    
+        employer_data = [
+            ['Contribution Type', 'Amount'],
+            ['SSS (ER Share + EC)', f"P{sss_er:,.2f}"],
+            ['PhilHealth (ER Share)', f"P{philhealth_er:,.2f}"],
+            ['Pag-IBIG (ER Share)', f"P{pagibig_er:,.2f}"],
+            ['TOTAL COMPANY CONTRIBUTION', f"P{total_employer:,.2f}"],
+        ]
+    
+        employer_table = Table(employer_data, colWidths=[5*inch, 2*inch])
+        employer_table.setStyle(table_styles['employer'])
+        elements.append(employer_table)
+    
+        elements.append(Spacer(1, 0.5*inch))
+    
+        elements.append(Paragraph("This is a computer-generated payslip. No signature required.", footer_style))
+        elements.append(Paragraph("For questions, please contact HR or Payroll Department.", footer_style))
+    
+        return elements
+    
+    def render(self, payroll_data, employee_data, period_data, deductions, output=None):
+        """Render one payslip into `output` (default: a new BytesIO); rewinds and returns it."""
+        if output is None:
+            output = BytesIO()
+        _payslip_doc(output).build(self.flowables(payroll_data, employee_data, period_data, deductions))
+        output.seek(0)
+        return output
+
+
+_template = None
+
+
+def get_payslip_template():
+    """This process's PayslipTemplate, built on first use."""
+    global _template
+    if _template is None:
+        _template = PayslipTemplate()
+    return _template
+
+
+def generate_payslip_pdf(payroll_data, employee_data, period_data, deductions):
+    """
+    Generate a professional PDF payslip with 3DBotics branding.
+    
+    Args:
+        payroll_data: dict with payroll record info (locked_daily_rate, days_worked, etc.)
+        employee_data: dict with employee info (name, position, etc.)
+        period_data: dict with period info (name, start_date, end_date)
+        deductions: list of deduction items
+    
+    Returns:
+        BytesIO buffer containing the PDF
+    """
+    return get_payslip_template().render(payroll_data, employee_data, period_data, deductions)
+
+
+class _RefillingFlowables(list):
+    """
+    Flowable list for doc.build() that pulls the next payslip's flowables only
+    when the current ones are nearly used up, so a long register never holds
+    every page's tables in memory at once. ReportLab still keeps each finished
+    page until the document is saved, so large registers are rendered by the
+    payslip_register job rather than in a request.
+    """
+    
+    def __init__(self, batches):
+        list.__init__(self)
+        self._batches = iter(batches)
+    
+    def __len__(self):
+        # Keep one flowable of lookahead for keepWithNext handling
+        while list.__len__(self) < 2:
+            batch = next(self._batches, None)
+            if batch is None:
+                break
+            self.extend(batch)
+        return list.__len__(self)
+
+
+def generate_period_payslips_pdf(payslips, output=None, progress=None):
+    """
+    Render many payslips (PayrollRecord.get_payslip_inputs() entries) into one
+    PDF, one employee per page. Styles are built once, the logo is embedded
+    once and referenced from every page, and each payslip's flowables are
+    built lazily as layout reaches it.
+
+    Writes to `output` (default: a temp file spooled to disk past 8 MB),
+    rewinds it and returns it. `progress(done, total)` is called as each
+    payslip is laid out.
+    """
+    if output is None:
+        output = tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024)
+    template = get_payslip_template()
+    
+    def batches():
+        for index, payslip in enumerate(payslips):
+            elements = template.flowables(payslip['payroll_data'], payslip['employee_data'],
+                                          payslip['period_data'], payslip['deductions'])
+            if index:
+                elements.insert(0, PageBreak())
+            if progress:
+                progress(index + 1, len(payslips))
+            yield elements
+    
+    doc = _payslip_doc(output)
+    if payslips:
+        doc.build(_RefillingFlowables(batches()))
+    else:
+        doc.build([Paragraph("No payroll records for this period.", template.styles['normal'])])
+    output.seek(0)
+    return output
+
+def render_payslip(payslip):
+    """Render one PayrollRecord.get_payslip_inputs() entry; returns (filename, pdf bytes)."""
+    buffer = generate_payslip_pdf(payslip['payroll_data'], payslip['employee_data'],
+                                  payslip['period_data'], payslip['deductions'])
+    return payslip['filename'], buffer.getvalue()
+
+
+def iter_rendered_payslips(payslips, workers=None):
+    """
+    Yield (filename, pdf bytes) for each payslip as soon as it is rendered.
+
+    Large batches are spread over a process pool with at most two payslips
+    per worker in flight, so finished PDFs never pile up in memory while
+    the consumer is still sending earlier ones.
+    """
+    workers = PAYSLIP_WORKERS if workers is None else workers
+    if workers <= 1 or len(payslips) < PAYSLIP_PARALLEL_MIN:
+        for payslip in payslips:
+            yield render_payslip(payslip)
+        return
+    
+    from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+    
+    pending = iter(payslips)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        in_flight = set()
+        for payslip in pending:
+            in_flight.add(pool.submit(render_payslip, payslip))
+            if len(in_flight) >= workers * 2:
+                break
+        while in_flight:
+            done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+                next_payslip = next(pending, None)
+                if next_payslip is not None:
+                    in_flight.add(pool.submit(render_payslip, next_payslip))
+
+
+class _ZipChunks:
+    """Write-only file object that hands buffered ZIP bytes back to a generator."""
+    
+    def __init__(self):
+        self._chunks = []
+    
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+    
+    def flush(self):
+        pass
+    
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def iter_payslip_zip(payslips, workers=None, progress=None):
+    """
+    Yield a ZIP archive of the rendered payslips chunk by chunk, one entry per
+    payslip in completion order. Only the PDF being written is held in memory.
+    `progress(done, total)` is called after each entry.
+    """
+    sink = _ZipChunks()
+    seen = set()
+    total = len(payslips)
+    # PDFs are already compressed; deflating them again only costs CPU
+    with zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_STORED) as archive:
+        for done, (filename, pdf) in enumerate(iter_rendered_payslips(payslips, workers), 1):
+            name = filename
+            suffix = 2
+            while name in seen:
+                name = filename[:-len('.pdf')] + f'_{suffix}.pdf'
+                suffix += 1
+            seen.add(name)
+            archive.writestr(name, pdf)
+            if progress:
+                progress(done, total)
+            yield sink.drain()
+    yield sink.drain()
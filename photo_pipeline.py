@@ -0,0 +1,277 @@
+"""
+Punch photo pipeline.
+
+record_attendance commits the punch with a `pending:<filename>` photo
+reference and hands the raw upload to submit(). A bounded thread pool then
+draws the purpose label, encodes full-size and thumbnail renditions as WebP
+with JPEG fallbacks, stores them (Supabase Storage with retries, the local
+uploads folder as the fallback) and swaps the pending reference on the
+attendance row for the stored path. When the pool is saturated the photo is
+processed in the calling thread instead, so work is never queued without
+limit.
+"""
+import os
+import time
+import logging
+import threading
+from io import BytesIO
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image, ImageDraw, ImageFont
+
+from models import Attendance
+
+logger = logging.getLogger(__name__)
+
+PHOTO_WORKERS = int(os.environ.get('PHOTO_WORKERS', '4'))
+# Photos waiting or in progress per process before submit() runs them inline
+PHOTO_QUEUE_MAX = int(os.environ.get('PHOTO_QUEUE_MAX', '64'))
+PHOTO_MAX_ATTEMPTS = 3
+PHOTO_RETRY_DELAY = 1.0
+
+# Largest punch photo accepted from a kiosk upload
+PHOTO_MAX_BYTES = int(os.environ.get('PHOTO_MAX_BYTES', str(5 * 1024 * 1024)))
+JPEG_MAGIC = b'\xff\xd8\xff'
+
+# Stored punch photos fit in this box; the admin attendance list uses thumbnails
+PHOTO_SIZE = (640, 480)
+THUMB_SIZE = (160, 120)
+# Every photo is stored as <stem>.{full,thumb}.{jpg,webp}; the attendance row
+# points at the full JPEG, the universally supported fallback
+FULL_JPEG_SUFFIX = '.full.jpg'
+ENCODER_OPTIONS = {
+    'JPEG': {'quality': 60, 'optimize': True},
+    'WEBP': {'quality': 60, 'method': 4},
+}
+EXTENSIONS = {'JPEG': 'jpg', 'WEBP': 'webp'}
+CONTENT_TYPES = {'JPEG': 'image/jpeg', 'WEBP': 'image/webp'}
+LABEL_FONT_PATH = '/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf'
+
+PENDING_PREFIX = 'pending:'
+PHOTO_BUCKET = 'attendance-photos'
+
+PURPOSE_LABELS = {
+    'clock_in': 'CLOCK IN',
+    'clock_out': 'CLOCK OUT',
+    'lunch_break_in': 'LUNCH BREAK - IN',
+    'lunch_break_out': 'LUNCH BREAK - OUT',
+    'snack_break_in': 'SNACK BREAK - IN',
+    'snack_break_out': 'SNACK BREAK - OUT',
+    'emergency_in': 'EMERGENCY - IN',
+    'emergency_out': 'EMERGENCY - OUT',
+    'early_start': 'EARLY START',
+    'remote_field': 'REMOTE/FIELD',
+    'official_overtime': 'OVERTIME',
+    'unapproved_undertime_out': 'UNDERTIME - OUT'
+}
+
+_storage_client = None
+_upload_folder = 'static/uploads'
+
+
+def configure(storage_client=None, upload_folder='static/uploads'):
+    global _storage_client, _upload_folder
+    _storage_client = storage_client
+    _upload_folder = upload_folder
+
+
+class InvalidPhoto(ValueError):
+    pass
+
+
+def read_upload(stream):
+    """
+    Read a raw JPEG upload, refusing oversized or non-JPEG data; returns its
+    bytes. The body has already been received by then: callers bound it with
+    request.max_content_length, this only checks what arrived.
+    """
+    return check_photo(stream.read(PHOTO_MAX_BYTES + 1))
+
+
+def check_photo(data):
+    """Refuse photo bytes over PHOTO_MAX_BYTES or without the JPEG magic bytes; returns data."""
+    if len(data) > PHOTO_MAX_BYTES:
+        raise InvalidPhoto("Photo is too large")
+    if not data.startswith(JPEG_MAGIC):
+        raise InvalidPhoto("Photo must be a JPEG image")
+    return data
+
+
+def photo_filename(employee_id, purpose, timestamp):
+    return f"{employee_id}_{purpose}_{timestamp}{FULL_JPEG_SUFFIX}"
+
+
+def pending_ref(filename):
+    return f'{PENDING_PREFIX}{filename}'
+
+
+def is_pending(photo_path):
+    return bool(photo_path) and str(photo_path).startswith(PENDING_PREFIX)
+
+
+def open_scaled(data, max_size):
+    """
+    Decode an image no larger than needed for max_size. JPEGs are decoded
+    with DCT scaling (Image.draft) at the smallest 1/2, 1/4 or 1/8 size that
+    still covers max_size, so large camera frames are never fully decoded;
+    thumbnail() then does the final LANCZOS resize.
+    """
+    img = Image.open(BytesIO(data))
+    img.draft('RGB', max_size)
+    img = img.convert('RGB')
+    img.thumbnail(max_size, Image.Resampling.LANCZOS)
+    return img
+
+
+@lru_cache(maxsize=1)
+def _label_font():
+    try:
+        return ImageFont.truetype(LABEL_FONT_PATH, 24)
+    except OSError:
+        return ImageFont.load_default()
+
+
+@lru_cache(maxsize=64)
+def _label_geometry(purpose_text, img_width):
+    """Text origin and background box of a label, centred at the top of the image."""
+    left, top, right, bottom = _label_font().getbbox(purpose_text)
+    text_width = right - left
+    text_height = bottom - top
+    x = (img_width - text_width) // 2
+    y = 10
+    padding = 10
+    box = [(x - padding, y - padding), (x + text_width + padding, y + text_height + padding)]
+    return (x, y), box
+
+
+def label_punch_photo(photo_bytes, purpose):
+    """Shrink the selfie to PHOTO_SIZE and stamp the purpose label on it."""
+    img = open_scaled(photo_bytes, PHOTO_SIZE)
+
+    purpose_text = PURPOSE_LABELS.get(purpose, purpose.upper().replace('_', ' '))
+    origin, box = _label_geometry(purpose_text, img.width)
+    draw = ImageDraw.Draw(img)
+    draw.rectangle(box, fill=(0, 0, 0, 180))
+    draw.text(origin, purpose_text, fill=(255, 255, 255), font=_label_font())
+    return img
+
+
+def _encode(img, fmt):
+    output = BytesIO()
+    img.save(output, fmt, **ENCODER_OPTIONS[fmt])
+    return output.getvalue()
+
+
+def render_punch_variants(photo_bytes, purpose, filename):
+    """{file name: (bytes, content type)} of every stored rendition of a punch photo."""
+    full = label_punch_photo(photo_bytes, purpose)
+    thumb = full.copy()
+    thumb.thumbnail(THUMB_SIZE, Image.Resampling.LANCZOS)
+    files = {}
+    for variant, img in (('full', full), ('thumb', thumb)):
+        for fmt in ('JPEG', 'WEBP'):
+            files[variant_filename(filename, variant, fmt)] = (_encode(img, fmt), CONTENT_TYPES[fmt])
+    return files
+
+
+def variant_filename(filename, variant, fmt):
+    """Sibling name of a `<stem>.full.jpg` photo, e.g. `<stem>.thumb.webp`."""
+    stem = filename[:-len(FULL_JPEG_SUFFIX)]
+    return f'{stem}.{variant}.{EXTENSIONS[fmt]}'
+
+
+def variant_url(photo_path, variant, fmt):
+    """
+    URL of another rendition of a stored photo. Photos saved before variants
+    existed (anything not ending in `.full.jpg`) only have the one file.
+    """
+    base = photo_path.rstrip('?')
+    if not base.endswith(FULL_JPEG_SUFFIX):
+        return photo_path
+    return variant_filename(base, variant, fmt)
+
+
+def _upload(name, data, content_type):
+    for attempt in range(1, PHOTO_MAX_ATTEMPTS + 1):
+        try:
+            _storage_client.storage.from_(PHOTO_BUCKET).upload(
+                path=name,
+                file=data,
+                file_options={"content-type": content_type, "upsert": "true"}
+            )
+            return
+        except Exception:
+            logger.warning(f"Photo upload of {name} failed (attempt {attempt}/{PHOTO_MAX_ATTEMPTS})", exc_info=True)
+            if attempt == PHOTO_MAX_ATTEMPTS:
+                raise
+            time.sleep(PHOTO_RETRY_DELAY * 2 ** (attempt - 1))
+
+
+def store_photo(filename, files):
+    """
+    Store every rendition in `files` together, in Supabase Storage (retrying
+    transient failures) or else all in the local uploads folder, so the
+    siblings of `filename` always live next to it. Returns the path of `filename`.
+    """
+    if _storage_client:
+        try:
+            for name, (data, content_type) in files.items():
+                _upload(name, data, content_type)
+            return _storage_client.storage.from_(PHOTO_BUCKET).get_public_url(filename)
+        except Exception:
+            logger.warning(f"Saving {filename} locally after failed uploads")
+
+    for name, (data, content_type) in files.items():
+        with open(os.path.join(_upload_folder, name), 'wb') as f:
+            f.write(data)
+    return f"static/uploads/{filename}"
+
+
+def process_photo(record_id, column, filename, photo_bytes, purpose):
+    """Render and store one punch photo, then point the attendance row at it."""
+    photo_path = None
+    try:
+        photo_path = store_photo(filename, render_punch_variants(photo_bytes, purpose, filename))
+    except Exception:
+        logger.exception(f"Could not process punch photo {filename}")
+    # A photo that could not be stored is cleared rather than left pending forever
+    Attendance.resolve_photo(record_id, column, pending_ref(filename), photo_path)
+    return photo_path
+
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+_slots = threading.BoundedSemaphore(PHOTO_QUEUE_MAX)
+
+
+def _get_executor():
+    """This process's pool; rebuilt after a fork, whose copy has no threads."""
+    global _executor, _executor_pid, _slots
+    if _executor_pid != os.getpid():
+        with _executor_lock:
+            if _executor_pid != os.getpid():
+                _executor = ThreadPoolExecutor(max_workers=PHOTO_WORKERS, thread_name_prefix='photo')
+                _slots = threading.BoundedSemaphore(PHOTO_QUEUE_MAX)
+                _executor_pid = os.getpid()
+    return _executor
+
+
+def submit(record_id, column, filename, photo_bytes, purpose):
+    """Process a committed punch's photo in the background (inline when the pool is full)."""
+    executor = _get_executor()
+    if not _slots.acquire(blocking=False):
+        logger.warning(f"Photo queue full, processing {filename} inline")
+        process_photo(record_id, column, filename, photo_bytes, purpose)
+        return
+
+    def run():
+        try:
+            process_photo(record_id, column, filename, photo_bytes, purpose)
+        except Exception:
+            logger.exception(f"Punch photo {filename} was not recorded")
+        finally:
+            _slots.release()
+
+    executor.submit(run)
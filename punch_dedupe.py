@@ -0,0 +1,77 @@
+"""
+In-process dedupe of kiosk punch submissions.
+
+The kiosk sends an Idempotency-Key with every punch and keeps it when the
+punch is submitted again (a second tap, a retry after a slow response).
+While the first submission is still running in this process, repeats wait
+for it instead of writing and processing the photo again; afterwards they
+get its response from a short-lived cache. Repeats that reach another
+worker, or arrive after the entry expired, are caught by the unique key
+columns on attendance instead.
+"""
+import os
+import time
+import threading
+from collections import OrderedDict
+
+# Seconds a finished punch's response is replayed, and how many are kept
+DEDUPE_TTL = float(os.environ.get('PUNCH_DEDUPE_TTL', '600'))
+DEDUPE_MAX_ENTRIES = 1024
+# Longest a repeat waits for the first submission before running itself
+DEDUPE_WAIT = 30
+
+_entries = OrderedDict()
+_lock = threading.Lock()
+
+
+class _Entry:
+    def __init__(self):
+        self.done = threading.Event()
+        self.response = None
+        self.expires_at = None
+
+
+def _evict(now):
+    """Drop expired responses, then the oldest entries beyond DEDUPE_MAX_ENTRIES."""
+    for key in [key for key, entry in _entries.items()
+                if entry.expires_at is not None and entry.expires_at <= now]:
+        del _entries[key]
+    while len(_entries) > DEDUPE_MAX_ENTRIES:
+        _entries.popitem(last=False)
+
+
+def run_once(key, handler):
+    """
+    handler() -> (payload, status) for a punch; the first response for key
+    is returned to every submission of it. A falsy key runs handler() as is.
+    Server errors (status >= 500) are not remembered, so a retry runs again.
+    """
+    if not key:
+        return handler()
+    now = time.monotonic()
+    with _lock:
+        _evict(now)
+        entry = _entries.get(key)
+        owner = entry is None
+        if owner:
+            entry = _entries[key] = _Entry()
+
+    if not owner:
+        entry.done.wait(DEDUPE_WAIT)
+        if entry.response is not None:
+            return entry.response
+        # The first submission failed or is stuck; the database key still dedupes
+        return handler()
+
+    response = None
+    try:
+        response = handler()
+        return response
+    finally:
+        with _lock:
+            if response is not None and response[1] < 500:
+                entry.response = response
+                entry.expires_at = time.monotonic() + DEDUPE_TTL
+            elif _entries.get(key) is entry:
+                del _entries[key]
+        entry.done.set()